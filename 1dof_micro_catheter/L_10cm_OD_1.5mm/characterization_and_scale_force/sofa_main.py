@@ -5,6 +5,16 @@ from sklearn.cluster import KMeans
 from scipy import optimize
 from utils import *  
 import os
+import sys
+
+# Shared tracking helpers (numba kernels when available, overlay renderer)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tracking'))
+from kernels import arc_length as compute_arc_length, error_fct, error_fct_grad, mask_centroid, reduce_edge_points
+from overlay import ImageSequence, Measurement, OverlayRenderer, render_recorded
+
+# Draw one frame every RENDER_EVERY frames (0 to only write the csv) and show it
+RENDER_EVERY = 1
+SHOW = True
 
 experiment_name = 'sofa_free_motion'
 # experiment_name = 'sofa_force_small_bending'
@@ -18,6 +28,16 @@ elif experiment_name == 'sofa_force_small_bending':
 # Flag variable to track the first iteration
 first_iteration = True  
 
+# The processed images are drawn after the run from the recorded measurements, so no frame is dropped
+def save_processed(frame_index, frame_overlay, _):
+    processed_image_path = image_files[frame_index].replace('crop', 'processed')  # Modify path as needed
+    cv2.imwrite(processed_image_path, frame_overlay)  # Save frame with drawings
+
+# Live display only: drawn in a background thread, frames are skipped when it falls behind
+renderer = OverlayRenderer(every=RENDER_EVERY if SHOW else 0, background=True, radius_limit=1000)
+measurements = []
+frame_index = 0
+
 # Iterate over each image file
 for image_file in image_files:
     frame = cv2.imread(image_file)
@@ -49,25 +69,24 @@ for image_file in image_files:
             lower_yellow = np.array([25, 150, 150])  # Wider range for yellow detection
             upper_yellow = np.array([35, 255, 250])
 
+        # mask_centroid replaces get_red_tip_avg / get_blue_base_avg (yellow base) on the masked 3-channel frame,
+        # which counted every pixel once per non zero channel: each pixel now has the same weight, so the positions
+        # differ slightly from the CSVs written before
         # Get average of coorinates of point in red tip
         mask_red1 = cv2.inRange(hsv, lower_red1, upper_red1)
         mask_red2 = cv2.inRange(hsv, lower_red2, upper_red2)
         mask_red = cv2.bitwise_or(mask_red1, mask_red2)
-        red_tip = cv2.bitwise_and(frame, frame, mask=mask_red)
-        x_tip, y_tip = get_red_tip_avg(red_tip)
+        x_tip, y_tip = mask_centroid(mask_red)
         
         # Detect yellow objects
         mask_yellow = cv2.inRange(hsv, lower_yellow, upper_yellow)
-        yellow_base = cv2.bitwise_and(frame, frame, mask=mask_yellow)
 
         # Get average coordinates of yellow base
-        x_base, y_base = get_blue_base_avg(yellow_base)
+        x_base, y_base = mask_centroid(mask_yellow)
 
-        # Draw points on the frame (for debugging)
-        if not np.isnan(x_tip) and not np.isnan(y_tip):
-            cv2.circle(frame, (int(x_tip), int(y_tip)), 10, (0, 255, 0), 5)       
-        if not np.isnan(x_base) and not np.isnan(y_base):
-            cv2.circle(frame, (int(x_base), int(y_base)), 10, (0, 255, 0), 5)    
+        # Store the measurements of this frame, drawn later by the renderer (the drawings no longer end up in
+        # the image used for edge detection)
+        measurement = Measurement(frame_index, tip=(x_tip, y_tip), base=(x_base, y_base))
 
         # Apply the new edge detection process
         edges = process_frame_for_edges(frame)
@@ -81,23 +100,12 @@ for image_file in image_files:
         points = points[(points[:, 0] > x_base) & (points[:, 0] < x_tip - offset)]
         
         if len(points) > 0:
-            reduced_points = []
-            cols, rows = edges.shape[:2]
             cols_per_step = 2  # Reduce the number of points by a factor of cols_per_step
 
-            for col in range(0, cols, cols_per_step):
-                if col > x_base and col < x_tip - offset:  # Ensure col is strictly between x_base and x_tip
-                    row_indices = np.where(edges[:, col] > 0)[0]
-                    if len(row_indices) > 0:
-                        row = int(np.mean(row_indices))
-                        reduced_points.append([col, row])
-
-            # Convert reduced_points to a NumPy array for further operations
-            reduced_points = np.array(reduced_points)            
-
-            # Draw all the reduced points on the frame (for debugging)
-            for point in reduced_points:
-                cv2.circle(frame, tuple(point), 1, (204, 255, 204), 1)
+            # One point per column strictly between x_base and x_tip (the columns scanned stop at
+            # edges.shape[0], as in the original loop)
+            reduced_points = reduce_edge_points(edges, cols_per_step, x_base, min(x_tip - offset, edges.shape[0]))
+            measurement.points = reduced_points
 
             # Get x n and y coordinates of the points as np.array
             x = reduced_points[:, 0]
@@ -107,11 +115,10 @@ for image_file in image_files:
             guess = (np.mean(x), np.mean(y), np.std(x))
 
             # Use scipy.optimize.minimize to solve the problem
-            result = optimize.minimize(error_fct, guess, args=(x, y))
+            result = optimize.minimize(error_fct, guess, args=(x, y), jac=error_fct_grad)
 
             # Extract the result
             x_c, y_c, radius = result.x
-            center = (int(x_c), int(y_c))
             radius = int(radius)
             curvature = 1 / radius
 
@@ -131,31 +138,38 @@ for image_file in image_files:
                 # Include pressure and force in the CSV entry
                 f.write(f'{radius:.2f},{curvature:.2f},{arc_length:.2f},{x_tip:.2f},{y_tip:.2f},{x_base:.2f},{y_base:.2f}\n')
 
-            # Check radius thresold
-            if radius < 1000:               
-                # Draw the fitted circle on the frame (for debugging)
-                cv2.circle(frame, center, radius, (255, 204, 204), 2)
-
-            # Display the curvature (for debugging)
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            cv2.putText(frame, 'Radius: {:.2f} px'.format(radius), (10, 50), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-            cv2.putText(frame, 'Arc Length: {:.2f} px'.format(arc_length), (10, 90), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-            cv2.putText(frame, 'X Tip: {:.2f}'.format(x_tip), (10, 210), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-            cv2.putText(frame, 'Y Tip: {:.2f}'.format(y_tip), (10, 250), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-        
-        # Display the frame (for debugging)
-        cv2.imshow('Frame', frame)
-        cv2.imshow('Edges', edges)
-
-        # Save the processed image
-        processed_image_path = image_file.replace('crop', 'processed')  # Modify path as needed
-        cv2.imwrite(processed_image_path, frame)  # Save frame with drawings
-
-        # Break the loop on 'q' key press
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+            # Fitted circle and values displayed on the frame (for debugging, circles with radius over 1000 px
+            # are not drawn)
+            measurement.circle = (x_c, y_c, radius)
+            measurement.labels = {
+                'Radius': '{:.2f} px'.format(radius),
+                'Arc Length': '{:.2f} px'.format(arc_length),
+                'X Tip': '{:.2f}'.format(x_tip),
+                'Y Tip': '{:.2f}'.format(y_tip),
+            }
+
+        # Hand the frame over to the display renderer (drawing never blocks the measurement)
+        measurements.append(measurement)
+        renderer.submit(frame, measurement, edges)
+        frame_index += 1
+
+        # Display the last drawn frame (for debugging)
+        if SHOW and renderer.last_rendered is not None:
+            _, frame_overlay, edges_overlay = renderer.last_rendered
+            cv2.imshow('Frame', frame_overlay)
+            cv2.imshow('Edges', edges_overlay)
+
+            # Break the loop on 'q' key press
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
     else:
         break
 
+renderer.close()
+
+# Draw the measurements on the images and save them
+if RENDER_EVERY:
+    render_recorded(ImageSequence(image_files), measurements,
+                    OverlayRenderer(sink=save_processed, every=RENDER_EVERY, radius_limit=1000))
 cv2.destroyAllWindows()
 
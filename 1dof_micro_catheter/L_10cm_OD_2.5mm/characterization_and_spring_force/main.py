@@ -1,7 +1,19 @@
+import os
+import sys
 from scipy import optimize
 from utils import *
 from sklearn.cluster import KMeans
 
+# Shared tracking helpers
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tracking'))
+from kernels import arc_length as compute_arc_length, error_fct, error_fct_grad, reduce_edge_points
+from overlay import Measurement, OverlayRenderer, render_recorded
+from orientation import CircularSmoother, tip_tangent_angle
+
+# Draw one frame every RENDER_EVERY frames (0 to only write the csv) and show it
+RENDER_EVERY = 1
+SHOW = True
+
 # Read the cropped video
 cap = cv2.VideoCapture('data/video/diagonal_force.mp4')
 
@@ -14,12 +26,27 @@ fourcc = cv2.VideoWriter_fourcc(*'mp4v') # or use 'XVID'
 out_circle = cv2.VideoWriter('data/video/circle.mp4', fourcc, 20.0, (width, height))
 out_edges = cv2.VideoWriter('data/video/edges.mp4', fourcc, 20.0, (width, height))
 
-# Initialize slope history for filtering
-m1_history = []
+# The videos are drawn after the run from the recorded measurements, so no frame is dropped
+# (model_validation.py matches the frames of edges.mp4 with the pressure)
+def write_videos(frame_index, frame_overlay, edges_overlay):
+    out_circle.write(frame_overlay)
+    out_edges.write(edges_overlay)
+
+# Start a new csv (rows are appended every frame): rows of a previous run, possibly in the older 6-column format,
+# would make model_validation.py fail to read it
+open('data/cv_output.csv', 'w').close()
+
+# Live display only: drawn in a background thread, frames are skipped when it falls behind
+renderer = OverlayRenderer(every=RENDER_EVERY if SHOW else 0, background=True)
+measurements = []
+frame_index = 0
 
-# Max history length
+# Max history length of the tip orientation filter
 history_length = 5
 
+# Tip orientation filter (averages unit vectors, no jump at +-pi)
+tip_angle_filter = CircularSmoother(history_length)
+
 # Process the first frame only
 ret, frame = cap.read()
 
@@ -117,20 +144,9 @@ while(cap.isOpened()):
             # Compute distance between the two blue objects
             spring_length = np.sqrt((x_blue_2 - x_blue_1)**2 + (y_blue_2 - y_blue_1)**2)
 
-            # Draw circles on the original frame to indicate the objects
-            cv2.circle(frame, (int(x_blue_1), int(y_blue_1)), 10, (255, 192, 203), 2) 
-            cv2.circle(frame, (int(x_blue_2), int(y_blue_2)), 10, (255, 192, 203), 2)  
-
-
-        # Draw points on the frame (for debugging)
-        if not np.isnan(x_tip) and not np.isnan(y_tip):
-            cv2.circle(frame, (int(x_tip), int(y_tip)), 10, (0, 255, 0), 5)       
-        if not np.isnan(x_base) and not np.isnan(y_base):
-            cv2.circle(frame, (int(x_base), int(y_base)), 10, (0, 255, 0), 5)    
-        if not np.isnan(x_blue_1) and not np.isnan(y_blue_1):
-            cv2.circle(frame, (int(x_blue_1), int(y_blue_1)), 10, (0, 255, 0), 5)
-        if not np.isnan(x_blue_2) and not np.isnan(y_blue_2):
-            cv2.circle(frame, (int(x_blue_2), int(y_blue_2)), 10, (0, 255, 0), 5)
+        # Store the measurements of this frame, drawn later by the renderer
+        measurement = Measurement(frame_index, tip=(x_tip, y_tip), base=(x_base, y_base),
+                                  markers=[(x_blue_1, y_blue_1), (x_blue_2, y_blue_2)])
 
         # Apply the new edge detection process
         edges = process_frame_for_edges(frame)
@@ -144,23 +160,12 @@ while(cap.isOpened()):
         points = points[(points[:, 0] > x_base) & (points[:, 0] < x_tip - offset)]
         
         if len(points) > 0:
-            reduced_points = []
-            cols, rows = edges.shape[:2]
             cols_per_step = 2  # Reduce the number of points by a factor of cols_per_step
 
-            for col in range(0, cols, cols_per_step):
-                if col > x_base and col < x_tip - offset:  # Ensure col is strictly between x_base and x_tip
-                    row_indices = np.where(edges[:, col] > 0)[0]
-                    if len(row_indices) > 0:
-                        row = int(np.mean(row_indices))
-                        reduced_points.append([col, row])
-
-            # Convert reduced_points to a NumPy array for further operations
-            reduced_points = np.array(reduced_points)            
-
-            # Draw all the reduced points on the frame (for debugging)
-            for point in reduced_points:
-                cv2.circle(frame, tuple(point), 1, (204, 255, 204), 1)
+            # One point per column strictly between x_base and x_tip (the columns scanned stop at
+            # edges.shape[0], as in the original loop)
+            reduced_points = reduce_edge_points(edges, cols_per_step, x_base, min(x_tip - offset, edges.shape[0]))
+            measurement.points = reduced_points
 
             # Get x n and y coordinates of the points as np.array
             x = reduced_points[:, 0]
@@ -170,89 +175,70 @@ while(cap.isOpened()):
             guess = (np.mean(x), np.mean(y), np.std(x))
 
             # Use scipy.optimize.minimize to solve the problem
-            result = optimize.minimize(error_fct, guess, args=(x, y))
+            result = optimize.minimize(error_fct, guess, args=(x, y), jac=error_fct_grad)
 
             # Extract the result
             x_c, y_c, radius = result.x
-            center = (int(x_c), int(y_c))
             radius = int(radius)
             curvature = 1 / radius
 
             # Compute arc length
             arc_length = compute_arc_length(x_c, y_c, radius, x_base, y_base, x_tip, y_tip)
 
-            # Store radius, curvature and arc length in a csv file
-            with open('data/cv_output.csv', 'a') as f:
-                f.write('{:.2f},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f}\n'.format(radius, curvature, arc_length, x_tip, y_tip, spring_length))
-
-            # Check radius thresold
-            if radius < 600:               
-                # Draw the fitted circle on the frame (for debugging)
-                cv2.circle(frame, center, radius, (255, 204, 204), 2)
-
-            # Display the curvature (for debugging)
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            cv2.putText(frame, 'Radius: {:.2f} px'.format(radius) , (10, 50), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-            cv2.putText(frame, 'Spring Length: {:.2f} px'.format(spring_length), (10, 90), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-            cv2.putText(frame, 'Arc Length: {:.2f} px'.format(arc_length), (10, 130), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-            
-
-            # Draw the tangent line on the edges frame to display the tip orientation
-            if not np.isnan(x_tip) and not np.isnan(y_tip):
-                # Draw red point on tip coordinates 
-                edges = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-                cv2.circle(edges, (int(x_tip), int(y_tip)), 1, (206, 0, 88), 5)
+            # Compute the tip orientation (tangent to the circle at the tip, from base to tip)
+            tip_angle = tip_tangent_angle(x_c, y_c, x_tip, y_tip, x_base, y_base)
+            tip_angle_filtered = tip_angle_filter.update(tip_angle)
 
-                # Filter slope
-                # Get the slope of the line between the center and the tip
-                m1 = (y_tip - y_c) / (x_tip - x_c)
-
-                # Append the value to the history
-                m1_history.append(m1)
-
-                # Ensure the history does not exceed max length
-                if len(m1_history) > history_length:
-                    m1_history.pop(0)
-
-                # Compute the average
-                avg_m1 = np.mean(m1_history)
-
-                # Get tangent line equation                
-                m2 = -1 / avg_m1
-                b = y_tip - m2 * x_tip
-
-                # Fixed length of the arrow
-                arrow_length = 50
-
-                # Calculate angle of the vector using the slope
-                theta = np.arctan(avg_m1) - np.pi / 2 # Subtract Pi/2 for 90 degree rotation
-
-                # Calculate the x and y coordinates for the end of the vector
-                x2 = x_tip + arrow_length * np.cos(theta)
-                y2 = y_tip + arrow_length * np.sin(theta) # Add because the y-axis is inverted in image coordinates
-
-                # Draw arrowed line
-                cv2.arrowedLine(edges, (int(x_tip), int(y_tip)), (int(x2), int(y2)), (206, 0, 88), 2, tipLength=0.2)
+            # Store radius, curvature, arc length, tip orientation [rad] and frame index in a csv file
+            with open('data/cv_output.csv', 'a') as f:
+                f.write('{:.2f},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f},{:.4f},{:.4f},{}\n'.format(
+                    radius, curvature, arc_length, x_tip, y_tip, spring_length,
+                    tip_angle, tip_angle_filtered, frame_index))
+
+            # Fitted circle and values displayed on the frame (for debugging)
+            measurement.circle = (x_c, y_c, radius)
+            measurement.labels = {
+                'Radius': '{:.2f} px'.format(radius),
+                'Spring Length': '{:.2f} px'.format(spring_length),
+                'Arc Length': '{:.2f} px'.format(arc_length),
+                'Tip Angle': '{:.1f} deg'.format(np.degrees(tip_angle_filtered)),
+            }
+
+            # Tip orientation displayed as an arrow on the edges frame
+            measurement.tip_angle = tip_angle_filtered
 
             # Draw the tip position predicted by the model
             #x_tip_pred, y_tip_pred, theta_pred = tip_cartesian(k_coeff, p, arc_length, x_base, y_base)
             # ADDED in 
                 
         
-        # Display the frame (for debugging)
-        cv2.imshow('Frame', frame)
-        cv2.imshow('Edges', edges)
-
-        # Save video of frame and edges
-        out_circle.write(frame)
-        out_edges.write(edges)
-
-        # Break the loop on 'q' key press
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+        # Hand the frame over to the display renderer (drawing never blocks the measurement)
+        measurements.append(measurement)
+        renderer.submit(frame, measurement, edges)
+        frame_index += 1
+
+        # Display the last drawn frame (for debugging)
+        if SHOW and renderer.last_rendered is not None:
+            _, frame_overlay, edges_overlay = renderer.last_rendered
+            cv2.imshow('Frame', frame_overlay)
+            cv2.imshow('Edges', edges_overlay)
+
+            # Break the loop on 'q' key press
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
     else:
         break
 
+renderer.close()
 cap.release()
+
+# Draw the measurements on the frames of the video (the first frame was only used for the base)
+if RENDER_EVERY:
+    cap = cv2.VideoCapture('data/video/diagonal_force.mp4')
+    render_recorded(cap, measurements, OverlayRenderer(sink=write_videos, every=RENDER_EVERY),
+                    edges_fn=process_frame_for_edges, skip=1)
+    cap.release()
+out_circle.release()
+out_edges.release()
 cv2.destroyAllWindows()
 
@@ -1,8 +1,17 @@
+import os
+import sys
 import pandas as pd
 import numpy as np
 import cv2
 from kin_model import tip_cartesian
 
+# Shared tracking helpers
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tracking'))
+from orientation import angle_difference, to_model_orientation
+
+# Direction of the catheter at the base in image coordinates (the catheter leaves the base upwards)
+BASE_ANGLE = -np.pi / 2
+
 # Import pressure data (value of the pressure every 0.005 seconds)
 pressure = pd.read_csv('data/Pressure.csv', header=None)
 print("\nPressure data shape: ", pressure.shape)
@@ -36,6 +45,12 @@ print("\narc length avg: ", arc_length_avg, " px")
 print("x_base avg: ", x_base_avg, " px")
 print("y_base avg: ", y_base_avg, " px")
 
+# Measured tip orientation (filtered), only in csv files written with the orientation columns
+theta_meas = {}
+if cv_output.shape[1] > 6:
+    theta_meas = dict(zip(cv_output.iloc[:, 8].astype(int),
+                          to_model_orientation(cv_output.iloc[:, 7].values, BASE_ANGLE)))
+
 # Tip length 
 L = 5 #mm
 
@@ -76,6 +91,9 @@ out_video = cv2.VideoWriter('data/video/model_validation.mp4', fourcc, 20.0, (fr
 # Init index to get the right pressure value
 index = 0
 
+# Orientation error of the model for the frames with a measured orientation
+theta_errors = []
+
 # Loop over all frames in the video
 while(cap.isOpened()):
     # Read the current frame
@@ -97,6 +115,11 @@ while(cap.isOpened()):
         print("y_tip_pred: ", y_tip_pred, " px")
         print("Lpx: ", L*mm2px, " px")
 
+        # Compare the predicted orientation with the measured one (frames of edges.mp4 are the
+        # frames of the tracker when it draws every frame)
+        if index in theta_meas and not np.isnan(theta_meas[index]):
+            theta_errors.append(angle_difference(theta_pred, theta_meas[index]))
+
         # transform coordinates in opencv frame
         x_tip_pred = x_base_avg 
         y_tip_pred = y_base_avg - x_tip_pred
@@ -127,4 +150,8 @@ out_video.release()
 # Close all OpenCV windows
 cv2.destroyAllWindows()
 
+if len(theta_errors) > 0:
+    theta_rmse = np.sqrt(np.mean(np.square(theta_errors)))
+    print("\nTip orientation RMSE: {:.2f} deg over {} frames".format(np.degrees(theta_rmse), len(theta_errors)))
+
 
@@ -1,5 +1,11 @@
 import cv2
 import numpy as np
+import os
+import sys
+
+# Shared tracking kernels (numba when available)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tracking'))
+from kernels import mask_centroid
 
 # Define the circle equation and the error function
 def circle_eqn(x_c, y_c, x, y):
@@ -15,32 +21,18 @@ def get_red_tip_avg(red_tip):
     red_tip_gray = cv2.cvtColor(red_tip, cv2.COLOR_BGR2GRAY)
     _, red_tip_thresh = cv2.threshold(red_tip_gray, 127, 255, cv2.THRESH_BINARY)
     red_tip_edges = cv2.Canny(red_tip_thresh, 50, 150)
-    red_tip_points = np.where((red_tip_edges > 0))
-    red_tip_points = np.column_stack((red_tip_points[1], red_tip_points[0]))        
 
     # Get average of coorinates of point in red tip
-    red_tip_x = red_tip_points[:, 0]
-    red_tip_y = red_tip_points[:, 1]
-    x_tip = np.mean(red_tip_x)
-    y_tip = np.mean(red_tip_y)
-
-    return x_tip, y_tip
+    return mask_centroid(red_tip_edges)
 
 # Get average coordinates of yellow base
 def get_yellow_base_avg(yellow_base):
     yellow_base_gray = cv2.cvtColor(yellow_base, cv2.COLOR_BGR2GRAY)
     _, yellow_base_thresh = cv2.threshold(yellow_base_gray, 127, 255, cv2.THRESH_BINARY)
     yellow_base_edges = cv2.Canny(yellow_base_thresh, 50, 150)
-    yellow_base_points = np.where((yellow_base_edges > 0))
-    yellow_base_points = np.column_stack((yellow_base_points[1], yellow_base_points[0]))
 
     # Get average coordinates of yellow base
-    yellow_base_x = yellow_base_points[:, 0]
-    yellow_base_y = yellow_base_points[:, 1]
-    x_base = np.mean(yellow_base_x)
-    y_base = np.mean(yellow_base_y)
-
-    return x_base, y_base
+    return mask_centroid(yellow_base_edges)
 
 # Compute arc length
 def compute_arc_length(x_c, y_c, radius, x_base, y_base, x_tip, y_tip):
@@ -1,8 +1,19 @@
 import cv2
 import numpy as np
+import os
+import sys
 from scipy import optimize
 from utils import *
 
+# Shared tracking kernels (numba when available)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tracking'))
+from kernels import contour_points, error_fct_grad
+from overlay import Measurement, OverlayRenderer, render_recorded
+
+# Draw one frame every RENDER_EVERY frames (0 to only write the csv) and show it
+RENDER_EVERY = 1
+SHOW = True
+
 # Read the cropped video
 cap = cv2.VideoCapture('data/video/red.mp4')
 
@@ -14,6 +25,12 @@ height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # or use 'XVID'
 out_circle = cv2.VideoWriter('data/video/cong_circle.mp4', fourcc, 20.0, (width, height))
 
+# Live display only: drawn in a background thread, frames are skipped when it falls behind
+renderer = OverlayRenderer(every=RENDER_EVERY if SHOW else 0, background=True)
+# The video is drawn after the run from the recorded measurements, so no frame is dropped
+measurements = []
+frame_index = 0
+
 # Process each frame
 while cap.isOpened():
     ret, frame = cap.read()
@@ -45,21 +62,12 @@ while cap.isOpened():
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
         # Extract the coordinates of the reduced points
-        reduced_points = []
-        for contour in contours:
-            for point in contour:
-                x, y = point[0]
-                reduced_points.append([x, y])
+        reduced_points = contour_points(contours)
 
-                # Draw a circle on the frame at the reduced point
-                cv2.circle(frame, (x, y), 3, (0, 0, 255), -1)
-
-        # Draw all the reduced points on the frame (for debugging)
-        for point in reduced_points:
-            cv2.circle(frame, tuple(point), 1, (204, 255, 204), 1)
+        # Store the measurements of this frame, drawn later by the renderer
+        measurement = Measurement(frame_index, points=list(contours))
 
         # Get x and y coordinates of the reduced points as np.array
-        reduced_points = np.array(reduced_points)
         x = reduced_points[:, 0]
         y = reduced_points[:, 1]
 
@@ -67,11 +75,10 @@ while cap.isOpened():
         guess = (np.mean(x), np.mean(y), np.std(x))
 
         # Use scipy.optimize.minimize to solve the problem
-        result = optimize.minimize(error_fct, guess, args=(x, y))
+        result = optimize.minimize(error_fct, guess, args=(x, y), jac=error_fct_grad)
 
         # Extract the result
         x_c, y_c, radius = result.x
-        center = (int(x_c), int(y_c))
         radius = int(radius)
         curvature = 1 / radius
 
@@ -79,27 +86,36 @@ while cap.isOpened():
         with open('data/cong_cv_output.csv', 'a') as f:
             f.write('{:.2f},{:.2f}\n'.format(radius, curvature))
 
-        # Check radius thresold
-        if radius < 600:               
-            # Draw the fitted circle on the frame (for debugging)
-            cv2.circle(frame, center, radius, (255, 204, 204), 2)
-
-        # Display the curvature (for debugging)
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        cv2.putText(frame, 'Radius: {:.2f} px'.format(radius) , (10, 50), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-        cv2.putText(frame, 'Curvature: {:.2f}'.format(curvature), (10, 90), font, 0.5, (204, 229, 255), 1, cv2.LINE_AA)
-
-        # Display the frame (for debugging)
-        cv2.imshow('Frame', frame)
-
-        # Save video of frame and edges
-        out_circle.write(frame)
-
-        # Break the loop on 'q' key press
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+        # Fitted circle and values displayed on the frame (for debugging)
+        measurement.circle = (x_c, y_c, radius)
+        measurement.labels = {
+            'Radius': '{:.2f} px'.format(radius),
+            'Curvature': '{:.2f}'.format(curvature),
+        }
+
+        # Hand the frame over to the display renderer (drawing never blocks the measurement)
+        measurements.append(measurement)
+        renderer.submit(frame, measurement)
+        frame_index += 1
+
+        # Display the last drawn frame (for debugging)
+        if SHOW and renderer.last_rendered is not None:
+            cv2.imshow('Frame', renderer.last_rendered[1])
+
+            # Break the loop on 'q' key press
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
     else:
         break
 
+renderer.close()
 cap.release()
+
+# Draw the measurements on the frames of the video
+if RENDER_EVERY:
+    cap = cv2.VideoCapture('data/video/red.mp4')
+    render_recorded(cap, measurements, OverlayRenderer(
+        sink=lambda frame_index, frame_overlay, _: out_circle.write(frame_overlay), every=RENDER_EVERY))
+    cap.release()
+out_circle.release()
 cv2.destroyAllWindows()
@@ -0,0 +1,182 @@
+"""
+Closed form (algebraic) circle fitting.
+
+The trackers fit the circle with scipy.optimize.minimize(error_fct, ...), which is accurate but
+iterative. The algebraic (Kasa) fit solves the linear least squares problem
+    x^2 + y^2 + D x + E y + F = 0
+in one shot, which is good enough to score segmentation settings and to seed the geometric fit.
+
+In offline mode the reduced points of every frame are already available, so all the frames are
+fitted together: the points are concatenated in a single (N, 2) array and frame i owns the rows
+offsets[i]:offsets[i+1] (same layout as a CSR matrix). The moment sums of all frames are computed
+with np.add.reduceat and the normal equations are solved as one batch of 3x3 systems.
+"""
+
+import numpy as np
+
+
+def pack_points(point_sets):
+    """
+    Concatenates a list of (n_i, 2) point arrays.
+    Returns:
+        points: (sum n_i, 2) array
+        offsets: (len(point_sets) + 1,) array, frame i is points[offsets[i]:offsets[i+1]]
+    """
+    counts = [len(p) for p in point_sets]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    if offsets[-1] == 0:
+        return np.empty((0, 2)), offsets
+    points = np.concatenate([np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in point_sets if len(p) > 0])
+    return points, offsets
+
+
+def _segment_sums(values, starts):
+    # reduceat sums values[starts[k]:starts[k+1]], starts must only contain non empty segments
+    return np.add.reduceat(values, starts)
+
+
+def fit_circles_batched(points, offsets):
+    """
+    Algebraic circle fit of many point sets in a single vectorised call.
+    Inputs:
+        points: (N, 2) array of [x, y] points of all the frames
+        offsets: (F + 1,) array of segment boundaries (see pack_points)
+    Returns:
+        x_c, y_c, radius: (F,) arrays (nan for frames with fewer than 3 points or degenerate points)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    num_frames = len(counts)
+    x_c = np.full(num_frames, np.nan)
+    y_c = np.full(num_frames, np.nan)
+    radius = np.full(num_frames, np.nan)
+
+    fitted = counts >= 3
+    if not fitted.any():
+        return x_c, y_c, radius
+
+    # Drop the frames that can't be fitted so that every reduceat segment is non empty
+    keep = np.repeat(fitted, counts)
+    pts = points[keep]
+    n = counts[fitted]
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+
+    # Centre every frame on its mean for numerical stability
+    x_m = _segment_sums(pts[:, 0], starts) / n
+    y_m = _segment_sums(pts[:, 1], starts) / n
+    u = pts[:, 0] - np.repeat(x_m, n)
+    v = pts[:, 1] - np.repeat(y_m, n)
+    z = u * u + v * v
+
+    s_uu = _segment_sums(u * u, starts)
+    s_uv = _segment_sums(u * v, starts)
+    s_vv = _segment_sums(v * v, starts)
+    s_u = _segment_sums(u, starts)
+    s_v = _segment_sums(v, starts)
+    s_uz = _segment_sums(u * z, starts)
+    s_vz = _segment_sums(v * z, starts)
+    s_z = _segment_sums(z, starts)
+
+    # Normal equations of [u v 1] @ [D E F] = -z, one 3x3 system per frame
+    A = np.empty((len(n), 3, 3))
+    A[:, 0, 0], A[:, 0, 1], A[:, 0, 2] = s_uu, s_uv, s_u
+    A[:, 1, 0], A[:, 1, 1], A[:, 1, 2] = s_uv, s_vv, s_v
+    A[:, 2, 0], A[:, 2, 1], A[:, 2, 2] = s_u, s_v, n
+    b = -np.stack((s_uz, s_vz, s_z), axis=1)
+
+    # Collinear points give a singular system, solve an identity instead and discard the result
+    scale = np.maximum(s_uu + s_vv, 1.0)
+    singular = np.abs(np.linalg.det(A)) <= 1e-12 * scale * scale * n
+    A[singular] = np.eye(3)
+    D, E, F = np.linalg.solve(A, b[..., None])[..., 0].T
+
+    u_c, v_c = -D / 2, -E / 2
+    r2 = u_c * u_c + v_c * v_c - F
+    valid = ~singular & (r2 > 0)
+
+    idx = np.flatnonzero(fitted)[valid]
+    x_c[idx] = u_c[valid] + x_m[valid]
+    y_c[idx] = v_c[valid] + y_m[valid]
+    radius[idx] = np.sqrt(r2[valid])
+    return x_c, y_c, radius
+
+
+def fit_circle(x, y):
+    """
+    Algebraic circle fit of a single point set.
+    Inputs:
+        x, y: coordinates of the points
+    Returns:
+        x_c, y_c, radius (nan if the points are degenerate)
+    """
+    points = np.column_stack((np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)))
+    x_c, y_c, radius = fit_circles_batched(points, [0, len(points)])
+    return x_c[0], y_c[0], radius[0]
+
+
+def circle_residuals(x_c, y_c, radius, x, y):
+    """Signed geometric distance of every point from the circle"""
+    return np.hypot(np.asarray(x) - x_c, np.asarray(y) - y_c) - radius
+
+
+def rms_residuals_batched(points, offsets, x_c, y_c, radius):
+    """
+    RMS geometric residual of every frame of a batch (see fit_circles_batched).
+    Returns:
+        (F,) array, nan for frames that were not fitted
+    """
+    points = np.asarray(points, dtype=np.float64)
+    counts = np.diff(np.asarray(offsets, dtype=np.int64))
+    rms = np.full(len(counts), np.nan)
+    fitted = (counts > 0) & ~np.isnan(radius)
+    if not fitted.any():
+        return rms
+
+    keep = np.repeat(fitted, counts)
+    n = counts[fitted]
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+    res = circle_residuals(
+        np.repeat(x_c[fitted], n), np.repeat(y_c[fitted], n), np.repeat(radius[fitted], n),
+        points[keep, 0], points[keep, 1],
+    )
+    rms[fitted] = np.sqrt(_segment_sums(res * res, starts) / n)
+    return rms
+
+
+if __name__ == "__main__":
+    import time
+
+    # Noise free arcs of random circles must be recovered exactly
+    rng = np.random.default_rng(0)
+    num_frames = 20000
+    centres = rng.uniform(0, 500, size=(num_frames, 2))
+    radii = rng.uniform(50, 800, size=num_frames)
+    point_sets = []
+    for (cx, cy), r in zip(centres, radii):
+        theta = rng.uniform(0, np.pi / 2) + np.linspace(0, rng.uniform(0.3, 1.5), rng.integers(3, 80))
+        point_sets.append(np.column_stack((cx + r * np.cos(theta), cy + r * np.sin(theta))))
+    # Degenerate frames: empty, too few points, collinear
+    point_sets[10] = np.empty((0, 2))
+    point_sets[11] = np.array([[0.0, 0.0], [1.0, 1.0]])
+    point_sets[12] = np.column_stack((np.arange(10.0), 2 * np.arange(10.0)))
+
+    points, offsets = pack_points(point_sets)
+    start = time.perf_counter()
+    x_c, y_c, radius = fit_circles_batched(points, offsets)
+    end = time.perf_counter()
+    print(f"Fitted {num_frames} frames ({len(points)} points) in {(end - start) * 1000:.1f} ms")
+
+    ok = np.ones(num_frames, dtype=bool)
+    ok[[10, 11, 12]] = False
+    assert np.all(np.isnan(radius[~ok]))
+    assert np.allclose(x_c[ok], centres[ok, 0], atol=1e-4 * radii[ok])
+    assert np.allclose(y_c[ok], centres[ok, 1], atol=1e-4 * radii[ok])
+    assert np.allclose(radius[ok], radii[ok], rtol=1e-4)
+
+    # Batched and single frame fits agree
+    for i in [0, 1, 500, num_frames - 1]:
+        assert np.allclose(fit_circle(point_sets[i][:, 0], point_sets[i][:, 1]), (x_c[i], y_c[i], radius[i]))
+    assert np.nanmax(rms_residuals_batched(points, offsets, x_c, y_c, radius)) < 1e-3
+
+    print("Success!")
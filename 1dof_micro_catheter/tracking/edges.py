@@ -0,0 +1,72 @@
+"""
+Edge extraction and point reduction shared by the catheter trackers.
+
+The per-experiment scripts all follow the same recipe: mask out the coloured background in HSV,
+median blur the inverted mask, run Canny on it and then reduce the edge pixels to one point per
+column (side view trackers) or per row (top view trackers) by averaging the edge coordinates.
+"""
+
+import cv2
+import numpy as np
+
+
+def edge_map(hsv, lower_hsv, upper_hsv, blur=5, canny_low=100, canny_high=200):
+    """
+    Same pipeline as process_frame_for_edges() but on an already converted HSV frame and with
+    every threshold exposed, so the HSV conversion can be shared between settings.
+    Inputs:
+        hsv: frame in HSV colour space
+        lower_hsv, upper_hsv: HSV range of the background to remove
+        blur: median blur aperture (odd)
+        canny_low, canny_high: Canny hysteresis thresholds
+    Returns:
+        Binary edge image (uint8, 0 or 255)
+    """
+    mask_background = cv2.inRange(hsv, np.asarray(lower_hsv), np.asarray(upper_hsv))
+    return edges_from_mask(mask_background, blur, canny_low, canny_high)
+
+
+def edges_from_mask(mask_background, blur=5, canny_low=100, canny_high=200):
+    """Inverts a background mask, blurs it and detects the edges of what is left"""
+    mask_objects = cv2.bitwise_not(mask_background)
+    mask_objects_blurred = cv2.medianBlur(mask_objects, blur)
+    return cv2.Canny(mask_objects_blurred, canny_low, canny_high)
+
+
+def reduce_edge_points(edges, step=2, lo=None, hi=None, axis=0):
+    """
+    Vectorised version of the reduction loop of the trackers:
+
+        for col in range(0, cols, step):
+            if lo < col < hi:
+                row_indices = np.where(edges[:, col] > 0)[0]
+                if len(row_indices) > 0:
+                    reduced_points.append([col, int(np.mean(row_indices))])
+
+    Inputs:
+        edges: binary edge image
+        step: keep one line every step lines
+        lo, hi: optional open interval on the scanned coordinate (e.g. x_base and x_tip - offset)
+        axis: 0 scans columns (one point per column), 1 scans rows (one point per row)
+    Returns:
+        (N, 2) int array of [x, y] points
+    """
+    if axis == 1:
+        edges = edges.T
+    lines = np.arange(0, edges.shape[1], step)
+    if lo is not None:
+        lines = lines[lines > lo]
+    if hi is not None:
+        lines = lines[lines < hi]
+
+    hits = edges[:, lines] > 0
+    counts = np.count_nonzero(hits, axis=0)
+    sums = np.arange(edges.shape[0]) @ hits
+    keep = counts > 0
+    # Integer division truncates like int(np.mean(...)) since indices are non negative
+    means = sums[keep] // counts[keep]
+    lines = lines[keep]
+
+    if axis == 1:
+        return np.column_stack((means, lines)).astype(int)
+    return np.column_stack((lines, means)).astype(int)
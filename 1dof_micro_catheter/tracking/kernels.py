@@ -0,0 +1,319 @@
+"""
+Compiled kernels for the hot loops of the catheter trackers.
+
+Covers the edge point reduction, the circle residuals / Jacobian used by the geometric fit
+(error_fct in the experiment utils.py), the centroid of the colour masks (tip and base markers),
+the arc length between base and tip and the flattening of contours in cong_data.py. Used by the
+L_10cm trackers (main.py, sofa_main.py), cong_data.py and threshold_sweep.py.
+
+Every kernel has a Numba implementation (used automatically when numba is installed, compiled with
+nogil so that threads calling it run in parallel) and a pure NumPy implementation with identical
+results. Set kernels.USE_NUMBA = False to force NumPy.
+Run this file to check that both implementations agree.
+"""
+
+import numpy as np
+
+from edges import reduce_edge_points as _reduce_edge_points_numpy
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    # Without numba the kernels below stay plain Python (only used by the self check)
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+USE_NUMBA = HAVE_NUMBA
+
+
+# ======================= #
+#   EDGE POINT REDUCTION  #
+# ======================= #
+
+@njit(cache=True, nogil=True)
+def _reduce_columns_numba(edges, step, lo, hi):
+    rows, cols = edges.shape
+    sums = np.zeros(cols, np.int64)
+    counts = np.zeros(cols, np.int64)
+    # Scan row by row to read the image in memory order
+    for row in range(rows):
+        for col in range(0, cols, step):
+            if edges[row, col] > 0:
+                sums[col] += row
+                counts[col] += 1
+    out = np.empty((cols // step + 1, 2), np.int64)
+    k = 0
+    for col in range(0, cols, step):
+        if col > lo and col < hi and counts[col] > 0:
+            out[k, 0] = col
+            out[k, 1] = sums[col] // counts[col]
+            k += 1
+    return out[:k]
+
+
+@njit(cache=True, nogil=True)
+def _reduce_rows_numba(edges, step, lo, hi):
+    rows, cols = edges.shape
+    out = np.empty((rows // step + 1, 2), np.int64)
+    k = 0
+    for row in range(0, rows, step):
+        if row > lo and row < hi:
+            s = 0
+            c = 0
+            for col in range(cols):
+                if edges[row, col] > 0:
+                    s += col
+                    c += 1
+            if c > 0:
+                out[k, 0] = s // c
+                out[k, 1] = row
+                k += 1
+    return out[:k]
+
+
+def reduce_edge_points(edges, step=2, lo=None, hi=None, axis=0):
+    """One point per column (axis=0) or per row (axis=1), see edges.reduce_edge_points"""
+    if not USE_NUMBA:
+        return _reduce_edge_points_numpy(edges, step, lo, hi, axis)
+    lo = -np.inf if lo is None else float(lo)
+    hi = np.inf if hi is None else float(hi)
+    edges = np.ascontiguousarray(edges)
+    if axis == 1:
+        return _reduce_rows_numba(edges, step, lo, hi)
+    return _reduce_columns_numba(edges, step, lo, hi)
+
+
+# ============================= #
+#   CIRCLE RESIDUAL / JACOBIAN  #
+# ============================= #
+
+def _circle_residuals_numpy(params, x, y):
+    x_c, y_c, r = params
+    return np.sqrt((x - x_c) ** 2 + (y - y_c) ** 2) - r
+
+
+def _circle_jacobian_numpy(params, x, y):
+    x_c, y_c, _ = params
+    d = np.sqrt((x - x_c) ** 2 + (y - y_c) ** 2)
+    d = np.where(d > 0, d, 1.0)
+    return np.column_stack((-(x - x_c) / d, -(y - y_c) / d, -np.ones_like(d)))
+
+
+@njit(cache=True, nogil=True)
+def _circle_residuals_numba(params, x, y):
+    x_c, y_c, r = params[0], params[1], params[2]
+    out = np.empty(len(x))
+    for i in range(len(x)):
+        out[i] = np.sqrt((x[i] - x_c) ** 2 + (y[i] - y_c) ** 2) - r
+    return out
+
+
+@njit(cache=True, nogil=True)
+def _circle_jacobian_numba(params, x, y):
+    x_c, y_c = params[0], params[1]
+    out = np.empty((len(x), 3))
+    for i in range(len(x)):
+        d = np.sqrt((x[i] - x_c) ** 2 + (y[i] - y_c) ** 2)
+        if d <= 0:
+            d = 1.0
+        out[i, 0] = -(x[i] - x_c) / d
+        out[i, 1] = -(y[i] - y_c) / d
+        out[i, 2] = -1.0
+    return out
+
+
+def _as_float_args(params, x, y):
+    return (np.asarray(params, dtype=np.float64), np.asarray(x, dtype=np.float64),
+            np.asarray(y, dtype=np.float64))
+
+
+def circle_residuals(params, x, y):
+    """Distance of every point from the circle params = (x_c, y_c, r), for least_squares"""
+    params, x, y = _as_float_args(params, x, y)
+    if USE_NUMBA:
+        return _circle_residuals_numba(params, x, y)
+    return _circle_residuals_numpy(params, x, y)
+
+
+def circle_jacobian(params, x, y):
+    """(N, 3) Jacobian of circle_residuals with respect to (x_c, y_c, r)"""
+    params, x, y = _as_float_args(params, x, y)
+    if USE_NUMBA:
+        return _circle_jacobian_numba(params, x, y)
+    return _circle_jacobian_numpy(params, x, y)
+
+
+def error_fct(params, x, y):
+    """Same cost as error_fct in the experiment utils.py (sum of squared residuals)"""
+    res = circle_residuals(params, x, y)
+    return np.dot(res, res)
+
+
+def error_fct_grad(params, x, y):
+    """
+    Gradient of error_fct, to pass as jac= to optimize.minimize so that it doesn't estimate it
+    with finite differences (3 extra cost evaluations per iteration):
+        optimize.minimize(error_fct, guess, args=(x, y), jac=error_fct_grad)
+    """
+    return 2 * circle_residuals(params, x, y) @ circle_jacobian(params, x, y)
+
+
+# ==================== #
+#   MASK CENTROIDS     #
+# ==================== #
+
+def _mask_centroid_numpy(mask):
+    ys, xs = np.nonzero(mask)
+    if len(xs) == 0:
+        return np.nan, np.nan
+    return xs.sum() / len(xs), ys.sum() / len(ys)
+
+
+@njit(cache=True, nogil=True)
+def _mask_centroid_numba(mask):
+    rows, cols = mask.shape
+    sx = 0
+    sy = 0
+    n = 0
+    for row in range(rows):
+        for col in range(cols):
+            if mask[row, col] != 0:
+                sx += col
+                sy += row
+                n += 1
+    if n == 0:
+        return np.nan, np.nan
+    return sx / n, sy / n
+
+
+def mask_centroid(mask):
+    """
+    Average coordinates of the non zero pixels of a 2D mask (as get_blue_base_avg /
+    get_red_tip_avg, but without building the index arrays). Returns (nan, nan) if empty.
+    """
+    if USE_NUMBA:
+        return _mask_centroid_numba(np.ascontiguousarray(mask))
+    return _mask_centroid_numpy(mask)
+
+
+# ================ #
+#   ARC LENGTH     #
+# ================ #
+
+def _arc_length_numpy(x_c, y_c, radius, x_base, y_base, x_tip, y_tip):
+    theta_base = np.arctan2(y_base - y_c, x_base - x_c)
+    theta_tip = np.arctan2(y_tip - y_c, x_tip - x_c)
+    dtheta = np.abs(theta_tip - theta_base)
+    dtheta = np.minimum(dtheta, 2 * np.pi - dtheta)  # Ensure the angle is at most pi
+    return radius * dtheta
+
+
+@njit(cache=True, nogil=True)
+def _arc_length_numba(x_c, y_c, radius, x_base, y_base, x_tip, y_tip):
+    out = np.empty(len(x_c))
+    for i in range(len(x_c)):
+        theta_base = np.arctan2(y_base[i] - y_c[i], x_base[i] - x_c[i])
+        theta_tip = np.arctan2(y_tip[i] - y_c[i], x_tip[i] - x_c[i])
+        dtheta = np.abs(theta_tip - theta_base)
+        dtheta = min(dtheta, 2 * np.pi - dtheta)
+        out[i] = radius[i] * dtheta
+    return out
+
+
+def arc_length(x_c, y_c, radius, x_base, y_base, x_tip, y_tip):
+    """
+    compute_arc_length of the experiment utils.py for scalars or for arrays of frames.
+    """
+    args = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64) for a in
+                                 (x_c, y_c, radius, x_base, y_base, x_tip, y_tip)])
+    shape = args[0].shape
+    if USE_NUMBA:
+        out = _arc_length_numba(*[np.ascontiguousarray(a).ravel() for a in args]).reshape(shape)
+    else:
+        out = _arc_length_numpy(*args)
+    return out[()] if out.ndim == 0 else out
+
+
+# ==================== #
+#   CONTOUR POINTS     #
+# ==================== #
+
+def contour_points(contours):
+    """
+    All the points of the contours returned by cv2.findContours as a single (N, 2) array,
+    replacing the nested "for contour in contours: for point in contour:" loop.
+    """
+    if len(contours) == 0:
+        return np.empty((0, 2), dtype=np.int32)
+    return np.concatenate(contours).reshape(-1, 2)
+
+
+if __name__ == "__main__":
+    import time
+
+    print(f"numba available: {HAVE_NUMBA}")
+    rng = np.random.default_rng(0)
+    edges = ((rng.random((480, 640)) > 0.97) * 255).astype(np.uint8)
+    x = rng.uniform(0, 640, 500)
+    y = rng.uniform(0, 480, 500)
+    params = np.array([320.0, 900.0, 700.0])
+    frames = [rng.uniform(0, 640, 1000) for _ in range(7)]
+
+    def run_all():
+        return (
+            reduce_edge_points(edges, 2, 35, 600),
+            reduce_edge_points(edges, 1, axis=1),
+            reduce_edge_points(edges, 3, hi=100, axis=1),
+            circle_residuals(params, x, y),
+            circle_jacobian(params, x, y),
+            error_fct(params, x, y),
+            error_fct_grad(params, x, y),
+            mask_centroid(edges),
+            mask_centroid(np.zeros((10, 10), np.uint8)),
+            arc_length(*frames),
+            arc_length(1.0, 2.0, 30.0, 10.0, 5.0, 40.0, 50.0),
+        )
+
+    USE_NUMBA = False
+    start = time.perf_counter()
+    reference = run_all()
+    print(f"NumPy: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    USE_NUMBA = True
+    run_all()  # compile (or plain Python without numba)
+    start = time.perf_counter()
+    compiled = run_all()
+    print(f"{'Numba' if HAVE_NUMBA else 'Python'}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    for ref, out in zip(reference, compiled):
+        assert np.shape(ref) == np.shape(out)
+        if np.asarray(ref).dtype.kind in "iu":
+            assert np.array_equal(ref, out)
+        else:
+            assert np.allclose(ref, out, rtol=1e-12, atol=1e-9, equal_nan=True)
+
+    # Reference loop of the trackers
+    reduced_points = []
+    for col in range(0, edges.shape[1], 2):
+        if col > 35 and col < 600:
+            row_indices = np.where(edges[:, col] > 0)[0]
+            if len(row_indices) > 0:
+                reduced_points.append([col, int(np.mean(row_indices))])
+    assert np.array_equal(np.array(reduced_points), reference[0])
+
+    # Gradient against finite differences
+    eps = 1e-6
+    numerical = [(error_fct(params + eps * e, x, y) - error_fct(params - eps * e, x, y)) / (2 * eps)
+                 for e in np.eye(3)]
+    assert np.allclose(numerical, reference[6], rtol=1e-5)
+
+    contours = [rng.integers(0, 100, (5, 1, 2)).astype(np.int32) for _ in range(3)]
+    loop_points = [list(point[0]) for contour in contours for point in contour]
+    assert np.array_equal(np.array(loop_points), contour_points(contours))
+
+    print("Success!")
@@ -0,0 +1,167 @@
+"""
+Tip orientation of the catheter.
+
+The orientation is the direction of the tangent to the catheter at the tip, in image coordinates
+(radians, x to the right, y down, as used by cv2 drawing functions). It is computed either from
+the fitted circle or from an ordered centerline, with arctan2 so that vertical radii and tangents
+are handled, and vectorised so that whole recordings can be processed at once.
+
+Angles wrap around, so they are smoothed by averaging unit vectors (circular mean) instead of
+averaging slopes or angles directly.
+"""
+
+from collections import deque
+
+import numpy as np
+
+
+def wrap_angle(angle):
+    """Wraps angles to [-pi, pi)"""
+    return (np.asarray(angle) + np.pi) % (2 * np.pi) - np.pi
+
+
+def angle_difference(a, b):
+    """Signed smallest difference a - b, in [-pi, pi)"""
+    return wrap_angle(np.asarray(a) - np.asarray(b))
+
+
+def tip_tangent_angle(x_c, y_c, x_tip, y_tip, x_base=None, y_base=None):
+    """
+    Direction of the tangent to the fitted circle at the tip, for scalars or arrays of frames.
+    Inputs:
+        x_c, y_c: centre of the fitted circle
+        x_tip, y_tip: tip position
+        x_base, y_base: base position, used to orient the tangent from base to tip. Without it
+                        the tangent pointing up in the image is returned (old arrow convention)
+    Returns:
+        tangent angle in image coordinates [rad] (nan where the inputs are nan)
+    """
+    x_c, y_c, x_tip, y_tip = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64) for a in (x_c, y_c, x_tip, y_tip)])
+    radial = np.arctan2(y_tip - y_c, x_tip - x_c)
+
+    if x_base is not None and y_base is not None:
+        # The sign of the cross product (base - c) x (tip - c) gives the direction of travel
+        cross = (np.asarray(x_base) - x_c) * (y_tip - y_c) - (np.asarray(y_base) - y_c) * (x_tip - x_c)
+        direction = np.where(cross >= 0, 1.0, -1.0)
+    else:
+        # Choose the tangent with a negative y component (pointing up in the image)
+        direction = np.where(np.cos(radial) >= 0, -1.0, 1.0)
+
+    angle = wrap_angle(radial + direction * np.pi / 2)
+    return angle[()] if angle.ndim == 0 else angle
+
+
+def centerline_tip_angles(points, offsets, window=5):
+    """
+    Tip direction of many centerlines at once, from the last `window` points of each one.
+    Inputs:
+        points: (N, 2) concatenated centerline points, each centerline ordered from base to tip
+        offsets: (F + 1,) segment boundaries, centerline i is points[offsets[i]:offsets[i+1]]
+        window: number of points at the tip used for the direction
+    Returns:
+        (F,) angles in image coordinates [rad], nan for centerlines with fewer than 2 points
+    """
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    angles = np.full(len(counts), np.nan)
+    valid = counts >= 2
+    if not valid.any():
+        return angles
+
+    end = offsets[1:][valid] - 1
+    start = offsets[1:][valid] - np.minimum(counts[valid], window)
+    delta = points[end] - points[start]
+    angles[valid] = np.arctan2(delta[:, 1], delta[:, 0])
+    return angles
+
+
+def circular_moving_average(angles, window=5):
+    """
+    Trailing moving average of angles over `window` frames, computed on unit vectors so that
+    there's no jump at +-pi. nan values are ignored (nan if the whole window is nan).
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    valid = ~np.isnan(angles)
+    c = np.where(valid, np.cos(angles), 0.0)
+    s = np.where(valid, np.sin(angles), 0.0)
+
+    def trailing_sum(values):
+        cumsum = np.concatenate(([0.0], np.cumsum(values)))
+        start = np.maximum(np.arange(1, len(values) + 1) - window, 0)
+        return cumsum[1:] - cumsum[start]
+
+    n = trailing_sum(valid.astype(np.float64))
+    smoothed = np.arctan2(trailing_sum(s), trailing_sum(c))
+    return np.where(n > 0, smoothed, np.nan)
+
+
+class CircularSmoother:
+    """
+    Streaming version of circular_moving_average, for the per-frame loop of the trackers:
+        tip_angle_filter = CircularSmoother(5)
+        tip_angle_filtered = tip_angle_filter.update(tip_angle)
+    """
+
+    def __init__(self, window=5):
+        self.history = deque(maxlen=window)
+
+    def update(self, angle):
+        # nan frames still take a slot of the window, as in circular_moving_average
+        if np.isnan(angle):
+            self.history.append((0.0, 0.0, 0))
+        else:
+            self.history.append((np.cos(angle), np.sin(angle), 1))
+        c, s, n = np.sum(self.history, axis=0)
+        return float(np.arctan2(s, c)) if n > 0 else np.nan
+
+
+def to_model_orientation(image_angle, base_angle=0.0):
+    """
+    Converts a tip angle in image coordinates to the orientation returned by
+    kin_model.tip_cartesian (angle from the base direction, counter clockwise, y axis up).
+    Inputs:
+        image_angle: tip angle in image coordinates [rad]
+        base_angle: direction of the catheter at the base in image coordinates [rad]
+                    (0 when the catheter leaves the base towards the right of the image)
+    """
+    return wrap_angle(-(np.asarray(image_angle) - base_angle))
+
+
+if __name__ == "__main__":
+    # Tangent at the top of a circle, travelling clockwise on screen (left to right)
+    assert np.isclose(tip_tangent_angle(0, 0, 0, -10, -10, 0), 0.0)
+    # Vertical radius without base: the old slope formula divided by zero here
+    assert np.isclose(abs(tip_tangent_angle(0, 0, 0, -10)), np.pi)
+    assert np.isclose(tip_tangent_angle(0, 0, 10, 0), -np.pi / 2)
+
+    # Vectorised: tip moving along a circle of centre (0, 100), base at (0, 0)
+    phi = np.linspace(-np.pi / 2, 0, 50)
+    x_tip, y_tip = 100 * np.cos(phi), 100 + 100 * np.sin(phi)
+    angles = tip_tangent_angle(0.0, 100.0, x_tip, y_tip, 0.0, 0.0)
+    assert np.allclose(angles, wrap_angle(phi + np.pi / 2))
+
+    # Centerlines of the same arcs agree with the circle tangent for small windows
+    point_sets = []
+    for p in phi[1:]:
+        t = np.linspace(-np.pi / 2, p, 200)
+        point_sets.append(np.column_stack((100 * np.cos(t), 100 + 100 * np.sin(t))))
+    offsets = np.concatenate(([0], np.cumsum([len(p) for p in point_sets])))
+    centerline = centerline_tip_angles(np.concatenate(point_sets), offsets, window=2)
+    assert np.allclose(centerline, angles[1:], atol=0.01)
+
+    # Circular smoothing doesn't jump at +-pi
+    noisy = np.array([np.pi - 0.01, -np.pi + 0.01, np.nan, np.pi - 0.02, -np.pi + 0.02])
+    smoothed = circular_moving_average(noisy, window=3)
+    assert np.all(np.abs(angle_difference(smoothed, np.pi)) < 0.03)
+    smoother = CircularSmoother(3)
+    assert np.allclose(angle_difference([smoother.update(a) for a in noisy], smoothed), 0)
+    angles = np.random.default_rng(0).uniform(-np.pi, np.pi, 100)
+    angles[::7] = np.nan
+    smoother = CircularSmoother(4)
+    streamed = np.array([smoother.update(a) for a in angles])
+    batched = circular_moving_average(angles, 4)
+    assert np.array_equal(np.isnan(streamed), np.isnan(batched))
+    assert np.allclose(angle_difference(streamed, batched)[~np.isnan(batched)], 0)
+
+    print("Success!")
@@ -0,0 +1,230 @@
+"""
+Deferred debug drawing for the catheter trackers.
+
+The trackers used to draw on the frame while measuring (one cv2.circle per reduced point, labels,
+fitted circle, GRAY2BGR conversion of the edges, tip arrow) on every frame, and the drawings even
+ended up in the image used for edge detection. Here the measurement of a frame is stored in a
+Measurement record and the OverlayRenderer draws it only when needed:
+    - every N-th frame (every=N), or never (every=0, e.g. when only the CSV is needed)
+    - in a background thread (background=True); if the thread falls behind, frames are dropped
+      from the overlay instead of slowing down the measurement
+    - after the run, from the recorded measurements (render_recorded), when a saved video must keep
+      every frame aligned with the measurements
+Point sets are drawn with a single cv2.polylines call.
+"""
+
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+TEXT_COLOR = (204, 229, 255)
+POINTS_COLOR = (204, 255, 204)
+MARKER_COLOR = (0, 255, 0)
+CIRCLE_COLOR = (255, 204, 204)
+TIP_COLOR = (206, 0, 88)
+
+
+class Measurement:
+    """
+    Everything measured on one frame.
+    Inputs:
+        frame_index: index of the frame in the video / image list
+        tip, base: (x, y) of the tip and base markers (may contain nan)
+        points: (N, 2) reduced edge points used for the fit, or a list of point sets
+        circle: (x_c, y_c, radius) of the fitted circle
+        markers: other (x, y) points to highlight (e.g. spring markers)
+        labels: {name: text} printed on the frame, in order
+        tip_angle: tip orientation in image coordinates [rad], drawn as an arrow on the edges
+    """
+
+    def __init__(self, frame_index, tip=None, base=None, points=None, circle=None, markers=(),
+                 labels=None, tip_angle=None):
+        self.frame_index = frame_index
+        self.tip = tip
+        self.base = base
+        self.points = points
+        self.circle = circle
+        self.markers = list(markers)
+        self.labels = labels or {}
+        self.tip_angle = tip_angle
+
+
+def _valid(point):
+    return point is not None and not np.any(np.isnan(point))
+
+
+def draw_points(image, points, color=POINTS_COLOR, thickness=2):
+    """
+    Draws a point set as one open polyline, or a list of point sets (e.g. contours) as several
+    polylines, with a single OpenCV call.
+    """
+    if points is None or len(points) == 0:
+        return image
+    if isinstance(points, (list, tuple)):
+        polylines = [np.asarray(p, dtype=np.int32).reshape(-1, 1, 2) for p in points]
+    else:
+        polylines = [np.asarray(points, dtype=np.int32).reshape(-1, 1, 2)]
+    cv2.polylines(image, polylines, False, color, thickness)
+    return image
+
+
+def draw_measurement(frame, measurement, radius_limit=600):
+    """Draws markers, reduced points, fitted circle and labels of a measurement on the frame"""
+    for point in [measurement.tip, measurement.base] + measurement.markers:
+        if _valid(point):
+            cv2.circle(frame, (int(point[0]), int(point[1])), 10, MARKER_COLOR, 5)
+
+    draw_points(frame, measurement.points)
+
+    if measurement.circle is not None and _valid(measurement.circle):
+        x_c, y_c, radius = measurement.circle
+        # Check radius thresold
+        if radius < radius_limit:
+            cv2.circle(frame, (int(x_c), int(y_c)), int(radius), CIRCLE_COLOR, 2)
+
+    for i, (name, text) in enumerate(measurement.labels.items()):
+        cv2.putText(frame, f"{name}: {text}", (10, 50 + 40 * i), FONT, 0.5, TEXT_COLOR, 1, cv2.LINE_AA)
+
+    return frame
+
+
+def draw_edges(edges, measurement, arrow_length=50):
+    """Converts the edges to BGR and draws the tip with its orientation arrow"""
+    edges = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
+    if _valid(measurement.tip):
+        x_tip, y_tip = measurement.tip
+        cv2.circle(edges, (int(x_tip), int(y_tip)), 1, TIP_COLOR, 5)
+        if measurement.tip_angle is not None and not np.isnan(measurement.tip_angle):
+            x2 = x_tip + arrow_length * np.cos(measurement.tip_angle)
+            y2 = y_tip + arrow_length * np.sin(measurement.tip_angle)
+            cv2.arrowedLine(edges, (int(x_tip), int(y_tip)), (int(x2), int(y2)), TIP_COLOR, 2, tipLength=0.2)
+    return edges
+
+
+class OverlayRenderer:
+    """
+    Draws measurements on demand, outside of the measurement loop.
+    Inputs:
+        sink: callable(frame_index, frame_overlay, edges_overlay) receiving the drawn images
+              (e.g. writes them to cv2.VideoWriter), edges_overlay is None if no edges were given
+        every: draw one frame every `every` frames, 0 disables drawing
+        background: draw in a worker thread instead of the caller's thread
+        max_pending: frames waiting for the worker before new ones are dropped
+        drop_when_busy: if False, wait for the worker instead of dropping frames (this blocks the
+                        measurement loop, prefer render_recorded to save every frame)
+        radius_limit: fitted circles larger than this are not drawn
+    """
+
+    def __init__(self, sink=None, every=1, background=False, max_pending=8, drop_when_busy=True,
+                 radius_limit=600):
+        self.sink = sink
+        self.every = every
+        self.drop_when_busy = drop_when_busy
+        self.radius_limit = radius_limit
+        self.dropped = 0
+        self.last_rendered = None  # (frame_index, frame_overlay, edges_overlay)
+        self._queue = None
+        self._worker = None
+        if background:
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def wants(self, frame_index):
+        """Whether the frame will be drawn (lets the caller skip copying it)"""
+        return self.every > 0 and frame_index % self.every == 0
+
+    def submit(self, frame, measurement, edges=None):
+        """
+        Queues a frame for drawing. The frame and edges are drawn on in place, so pass copies if
+        they are used afterwards. Never blocks unless drop_when_busy is False.
+        """
+        if not self.wants(measurement.frame_index):
+            return
+        if self._queue is None:
+            self._render(frame, measurement, edges)
+            return
+        try:
+            self._queue.put((frame, measurement, edges), block=not self.drop_when_busy)
+        except queue.Full:
+            self.dropped += 1
+
+    def _render(self, frame, measurement, edges):
+        frame = draw_measurement(frame, measurement, self.radius_limit)
+        edges = draw_edges(edges, measurement) if edges is not None else None
+        self.last_rendered = (measurement.frame_index, frame, edges)
+        if self.sink is not None:
+            self.sink(measurement.frame_index, frame, edges)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            self._render(*item)
+            self._queue.task_done()
+
+    def close(self):
+        """Waits for the pending frames to be drawn and stops the worker"""
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+
+class ImageSequence:
+    """
+    Reads a list of image files as a cv2.VideoCapture reads a video (read() -> (ret, frame)), for
+    render_recorded on the trackers that measure a folder of frames
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._next = 0
+
+    def read(self):
+        if self._next >= len(self.paths):
+            return False, None
+        frame = cv2.imread(self.paths[self._next])
+        self._next += 1
+        return frame is not None, frame
+
+    def release(self):
+        pass
+
+
+def render_recorded(capture, measurements, renderer, edges_fn=None, skip=0):
+    """
+    Draws recorded measurements on the frames of a video, after the measurement loop, so that the
+    saved overlay keeps every frame without slowing down the measurement.
+    Inputs:
+        capture: cv2.VideoCapture of the measured video (or ImageSequence of the measured images),
+                 from its first frame
+        measurements: Measurement records of the run (frame_index counted from the first measured frame)
+        renderer: OverlayRenderer (foreground) with the sink writing the videos
+        edges_fn: callable(frame) -> edges to draw the edges overlay (None for no edges overlay)
+        skip: frames of the video read before the first measured frame
+    Returns:
+        number of frames drawn
+    """
+    by_index = {m.frame_index: m for m in measurements}
+    last = max(by_index, default=-1)
+    for _ in range(skip):
+        capture.read()
+    drawn = 0
+    frame_index = 0
+    while frame_index <= last:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        measurement = by_index.get(frame_index)
+        if measurement is not None and renderer.wants(frame_index):
+            renderer.submit(frame, measurement, edges_fn(frame) if edges_fn is not None else None)
+            drawn += 1
+        frame_index += 1
+    renderer.close()
+    return drawn
@@ -0,0 +1,224 @@
+"""
+Parameter sweep for the background HSV range, median blur and Canny thresholds of the trackers.
+
+Instead of tuning the thresholds by hand with color_detection_test.py / edge_detection_test.py and
+copying them into the "if experiment_name == ..." blocks, a grid (or random) search is run over a
+few frames sampled from the experiment:
+    - every sampled frame is converted to HSV only once
+    - settings sharing the same HSV range share the background mask, so only blur and Canny are
+      recomputed
+    - settings are evaluated in parallel (OpenCV, NumPy and the nogil Numba kernels release the GIL,
+      threads are enough)
+Each setting is scored by the RMS residual of the circle fitted to the reduced edge points and by
+the temporal stability of the fitted radius across consecutive sampled frames (lower is better).
+
+Usage:
+    python threshold_sweep.py data/force_large_bending/crop --samples 30
+    python threshold_sweep.py data/video/diagonal_force.mp4 --random 200 --workers 8
+"""
+
+import argparse
+import glob
+import itertools
+import os
+import random
+
+import cv2
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from circle_fit import fit_circles_batched, pack_points, rms_residuals_batched
+from edges import edges_from_mask
+from kernels import reduce_edge_points
+
+# Search space around the values used in the experiment folders
+DEFAULT_SPACE = {
+    "lower_hsv": [(30, 40, 40), (40, 40, 40), (40, 60, 60)],
+    "upper_hsv": [(80, 255, 255), (90, 255, 255)],
+    "blur": [3, 5, 7],
+    "canny": [(50, 150), (100, 200)],
+}
+
+
+def load_sample_frames(source, num_samples=30):
+    """
+    Loads num_samples frames evenly spaced in time from a folder of images or from a video.
+    Returns:
+        list of BGR frames, in temporal order
+    """
+    if os.path.isdir(source):
+        image_files = sorted(glob.glob(os.path.join(source, "*")))
+        step = max(1, len(image_files) // num_samples)
+        frames = [cv2.imread(image_file) for image_file in image_files[::step][:num_samples]]
+        return [frame for frame in frames if frame is not None]
+
+    cap = cv2.VideoCapture(source)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    step = max(1, frame_count // num_samples)
+    frames = []
+    index = 0
+    # Read sequentially, seeking is not frame accurate for most codecs
+    while cap.isOpened() and len(frames) < num_samples:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if index % step == 0:
+            frames.append(frame)
+        index += 1
+    cap.release()
+    return frames
+
+
+def grid_configs(space=DEFAULT_SPACE):
+    """All combinations of the search space"""
+    configs = []
+    for lower, upper, blur, (canny_low, canny_high) in itertools.product(
+        space["lower_hsv"], space["upper_hsv"], space["blur"], space["canny"]
+    ):
+        configs.append({
+            "lower_hsv": tuple(lower),
+            "upper_hsv": tuple(upper),
+            "blur": blur,
+            "canny_low": canny_low,
+            "canny_high": canny_high,
+        })
+    return configs
+
+
+def random_configs(num_configs, space=DEFAULT_SPACE, seed=0):
+    """num_configs settings drawn uniformly between the extremes of the search space"""
+    rng = random.Random(seed)
+    lower = np.array(space["lower_hsv"])
+    upper = np.array(space["upper_hsv"])
+    blurs = list(range(min(space["blur"]), max(space["blur"]) + 1, 2))
+    canny = np.array(space["canny"])
+    configs = []
+    for _ in range(num_configs):
+        canny_low = rng.randint(canny[:, 0].min(), canny[:, 0].max())
+        configs.append({
+            # Keep the hue coarse so that settings can share background masks
+            "lower_hsv": tuple(rng.randint(lo, hi) // 5 * 5 for lo, hi in zip(lower.min(0), lower.max(0))),
+            "upper_hsv": tuple(rng.randint(lo, hi) // 5 * 5 for lo, hi in zip(upper.min(0), upper.max(0))),
+            "blur": rng.choice(blurs),
+            "canny_low": canny_low,
+            "canny_high": max(canny_low + 1, rng.randint(canny[:, 1].min(), canny[:, 1].max())),
+        })
+    return configs
+
+
+class SweepEngine:
+    """
+    Evaluates segmentation settings over a fixed set of sampled frames.
+    Inputs:
+        frames: BGR frames in temporal order
+        step, lo, hi, axis: arguments of reduce_edge_points() (same meaning as in the trackers)
+        min_points: frames with fewer reduced points count as failed
+        stability_weight: weight of the radius jitter (px) with respect to the fit residual (px)
+        failure_penalty: score added for a setting failing on every frame
+        workers: number of threads
+    """
+
+    def __init__(self, frames, step=2, lo=None, hi=None, axis=0, min_points=10,
+                 stability_weight=0.5, failure_penalty=100.0, workers=None):
+        self.hsv_frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2HSV) for frame in frames]
+        self.step = step
+        self.lo = lo
+        self.hi = hi
+        self.axis = axis
+        self.min_points = min_points
+        self.stability_weight = stability_weight
+        self.failure_penalty = failure_penalty
+        self.workers = workers or os.cpu_count()
+
+    def _background_masks(self, lower, upper, pool):
+        lower, upper = np.array(lower), np.array(upper)
+        return list(pool.map(lambda hsv: cv2.inRange(hsv, lower, upper), self.hsv_frames))
+
+    def _score(self, config, masks):
+        point_sets = []
+        for mask in masks:
+            edges = edges_from_mask(mask, config["blur"], config["canny_low"], config["canny_high"])
+            points = reduce_edge_points(edges, self.step, self.lo, self.hi, self.axis)
+            point_sets.append(points if len(points) >= self.min_points else points[:0])
+
+        # Fit all the sampled frames of this setting in one call
+        points, offsets = pack_points(point_sets)
+        x_c, y_c, radii = fit_circles_batched(points, offsets)
+        residuals = rms_residuals_batched(points, offsets, x_c, y_c, radii)
+
+        failed = np.mean(np.isnan(radii))
+        if failed == 1:
+            return dict(config, score=np.inf, residual=np.nan, stability=np.nan, failed=failed)
+
+        residual = float(np.nanmean(residuals))
+        jumps = np.abs(np.diff(radii))
+        jumps = jumps[~np.isnan(jumps)]
+        stability = float(np.median(jumps)) if len(jumps) > 0 else 0.0
+        score = residual + self.stability_weight * stability + self.failure_penalty * failed
+        return dict(config, score=score, residual=residual, stability=stability, failed=failed)
+
+    def evaluate(self, configs):
+        """
+        Scores every setting.
+        Returns:
+            list of result dicts (setting + score, residual, stability, failed), best first
+        """
+        # Group settings by HSV range so that each background mask is computed once per frame
+        groups = {}
+        for config in configs:
+            groups.setdefault((tuple(config["lower_hsv"]), tuple(config["upper_hsv"])), []).append(config)
+
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for (lower, upper), group in groups.items():
+                masks = self._background_masks(lower, upper, pool)
+                results += pool.map(lambda config: self._score(config, masks), group)
+                # masks go out of scope here, memory stays bounded by one group
+
+        results.sort(key=lambda result: result["score"])
+        return results
+
+
+def best_config(results):
+    """Extracts the edge_map() keyword arguments of the best result (ValueError if no setting produced a fit)"""
+    best = results[0]
+    if not np.isfinite(best["score"]):
+        raise ValueError("no setting produced a circle fit on any of the sampled frames")
+    return {
+        "lower_hsv": np.array(best["lower_hsv"]),
+        "upper_hsv": np.array(best["upper_hsv"]),
+        "blur": best["blur"],
+        "canny_low": best["canny_low"],
+        "canny_high": best["canny_high"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HSV / blur / Canny parameter sweep")
+    parser.add_argument("source", help="folder of frames or video file")
+    parser.add_argument("--samples", type=int, default=30, help="number of frames to sample")
+    parser.add_argument("--random", type=int, default=0, help="number of random settings (0 = full grid)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--axis", type=int, default=0, help="0 = one point per column, 1 = one point per row")
+    args = parser.parse_args()
+
+    frames = load_sample_frames(args.source, args.samples)
+    print(f"Loaded {len(frames)} frames from {args.source}")
+
+    configs = random_configs(args.random) if args.random > 0 else grid_configs()
+    engine = SweepEngine(frames, axis=args.axis, workers=args.workers)
+    results = engine.evaluate(configs)
+
+    for result in results[:5]:
+        print("score {score:.2f} | residual {residual:.2f} px | stability {stability:.2f} px | failed {failed:.0%} | "
+              "lower {lower_hsv} upper {upper_hsv} blur {blur} canny ({canny_low}, {canny_high})".format(**result))
+
+    if not np.isfinite(results[0]["score"]):
+        raise SystemExit("\nNo setting produced a fit on the sampled frames: check the source, or widen the HSV "
+                         "ranges / lower the Canny thresholds of the sweep")
+    best = best_config(results)
+    print("\nBest setting:")
+    print(f"lower_green = np.array({best['lower_hsv'].tolist()})")
+    print(f"upper_green = np.array({best['upper_hsv'].tolist()})")
+    print(f"blur = {best['blur']}")
+    print(f"canny = ({best['canny_low']}, {best['canny_high']})")
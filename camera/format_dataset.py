@@ -1,9 +1,10 @@
 import hashlib
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import shutil
 import cv2
+from PIL import Image
 from ultralytics.data.utils import compress_one_image
 from ultralytics.utils.downloads import zip_directory
 
@@ -57,7 +58,69 @@ def load_labels_mapping(labels_json_path):
     return {label['id']: {'yolo_id': label.get('yolo_id', -1)} for label in labels}
 
 
-def process_subset(source_dir, dest_dir, labels_mapping_path, subset_size=None):
+def file_hash(path):
+    # Content hash of a file, read in chunks
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def image_size(path):
+    # Width and height read from the image header (the pixels are not decoded)
+    with Image.open(path) as image:
+        return image.size
+
+def load_manifest(manifest_path):
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(manifest_path, manifest):
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def process_image(src_path, dst_path, previous_hash):
+    # Compress the source image into the dataset, unless it was already done for the same content
+    src_hash = file_hash(src_path)
+    copied = False
+    if src_hash != previous_hash or not dst_path.exists():
+        compress_one_image(src_path, dst_path)
+        copied = True
+    width, height = image_size(dst_path)
+    return src_hash, width, height, copied
+
+def remove_outputs(dest_dir, image_id, image=True):
+    # Deletes the label file and visualization of an image (and the image itself), in any split
+    paths = [Path(dest_dir) / 'visualization' / f"{image_id}.png"]
+    for split in ['train', 'val']:
+        paths.append(Path(dest_dir) / 'labels' / split / f"{image_id}.txt")
+        if image:
+            paths.append(Path(dest_dir) / 'images' / split / f"{image_id}.png")
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+def visualize_annotations(img_path, bboxes, polygons, visualization_path):
+    # Draws all the bounding boxes and polygons of one image
+    image = cv2.imread(str(img_path))
+    for bbox, polygon_points in zip(bboxes, polygons):
+        draw_bbox(image, bbox)
+        # Visualize the polygon
+        for point in polygon_points:
+            draw_circle(image, point)
+    cv2.imwrite(str(visualization_path), image)
+
+def process_subset(source_dir, dest_dir, labels_mapping_path, subset_size=None, workers=None, visualize_fraction=0.0):
+    """
+    Converts the bronchoscopy dataset into the YOLO format.
+    Images are compressed into the dataset in a process pool, only if new or changed since the last run (content
+    hashes of the sources are kept in dest_dir/manifest.json). Image sizes are read from the image headers.
+    Images that fail (e.g. corrupt files) are reported and skipped, they are processed again at the next run.
+    Images without boxes get no label file (the one of a previous run is deleted), and on a full run
+    (subset_size None) the outputs of the images no longer in the source are deleted.
+    visualize_fraction: fraction of the annotations drawn in dest_dir/visualization (sampled by image id)
+    """
     labels_mapping = load_labels_mapping(labels_mapping_path)
     
     # Setup directories
@@ -70,102 +133,154 @@ def process_subset(source_dir, dest_dir, labels_mapping_path, subset_size=None):
     for directory in directories:
         directory.mkdir(parents=True, exist_ok=True)
 
+    manifest_path = Path(dest_dir) / 'manifest.json'
+    manifest = load_manifest(manifest_path)
+
     # Counter for number of images in train and val
     train_count = 0
     val_count = 0
+    copied_count = 0
+    failed_count = 0
+    seen_ids = set()
     
-    # Process each category directory
-    for category in ['Lung_cancer/Lung_cancer', 'Non_lung_cancer/Non_lung_cancer']:
-
-        imgs_path = Path(source_dir) / category / 'imgs'
-        objects_file = Path(source_dir) / category / 'objects.json'
-        annotation_file = Path(source_dir) / category / 'annotation.json'
-        
-        with open(objects_file) as f:
-            objects = json.load(f)
-        with open(annotation_file) as f:
-            annotations = json.load(f)
-
-        print(f"Processing {len(objects)} objects in {category}")
-
-        # Process images
-        for obj in objects if subset_size is None else objects[:subset_size]:
-            for video in obj['videos']:
-                video_id = video['video_id']
-                for image in video['images']:
-                    image_id = image['image_id']
-                    img_file_path = imgs_path / obj['id'] / video_id / f"{image_id}.png"
-                    if not img_file_path.exists():
-                        print(f"Image file does not exist: {img_file_path}")
-                        continue  # Skip if file does not exist
-                    
-                    # 20% of images go to validation set
-                    if hash_to_int(image_id, 5) > 0:
-                        img_dir = images_train_dir
-                        label_dir = labels_train_dir
-                        train_count += 1
-                    else:
-                        img_dir = images_val_dir
-                        label_dir = labels_val_dir
-                        val_count += 1
-
-                    # Copy image to new location
-                    new_img_path = img_dir / f"{image_id}.png"
-                    # Compress the image at its current location before moving it
-                    compress_one_image(img_file_path)
-                    shutil.copy(img_file_path, new_img_path)
-                    print(f"Copied {img_file_path} to {new_img_path}")
-
-        # Process annotations and create YOLO labels
-        for annotation in annotations:
-            file_name = annotation['object_id']
-            label_id = annotation['label_ids'][0]
-            polygon_points = annotation['data']
-            img_path = images_train_dir / f"{file_name}.png" if (images_train_dir / f"{file_name}.png").exists() else images_val_dir / f"{file_name}.png"
-            image = cv2.imread(str(img_path))
-            # Get image dimensions
-            image_height, image_width, _ = image.shape
-            print(f"Processing annotation for {file_name}")
-            print(f"Image dimensions: {image_width}x{image_height}")
-            print(f"Labels: {label_id}")
-            # print(f"Polygon: {polygon_points}")
-            file_content = ""
-            label = labels_mapping.get(label_id, None)
-            if label is None:
-                print(f"Label ID {label_id} not found in labels mapping")
-                continue
-            yolo_id = label['yolo_id']
-            if yolo_id == -1:
-                print(f"YOLO ID not found for label ID {label_id}")
-                continue
-            print(f"YOLO ID: {yolo_id}")
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Process each category directory
+            for category in ['Lung_cancer/Lung_cancer', 'Non_lung_cancer/Non_lung_cancer']:
+
+                imgs_path = Path(source_dir) / category / 'imgs'
+                objects_file = Path(source_dir) / category / 'objects.json'
+                annotation_file = Path(source_dir) / category / 'annotation.json'
             
-            # Get bounding boxes
-            bbox = get_bounding_box(polygon_points, image_width, image_height)
-            file_content += f"{yolo_id} {bbox[0]} {bbox[1]} {bbox[2]} {bbox[3]}\n"
-
-            # Visualize bounding box
-            draw_bbox(image, bbox)
-
-            # Visualize the polygon
-            for point in polygon_points:
-                draw_circle(image, point)
-            visualization_path = visualization_dir / f"{file_name}.png"
-            cv2.imwrite(str(visualization_path), image)
-
-            if file_content:
-                if hash_to_int(file_name, 5) > 0:
-                    label_dir = labels_train_dir
-                else:
-                    label_dir = labels_val_dir
-                label_file_path = label_dir / f"{file_name}.txt"
-                with open(label_file_path, 'w') as f:
-                    f.write(file_content)
-                print(f"Created label file {label_file_path}")
+                with open(objects_file) as f:
+                    objects = json.load(f)
+                with open(annotation_file) as f:
+                    annotations = json.load(f)
+
+                print(f"Processing {len(objects)} objects in {category}")
+
+                # Process images, and index them by id: split, new path and size
+                image_index = {}
+                futures = {}
+                for obj in objects if subset_size is None else objects[:subset_size]:
+                    for video in obj['videos']:
+                        video_id = video['video_id']
+                        for image in video['images']:
+                            image_id = image['image_id']
+                            img_file_path = imgs_path / obj['id'] / video_id / f"{image_id}.png"
+                            if not img_file_path.exists():
+                                print(f"Image file does not exist: {img_file_path}")
+                                continue  # Skip if file does not exist
+                        
+                            # 20% of images go to validation set
+                            if hash_to_int(image_id, 5) > 0:
+                                split = 'train'
+                                train_count += 1
+                            else:
+                                split = 'val'
+                                val_count += 1
+
+                            # Compressed copy of the image in the new location (the source is left untouched)
+                            new_img_path = Path(dest_dir) / 'images' / split / f"{image_id}.png"
+                            previous_hash = manifest.get(image_id, {}).get('hash')
+                            futures[image_id] = pool.submit(process_image, img_file_path, new_img_path, previous_hash)
+                            image_index[image_id] = {'split': split, 'path': new_img_path, 'annotations': []}
+                            seen_ids.add(image_id)
+
+                category_copied = 0
+                for image_id, future in futures.items():
+                    try:
+                        src_hash, width, height, copied = future.result()
+                    except Exception as e:
+                        # Skipped (and without hash in the manifest, so it's processed again at the next run)
+                        print(f"Failed to process image {image_id}: {e}")
+                        manifest.pop(image_id, None)
+                        del image_index[image_id]
+                        failed_count += 1
+                        continue
+                    manifest[image_id] = {'hash': src_hash, 'width': width, 'height': height}
+                    image_index[image_id]['size'] = (width, height)
+                    category_copied += copied
+                copied_count += category_copied
+                print(f"Copied {category_copied} new or changed images out of {len(futures)}")
+                save_manifest(manifest_path, manifest)
+
+                # Group the annotations (polygons) by image
+                unmatched = 0
+                for annotation in annotations:
+                    entry = image_index.get(annotation['object_id'])
+                    if entry is None:
+                        unmatched += 1
+                        continue
+                    entry['annotations'].append(annotation)
+                if unmatched:
+                    print(f"{unmatched} annotations without image (missing or outside the subset)")
+
+                # Create YOLO labels, one file per image with all its boxes
+                visualizations = []
+                box_count = 0
+                for image_id, entry in image_index.items():
+                    label_file_path = Path(dest_dir) / 'labels' / entry['split'] / f"{image_id}.txt"
+                    if not entry['annotations']:
+                        remove_outputs(dest_dir, image_id, image=False)
+                        continue
+                    image_width, image_height = entry['size']
+                    bboxes = []
+                    polygons = []
+                    lines = []
+                    for annotation in entry['annotations']:
+                        label_id = annotation['label_ids'][0]
+                        polygon_points = annotation['data']
+                        label = labels_mapping.get(label_id, None)
+                        if label is None:
+                            print(f"Label ID {label_id} not found in labels mapping")
+                            continue
+                        yolo_id = label['yolo_id']
+                        if yolo_id == -1:
+                            print(f"YOLO ID not found for label ID {label_id}")
+                            continue
+
+                        # Get bounding boxes
+                        bbox = get_bounding_box(polygon_points, image_width, image_height)
+                        lines.append(f"{yolo_id} {bbox[0]} {bbox[1]} {bbox[2]} {bbox[3]}\n")
+                        bboxes.append(bbox)
+                        polygons.append(polygon_points)
+
+                    if not lines:
+                        # All the annotations are gone or unmapped: no stale boxes from a previous run
+                        remove_outputs(dest_dir, image_id, image=False)
+                        continue
+                    with open(label_file_path, 'w') as f:
+                        f.write("".join(lines))
+                    box_count += len(lines)
+
+                    # Visualize bounding boxes and polygons (on a sample of the images)
+                    if hash_to_int(image_id, 1000) < visualize_fraction * 1000:
+                        visualization_path = visualization_dir / f"{image_id}.png"
+                        visualizations.append(pool.submit(visualize_annotations, entry['path'], bboxes, polygons, visualization_path))
+
+                for future in visualizations:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Failed to draw a visualization: {e}")
+                print(f"Created labels with {box_count} boxes from {len(annotations)} annotations, {len(visualizations)} visualizations")
+
+        # Outputs of the images removed from the source (a subset run doesn't see all the images)
+        if subset_size is None:
+            removed_ids = set(manifest) - seen_ids
+            for image_id in removed_ids:
+                remove_outputs(dest_dir, image_id)
+                del manifest[image_id]
+            if removed_ids:
+                print(f"Removed {len(removed_ids)} images no longer in the source")
+    finally:
+        # Also saved when a category fails: the images already processed are not compressed again
+        save_manifest(manifest_path, manifest)
 
     print(f"Total images in training set: {train_count}")
     print(f"Total images in validation set: {val_count}")
-    print(f"Total images: {train_count + val_count}")
+    print(f"Total images: {train_count + val_count} ({copied_count} new or changed, {failed_count} failed)")
 
     # Zip the directories
     zip_directory(dest_dir)
@@ -175,4 +290,4 @@ if __name__ == "__main__":
     source_dir = Path(os.path.dirname(os.path.abspath(__file__))) / 'data' / 'bronchoscopy'
     dest_dir = Path(os.path.dirname(os.path.abspath(__file__))) / 'data' / 'formatted_bronchoscopy'
     labels_mapping_path = Path(os.path.dirname(os.path.abspath(__file__))) / 'data' / 'formatted_bronchoscopy' / 'yolo_labels.json'
-    process_subset(source_dir, dest_dir, labels_mapping_path, subset_size=None)
+    process_subset(source_dir, dest_dir, labels_mapping_path, subset_size=None, visualize_fraction=0.05)
@@ -1,3 +1,15 @@
+"""
+Implementation of YOLOv3-tiny architecture
+sources:
+    https://pjreddie.com/darknet/yolo/
+    https://github.com/pjreddie/darknet/blob/master/cfg/yolov3-tiny.cfg
+
+Two scales instead of three: a 13x13 grid (stride 32) for large objects and a 26x26 grid (stride 16), fed by the
+upsampled 13x13 features concatenated with the stride 16 backbone features (route connection).
+The outputs have the same layout as YOLOv3, one (N, 3, S, S, num_classes + 5) tensor per scale, so YoloLoss,
+the target encoder and the inference path work on both models (with config.TINY_ANCHORS and config.TINY_S).
+"""
+
 import torch
 import torch.nn as nn
 import config
@@ -22,7 +34,8 @@ class YOLOv3Tiny(nn.Module):
         self.num_anchors = 3
 
         # Define the YOLOv3-tiny architecture
-        self.layers = nn.Sequential(
+        # Backbone up to stride 16, its output is routed to the 26x26 head
+        self.backbone = nn.Sequential(
             ConvBlock(3, 16, 3, 1, 1),
             nn.MaxPool2d(2, 2),
             ConvBlock(16, 32, 3, 1, 1),
@@ -32,17 +45,39 @@ class YOLOv3Tiny(nn.Module):
             ConvBlock(64, 128, 3, 1, 1),
             nn.MaxPool2d(2, 2),
             ConvBlock(128, 256, 3, 1, 1),
+        )
+        # Stride 32, the stride 1 max pool is padded on the right and bottom to keep the 13x13 grid
+        self.neck = nn.Sequential(
             nn.MaxPool2d(2, 2),
             ConvBlock(256, 512, 3, 1, 1),
+            nn.ZeroPad2d((0, 1, 0, 1)),
             nn.MaxPool2d(2, 1),
             ConvBlock(512, 1024, 3, 1, 1),
             ConvBlock(1024, 256, 1, 1, 0),
+        )
+        self.head_13 = nn.Sequential(
             ConvBlock(256, 512, 3, 1, 1),
             nn.Conv2d(512, self.num_anchors * (5 + self.num_classes), 1, 1, 0)
         )
+        self.route = nn.Sequential(
+            ConvBlock(256, 128, 1, 1, 0),
+            nn.Upsample(scale_factor=2),
+        )
+        self.head_26 = nn.Sequential(
+            ConvBlock(128 + 256, 256, 3, 1, 1),
+            nn.Conv2d(256, self.num_anchors * (5 + self.num_classes), 1, 1, 0)
+        )
+
+    def _reshape(self, x):
+        # (N, 3 * (5 + C), S, S) -> (N, 3, S, S, 5 + C) as ScalePrediction of YOLOv3
+        return x.reshape(x.shape[0], self.num_anchors, self.num_classes + 5, x.shape[2], x.shape[3]).permute(0, 1, 3, 4, 2)
 
     def forward(self, x):
-        return self.layers(x)
+        features_26 = self.backbone(x)
+        features_13 = self.neck(features_26)
+        out_13 = self.head_13(features_13)
+        out_26 = self.head_26(torch.cat([self.route(features_13), features_26], dim=1))
+        return [self._reshape(out_13), self._reshape(out_26)]
 
 if __name__ == "__main__":
     num_classes = config.NUM_CLASSES
@@ -50,6 +85,14 @@ if __name__ == "__main__":
     model = YOLOv3Tiny(num_classes=num_classes)
     x = torch.randn((2, 3, IMAGE_SIZE, IMAGE_SIZE))
     out = model(x)
-    print(out.shape)
-    # The output should be torch.Size([2, 255, 13, 13]) where 255 = 3 * (5 + 80) where 3 is the number of anchors and 80 is the number of classes
+
+    # One output per scale: 13x13 and 26x26 grids, 3 anchors per cell
+    assert len(out) == 2
+    assert out[0].shape == (2, 3, IMAGE_SIZE//32, IMAGE_SIZE//32, num_classes + 5)
+    assert out[1].shape == (2, 3, IMAGE_SIZE//16, IMAGE_SIZE//16, num_classes + 5)
+
+    # Print total number of parameters in the model
+    pytorch_total_params = sum(p.numel() for p in model.parameters())
+    print("Total number of parameters: ", pytorch_total_params)
+
     print("Success!")
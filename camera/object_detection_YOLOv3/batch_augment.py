@@ -0,0 +1,254 @@
+"""
+Batch augmentation on tensors (GPU or CPU), replacing the per-sample albumentations chain of config.train_transforms.
+
+With config.BATCH_AUGMENT the DataLoader workers only decode, letterbox and collate the images with their boxes
+(config.batch_train_transforms, YOLODataset(encode=False), collate_boxes). The whole batch is then augmented with
+BatchAugment and the targets are encoded per batch with dataset.encode_targets:
+
+    x, boxes, batch_idx = batch_augment(x, boxes, batch_idx)
+    y = encode_targets(boxes, batch_idx, x.shape[0], anchors, config.S)
+
+Geometric transforms (random crop of the 1.1x image, shift/scale/rotate or shear, horizontal flip) are combined
+into one affine matrix per image and applied with a single grid_sample, the boxes are transformed with the same
+matrices. Photometric transforms (color jitter, blur, posterize, gray, channel shuffle) are computed
+only to the images drawn for each of them. CLAHE has no cheap tensor equivalent and is left out.
+"""
+
+import math
+import torch
+import torch.nn.functional as F
+
+
+def _uniform(n, low, high, device):
+    return torch.empty(n, device=device).uniform_(low, high)
+
+
+def _bernoulli(n, p, device):
+    return torch.rand(n, device=device) < p
+
+
+class BatchAugment:
+    """
+    Parameters:
+        scale (float): images are zoomed by scale and randomly cropped (LongestMaxSize(scale * size) + RandomCrop)
+        p_geometric (float): probability of shift/scale/rotate or shear (one of them, as A.OneOf)
+        shift_limit, scale_limit, rotate_limit, shear_limit: ranges of the geometric transforms (fraction of the
+        image, fraction of scale, degrees, degrees)
+        p_flip, p_color, p_blur, p_posterize, p_gray, p_channel_shuffle: probabilities of the other transforms
+        color_jitter (float): brightness, contrast, saturation (and hue, up to 0.5) jitter
+        min_visibility (float): boxes with less than this fraction of their area inside the image are dropped
+    """
+
+    def __init__(self, scale=1.1, p_geometric=0.5, shift_limit=0.0625, scale_limit=0.1, rotate_limit=20,
+                 shear_limit=15, p_flip=0.5, p_color=0.4, color_jitter=0.6, p_blur=0.1, p_posterize=0.1,
+                 p_gray=0.1, p_channel_shuffle=0.05, min_visibility=0.4):
+        self.scale = scale
+        self.p_geometric = p_geometric
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.shear_limit = shear_limit
+        self.p_flip = p_flip
+        self.p_color = p_color
+        self.color_jitter = color_jitter
+        self.p_blur = p_blur
+        self.p_posterize = p_posterize
+        self.p_gray = p_gray
+        self.p_channel_shuffle = p_channel_shuffle
+        self.min_visibility = min_visibility
+
+    def __call__(self, images, boxes, batch_idx):
+        """
+        Parameters:
+            images (tensor): (N, 3, H, W) uint8 or float in [0, 1] square images (letterboxed)
+            boxes (tensor): (M, 5) boxes [x, y, w, h, class] relative to the image
+            batch_idx (tensor): (M,) image of every box
+        Returns:
+            images (N, 3, H, W) float in [0, 1], kept boxes and their batch_idx
+        """
+        if images.dtype == torch.uint8:
+            images = images.float() / 255
+        matrices = self.random_affine(images.shape[0], images.device)
+        images = warp_images(images, matrices)
+        boxes, batch_idx = warp_boxes(boxes, batch_idx, matrices, self.min_visibility)
+        images = self.photometric(images)
+        return images, boxes, batch_idx
+
+    def random_affine(self, n, device):
+        """(n, 3, 3) forward transforms in normalized coordinates ([-1, 1], centre of the image at 0)"""
+        eye = torch.eye(3, device=device).repeat(n, 1, 1)
+
+        # Random crop of the image zoomed by scale
+        crop = eye.clone()
+        crop[:, 0, 0] = crop[:, 1, 1] = self.scale
+        crop[:, 0, 2] = _uniform(n, -(self.scale - 1), self.scale - 1, device)
+        crop[:, 1, 2] = _uniform(n, -(self.scale - 1), self.scale - 1, device)
+
+        # Shift scale rotate
+        angle = torch.deg2rad(_uniform(n, -self.rotate_limit, self.rotate_limit, device))
+        zoom = _uniform(n, 1 - self.scale_limit, 1 + self.scale_limit, device)
+        ssr = eye.clone()
+        ssr[:, 0, 0], ssr[:, 0, 1] = zoom * torch.cos(angle), -zoom * torch.sin(angle)
+        ssr[:, 1, 0], ssr[:, 1, 1] = zoom * torch.sin(angle), zoom * torch.cos(angle)
+        ssr[:, 0, 2] = _uniform(n, -2 * self.shift_limit, 2 * self.shift_limit, device)
+        ssr[:, 1, 2] = _uniform(n, -2 * self.shift_limit, 2 * self.shift_limit, device)
+
+        # Shear
+        shear = eye.clone()
+        shear[:, 0, 1] = torch.tan(torch.deg2rad(_uniform(n, -self.shear_limit, self.shear_limit, device)))
+
+        # One of them (or none) per image
+        geometric = _bernoulli(n, self.p_geometric, device)[:, None, None]
+        use_ssr = _bernoulli(n, 0.5, device)[:, None, None]
+        geometric_matrix = torch.where(geometric, torch.where(use_ssr, ssr, shear), eye)
+
+        flip = eye.clone()
+        flip[:, 0, 0] = torch.where(_bernoulli(n, self.p_flip, device), -1.0, 1.0)
+
+        return flip @ geometric_matrix @ crop
+
+    def photometric(self, images):
+        """Photometric transforms, each one only computed on the images it's applied to"""
+        n, device = images.shape[0], images.device
+        images = images.clone()
+
+        def apply(p, transform):
+            selected = torch.nonzero(_bernoulli(n, p, device)).squeeze(1)
+            if len(selected) > 0:
+                images[selected] = transform(images[selected])
+
+        apply(self.p_color, self.color_jitter_transform)
+        apply(self.p_blur, lambda x: F.avg_pool2d(F.pad(x, (1, 1, 1, 1), mode="replicate"), 3, stride=1))
+        apply(self.p_posterize, lambda x: torch.floor(x * 255 / 16) * 16 / 255)  # 4 bits
+        apply(self.p_gray, lambda x: to_gray(x).expand_as(x))
+        apply(self.p_channel_shuffle, lambda x: torch.gather(
+            x, 1, torch.argsort(torch.rand(len(x), 3, device=device), dim=1).view(-1, 3, 1, 1).expand_as(x)))
+        return images
+
+    def color_jitter_transform(self, images):
+        """Random brightness, contrast, saturation and hue of every image"""
+        n, device = images.shape[0], images.device
+        low, high = max(0.0, 1 - self.color_jitter), 1 + self.color_jitter
+
+        def factor():
+            return _uniform(n, low, high, device).view(n, 1, 1, 1)
+
+        images = images * factor()
+        mean = to_gray(images).mean(dim=(2, 3), keepdim=True)
+        images = (images - mean) * factor() + mean
+        gray = to_gray(images)
+        images = (images - gray) * factor() + gray
+        hue_limit = min(self.color_jitter, 0.5)
+        images = rotate_hue(images.clamp(0, 1), _uniform(n, -hue_limit, hue_limit, device))
+        return images.clamp(0, 1)
+
+
+def to_gray(images):
+    """(N, 1, H, W) luma of (N, 3, H, W) RGB images"""
+    weights = torch.tensor([0.299, 0.587, 0.114], device=images.device, dtype=images.dtype).view(1, 3, 1, 1)
+    return (images * weights).sum(dim=1, keepdim=True)
+
+
+def rotate_hue(images, hue):
+    """Shifts the hue of (N, 3, H, W) RGB images by hue (fraction of a turn) with a rotation in YIQ space"""
+    rgb_to_yiq = torch.tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]],
+                              device=images.device)
+    yiq_to_rgb = torch.linalg.inv(rgb_to_yiq)
+    angle = 2 * math.pi * hue
+    rotation = torch.zeros(len(hue), 3, 3, device=images.device)
+    rotation[:, 0, 0] = 1
+    rotation[:, 1, 1], rotation[:, 1, 2] = torch.cos(angle), -torch.sin(angle)
+    rotation[:, 2, 1], rotation[:, 2, 2] = torch.sin(angle), torch.cos(angle)
+    transform = yiq_to_rgb @ rotation @ rgb_to_yiq
+    return torch.einsum("nij,njhw->nihw", transform, images)
+
+
+def warp_images(images, matrices):
+    """Applies the (N, 3, 3) forward transforms (normalized coordinates) to the images, borders filled with 0"""
+    theta = torch.linalg.inv(matrices)[:, :2]  # grid_sample maps output pixels to input pixels
+    grid = F.affine_grid(theta, images.shape, align_corners=False)
+    return F.grid_sample(images, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+
+
+def warp_boxes(boxes, batch_idx, matrices, min_visibility=0.4):
+    """
+    Transforms [x, y, w, h, class] boxes (relative to the image) with the affine matrix of their image: the new box
+    encloses the transformed corners and is clipped to the image. Boxes with less than min_visibility of their area
+    inside the image are dropped.
+    """
+    if len(boxes) == 0:
+        return boxes, batch_idx
+
+    x, y, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    corners_x = torch.stack((x - w / 2, x + w / 2, x + w / 2, x - w / 2), dim=1) * 2 - 1
+    corners_y = torch.stack((y - h / 2, y - h / 2, y + h / 2, y + h / 2), dim=1) * 2 - 1
+    corners = torch.stack((corners_x, corners_y, torch.ones_like(corners_x)), dim=1)  # (M, 3, 4)
+    corners = (matrices[batch_idx].to(corners.dtype) @ corners)[:, :2]
+    corners = (corners + 1) / 2
+
+    top_left = corners.min(dim=2).values
+    bottom_right = corners.max(dim=2).values
+    area = (bottom_right - top_left).prod(dim=1)
+    top_left, bottom_right = top_left.clamp(0, 1), bottom_right.clamp(0, 1)
+    clipped_area = (bottom_right - top_left).clamp(min=0).prod(dim=1)
+
+    keep = clipped_area > min_visibility * area
+    center = (top_left + bottom_right) / 2
+    size = bottom_right - top_left
+    boxes = torch.cat((center, size, boxes[:, 4:5]), dim=1)
+    return boxes[keep], batch_idx[keep]
+
+
+def collate_boxes(batch):
+    """
+    collate_fn of a YOLODataset(encode=False): stacks the images and concatenates the boxes of the batch.
+    Returns:
+        images, (boxes (M, 5), batch_idx (M,))
+    """
+    images = torch.stack([image for image, _ in batch])
+    boxes = torch.cat([image_boxes for _, image_boxes in batch])
+    batch_idx = torch.cat([torch.full((len(image_boxes),), i, dtype=torch.long) for i, (_, image_boxes) in enumerate(batch)])
+    return images, (boxes, batch_idx)
+
+
+if __name__ == "__main__":
+    import time
+
+    torch.manual_seed(0)
+    images = torch.randint(0, 256, (32, 3, 416, 416), dtype=torch.uint8)
+    boxes = torch.rand(100, 5) * torch.tensor([0.5, 0.5, 0.3, 0.3, 0]) + torch.tensor([0.25, 0.25, 0.05, 0.05, 0])
+    boxes[:, 4] = torch.randint(0, 20, (100,)).float()
+    batch_idx = torch.randint(0, 32, (100,))
+
+    # Without any transform images and boxes are unchanged
+    identity = BatchAugment(scale=1.0, p_geometric=0, p_flip=0, p_color=0, p_blur=0, p_posterize=0, p_gray=0,
+                            p_channel_shuffle=0)
+    out, out_boxes, out_idx = identity(images, boxes, batch_idx)
+    assert torch.allclose(out, images.float() / 255, atol=1e-4)
+    assert torch.allclose(out_boxes, boxes, atol=1e-5) and torch.equal(out_idx, batch_idx)
+
+    # A flip mirrors the images and the boxes
+    flip = BatchAugment(scale=1.0, p_geometric=0, p_flip=1, p_color=0, p_blur=0, p_posterize=0, p_gray=0,
+                        p_channel_shuffle=0)
+    out, out_boxes, _ = flip(images, boxes, batch_idx)
+    assert torch.allclose(out, images.flip(-1).float() / 255, atol=1e-4)
+    assert torch.allclose(out_boxes[:, 0], 1 - boxes[:, 0], atol=1e-5)
+
+    # A box drawn on the image follows the geometric transforms
+    augment = BatchAugment(p_geometric=1, p_color=0, p_blur=0, p_posterize=0, p_gray=0, p_channel_shuffle=0)
+    image = torch.zeros(1, 3, 416, 416)
+    image[..., 150:250, 120:220] = 1
+    box = torch.tensor([[170 / 416, 200 / 416, 100 / 416, 100 / 416, 3.0]])
+    for _ in range(20):
+        out, out_box, _ = augment(image, box, torch.zeros(1, dtype=torch.long))
+        ys, xs = torch.nonzero(out[0, 0] > 0.5, as_tuple=True)
+        if len(out_box) == 1 and len(xs) > 0:
+            # the transformed box encloses the transformed square
+            x1, y1 = (out_box[0, :2] - out_box[0, 2:4] / 2) * 416
+            x2, y2 = (out_box[0, :2] + out_box[0, 2:4] / 2) * 416
+            assert xs.min() >= x1 - 2 and xs.max() <= x2 + 2 and ys.min() >= y1 - 2 and ys.max() <= y2 + 2
+
+    start = time.perf_counter()
+    BatchAugment()(images, boxes, batch_idx)
+    print(f"Augmented a batch of {len(images)} images on the cpu in {(time.perf_counter() - start) * 1000:.0f} ms")
+    print("Success!")
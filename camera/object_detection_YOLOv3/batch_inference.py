@@ -0,0 +1,273 @@
+"""
+Micro-batched inference for several frame sources (recorded bronchoscopy videos, several cameras).
+
+Frames submitted from any thread are queued, the runner thread groups them into batches of up to max_batch frames,
+waiting at most max_wait seconds after the first frame of a batch (the latency deadline), runs the batch through the
+model (any backend of realtime.py) and resolves the future of every frame with its boxes. With a
+detection_cache.DetectionCache, the frames of the recorded videos already seen (e.g. a procedure reviewed again) are
+resolved from the cache without going through the model, live cameras are not cached. Every source reads its
+frames and consumes their results in order, so the results are demultiplexed back to their source in order.
+
+Usage:
+    python batch_inference.py video1.mp4 video2.mp4 --max-batch 8 --max-wait-ms 20 --out-dir annotated
+    python batch_inference.py 0 1 --show   (live cameras 0 and 1)
+    python batch_inference.py video1.mp4 --cache detections.sqlite --conf 0.4   (replays served from the cache)
+"""
+
+import argparse
+import collections
+import os
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+import torch
+
+from concurrent.futures import Future
+
+import config
+from detection_cache import DetectionCache, filter_boxes, model_fingerprint, video_key
+from preprocess import FramePreprocessor, boxes_to_frame
+from realtime import BACKENDS, draw_bb, load_backend
+from utils import non_max_suppression, predictions_to_bboxes
+
+
+class MicroBatchRunner:
+    """
+    Inputs:
+        model: callable taking a (N, 3, IMAGE_SIZE, IMAGE_SIZE) batch and returning the predictions of every scale
+        scaled_anchors: (num scales, 3, 2) anchors scaled to the grids
+        max_batch: largest batch given to the model
+        max_wait: seconds a frame waits for other frames before its batch is run
+        cache: optional detection_cache.DetectionCache
+    """
+
+    def __init__(self, model, scaled_anchors, max_batch=8, max_wait=0.02, conf_threshold=0.6, iou_threshold=0.5,
+                 cache=None):
+        self.model = model
+        self.scaled_anchors = scaled_anchors
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.cache = cache
+        self.batch_sizes = []
+        self.preprocessor = FramePreprocessor()
+        # Batch input, every frame is letterboxed directly into its slot
+        self._inputs = torch.empty((max_batch, 3, config.IMAGE_SIZE, config.IMAGE_SIZE), device=config.DEVICE)
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, frame, source=None, key=None):
+        """
+        Queues a BGR frame. Returns a Future resolved with the boxes of the frame, a list of
+        [class_pred, conf, x, y, width, height] relative to the frame.
+        key: key of the frame in the cache (detection_cache.video_key), frames without key (live cameras) aren't cached
+        """
+        future = Future()
+        future.source = source
+        if self.cache is not None and key is not None:
+            boxes = self.cache.get(key, self.conf_threshold, self.iou_threshold)
+            if boxes is not None:
+                future.set_result(boxes)
+                return future
+        self._queue.put((frame, future, key))
+        return future
+
+    def _next_batch(self):
+        # Blocks for the first frame, then collects frames until the batch is full or the deadline is reached
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # Run what's left, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        # Frames whose future was cancelled (source stopped) are not run
+        return [item for item in batch if item[1].set_running_or_notify_cancel()]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            if not batch:
+                continue
+            frames, futures, keys = zip(*batch)
+            # The cached frames are computed down to cache.min_conf and filtered at conf_threshold
+            cached = self.cache is not None and any(key is not None for key in keys)
+            try:
+                boxes = self._infer(frames, self.cache.min_conf if cached else self.conf_threshold)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batch_sizes.append(len(frames))
+            for future, key, frame_boxes in zip(futures, keys, boxes):
+                if cached:
+                    if key is not None:
+                        self.cache.put(key, frame_boxes, self.iou_threshold)
+                    frame_boxes = filter_boxes(frame_boxes, self.conf_threshold)
+                future.set_result(frame_boxes)
+
+    def _infer(self, frames, threshold):
+        x = self._inputs[:len(frames)]
+        geometries = [self.preprocessor(frame, out=x[k])[1:] for k, frame in enumerate(frames)]
+        with torch.no_grad():
+            y = self.model(x)
+        return [
+            boxes_to_frame(
+                non_max_suppression(image_boxes, iou_threshold=self.iou_threshold, threshold=threshold,
+                                    box_format="midpoint").tolist(),
+                scale, pad, frame_shape=frame.shape,
+            )
+            for image_boxes, frame, (scale, pad) in zip(
+                predictions_to_bboxes(y, self.scaled_anchors, threshold=threshold), frames, geometries)
+        ]
+
+    def close(self):
+        """Runs the frames still queued and stops the runner thread"""
+        self._queue.put(None)
+        self._worker.join()
+
+
+def run_source(runner, capture, sink, source=None, max_in_flight=16, drop_when_busy=False, video_path=None,
+               stop=None):
+    """
+    Reads the frames of a cv2.VideoCapture, submits them to the runner and calls sink(frame_index, frame, boxes)
+    in frame order.
+    Inputs:
+        video_path: video file read by capture, its frames are cached by index (None: live camera, not cached)
+        max_in_flight: frames submitted and not consumed yet (bounds memory when the model is slower than the source)
+        drop_when_busy: skip frames instead of waiting when max_in_flight is reached (live cameras)
+        stop: optional threading.Event, when set the source stops reading, the frames still queued in the runner are
+              cancelled and the ones already being run are given to sink
+    Returns:
+        number of frames processed
+    """
+    pending = collections.deque()
+    frame_index = 0
+    processed = 0
+    while stop is None or not stop.is_set():
+        ret, frame = capture.read()
+        if not ret:
+            break
+        if len(pending) >= max_in_flight:
+            if drop_when_busy and not pending[0][2].done():
+                frame_index += 1
+                continue
+            index, old_frame, future = pending.popleft()
+            sink(index, old_frame, future.result())
+            processed += 1
+        key = video_key(video_path, frame_index) if runner.cache is not None and video_path is not None else None
+        pending.append((frame_index, frame, runner.submit(frame, source, key)))
+        frame_index += 1
+        # Consume the results that are already available, in order
+        while pending and pending[0][2].done():
+            index, old_frame, future = pending.popleft()
+            sink(index, old_frame, future.result())
+            processed += 1
+
+    while pending:
+        index, old_frame, future = pending.popleft()
+        if stop is not None and stop.is_set() and future.cancel():
+            continue
+        sink(index, old_frame, future.result())
+        processed += 1
+    return processed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batched YOLOv3 inference on videos or cameras")
+    parser.add_argument("sources", nargs="+", help="video files or camera indices")
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20.0)
+    parser.add_argument("--out-dir", default=None, help="write the annotated videos in this folder")
+    parser.add_argument("--show", action="store_true", help="display the annotated frames")
+    parser.add_argument("--conf", type=float, default=0.6, help="confidence threshold")
+    parser.add_argument("--cache", default=config.DETECTION_CACHE,
+                        help="detection cache file for the video files ('' to disable)")
+    args = parser.parse_args()
+
+    model = load_backend(config.RUNTIME)
+    cache = None
+    if args.cache:
+        cache = DetectionCache(args.cache, model_fingerprint(BACKENDS[config.RUNTIME][1]),
+                               max_entries=config.DETECTION_CACHE_MAX_ENTRIES)
+    scaled_anchors = ( torch.tensor(config.ANCHORS) * torch.tensor(config.S).unsqueeze(1).unsqueeze(1).repeat(1, 3, 2) ).to(config.DEVICE)
+    class_labels = config.COCO_LABELS if config.DATASET=='COCO' else config.PASCAL_CLASSES
+    colors = np.random.randint(0, 255, size=(len(class_labels), 3), dtype=int).tolist()
+    runner = MicroBatchRunner(model, scaled_anchors, args.max_batch, args.max_wait_ms / 1000, conf_threshold=args.conf,
+                              cache=cache)
+
+    def process(source):
+        live = source.isdigit()
+        capture = cv2.VideoCapture(int(source) if live else source)
+        writer = None
+        if args.out_dir is not None:
+            os.makedirs(args.out_dir, exist_ok=True)
+            name = f"camera_{source}.mp4" if live else os.path.basename(source)
+            fps = capture.get(cv2.CAP_PROP_FPS) or 30
+            size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            writer = cv2.VideoWriter(os.path.join(args.out_dir, name), cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+
+        def sink(frame_index, frame, boxes):
+            if writer is not None or args.show:
+                frame = draw_bb(frame, boxes, class_labels, colors)
+            if writer is not None:
+                writer.write(frame)
+            if args.show:
+                frames_to_show[source] = frame
+
+        try:
+            processed = run_source(runner, capture, sink, source, drop_when_busy=live,
+                                   video_path=None if live else source, stop=stop)
+        finally:
+            capture.release()
+            if writer is not None:
+                writer.release()
+        print(f"{source}: {processed} frames")
+
+    frames_to_show = {}
+    stop = threading.Event()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=process, args=(source,), daemon=True) for source in args.sources]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        if args.show:
+            # OpenCV windows must be updated from the main thread
+            for source, frame in list(frames_to_show.items()):
+                cv2.imshow(f"YOLOv3 {source}", frame)
+            if cv2.waitKey(1) == ord('q'):
+                break
+        else:
+            time.sleep(0.05)
+    # The sources stop submitting and release their writers before the runner stops
+    stop.set()
+    for thread in threads:
+        thread.join()
+    runner.close()
+    cv2.destroyAllWindows()
+
+    elapsed = time.perf_counter() - start
+    inferred = sum(runner.batch_sizes)
+    frames = inferred + (cache.hits if cache is not None else 0)
+    print(f"{frames} frames in {elapsed:.1f} s ({frames / elapsed:.1f} fps), "
+          f"mean batch {inferred / max(len(runner.batch_sizes), 1):.1f}")
+    if cache is not None:
+        print(f"Detection cache: {cache.hits} hits, {cache.misses} misses, {len(cache)} frames stored")
+        cache.close()
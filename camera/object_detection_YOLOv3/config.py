@@ -7,6 +7,17 @@ from albumentations.pytorch import ToTensorV2
 
 # realtime.py variables
 WEBCAM = False
+RUNTIME = "torch" # "torch" (CHECKPOINT_FILE), "torchscript" (TORCHSCRIPT_MODEL) or "onnxruntime" (ONNX_MODEL), see export.py
+BENCHMARK_RUNTIMES = False # compare the latency of the available runtimes instead of running the detection
+INFERENCE_BACKEND = "eager" # RUNTIME "torch": "eager", "script" (TorchScript) or "compile" (torch.compile), see inference.py
+CHANNELS_LAST = True # channels_last memory format for inference
+TRACKING = True # track the boxes across the webcam frames (sort_tracker.py): stable ids and classes
+DETECT_EVERY = 3 # with TRACKING, run the detector every DETECT_EVERY frames (or earlier when a track is uncertain)
+VIDEO_PATH = None # with WEBCAM True, replay this recorded video (every frame, in order) instead of the webcam
+DETECTION_CACHE = None # e.g. "detections.sqlite": detections of the recorded videos already seen (detection_cache.py), live cameras are not cached
+DETECTION_CACHE_MAX_ENTRIES = 200_000 # frames kept in DETECTION_CACHE, the least recently used are evicted
+TORCHSCRIPT_MODEL = "model.ts" # written by export.py, or the INT8 model written by quantize.py
+ONNX_MODEL = "model.onnx" # written by export.py
 IMG_PATH = "C:\\Users\\z5440219\\OneDrive - UNSW\Desktop\\github\\surgical-copilot\\camera\\object_detection_YOLOv3\\test_images\\people.jpg" # used only when WEBCAM is False
 
 DATASET = 'PASCAL_VOC'
@@ -23,6 +34,7 @@ NUM_EPOCHS = 100
 CONF_THRESHOLD = 0.05
 MAP_IOU_THRESH = 0.5
 NMS_IOU_THRESH = 0.45
+MODEL = "YOLOv3" # "YOLOv3" or "YOLOv3Tiny" (2 scales, selects TINY_ANCHORS and TINY_S below)
 S = [IMAGE_SIZE // 32, IMAGE_SIZE // 16, IMAGE_SIZE // 8] # 13, 26, 52
 PIN_MEMORY = True
 LOAD_MODEL = True
@@ -30,6 +42,10 @@ SAVE_MODEL = True
 CHECKPOINT_FILE = "checkpoint.pth.tar"
 IMG_DIR = DATASET + "/images/"
 LABEL_DIR = DATASET + "/labels/"
+CACHE_DIR = DATASET + "/cache/" # parsed labels (and cached images) of YOLODataset
+CACHE_IMAGES = False # decode and resize the images once into a memory-mapped store
+BATCH_AUGMENT = False # augment whole batches on DEVICE (batch_augment.py) instead of per sample in the workers
+PACKED_DATASET = None # folder written by pack_dataset.py (e.g. "../data/formatted_bronchoscopy/packed"): train and test on its train / val shards instead of the csv datasets
 
 ANCHORS = [
     [(0.28, 0.22), (0.38, 0.48), (0.9, 0.78)],
@@ -40,6 +56,16 @@ ANCHORS = [
 # Note these have been rescaled to be between [0, 1], then the i-th anchor for scale 13 is 0.28 and 0.22. This means that the width of the bounding box is 0.28 * 416 = 117 pixels and the height is 0.22 * 416 = 91 pixels.
 # Find where the anchors values come from in the paper...
 
+# YOLOv3Tiny: 2 scales, anchors of yolov3-tiny.cfg divided by 416
+TINY_ANCHORS = [
+    [(0.19, 0.2), (0.32, 0.41), (0.83, 0.77)],
+    [(0.02, 0.03), (0.06, 0.06), (0.09, 0.14)],
+]
+TINY_S = [IMAGE_SIZE // 32, IMAGE_SIZE // 16] # 13, 26
+if MODEL == "YOLOv3Tiny":
+    ANCHORS = TINY_ANCHORS
+    S = TINY_S
+
 scale = 1.1
 train_transforms = A.Compose(
     [
@@ -70,6 +96,17 @@ train_transforms = A.Compose(
     ],
     bbox_params=A.BboxParams(format="yolo", min_visibility=0.4, label_fields=[],),
 )
+# With BATCH_AUGMENT the workers only letterbox the images, augmentation is done per batch by batch_augment.BatchAugment
+batch_train_transforms = A.Compose(
+    [
+        A.LongestMaxSize(max_size=IMAGE_SIZE),
+        A.PadIfNeeded(
+            min_height=IMAGE_SIZE, min_width=IMAGE_SIZE, border_mode=cv2.BORDER_CONSTANT
+        ),
+        ToTensorV2(), # uint8, converted to float on the device
+    ],
+    bbox_params=A.BboxParams(format="yolo", min_visibility=0.4, label_fields=[],),
+)
 test_transforms = A.Compose(
     [
         A.LongestMaxSize(max_size=IMAGE_SIZE),
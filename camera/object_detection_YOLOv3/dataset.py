@@ -30,9 +30,10 @@ Dataset structure:
 import config
 import numpy as np
 import os
-import pandas as pd
+import time
 import torch
 
+from dataset_cache import ImageStore, LabelIndex
 from PIL import Image, ImageFile
 from torch.utils.data import Dataset, DataLoader
 from utils import (
@@ -55,66 +56,201 @@ class YOLODataset(Dataset):
         S=[13, 26, 52],
         C=20,
         transform=None,
+        cache_dir=None,
+        cache_images=False,
+        cache_image_size=None,
+        encode=True,
     ):
-        self.annotations = pd.read_csv(csv_file)
+        """
+        cache_dir: folder where the parsed labels are cached (None to parse them at every start)
+        cache_images: also cache the decoded images in a memory-mapped store in cache_dir
+        cache_image_size: longest side of the cached images (default 1.1 * image_size, the size used by
+                          the train transforms before the random crop)
+        encode: return the targets of every scale, or the (n, 5) tensor of boxes [x, y, w, h, class] to
+                encode them per batch (batch_augment.collate_boxes, encode_targets)
+        """
         self.img_dir = img_dir
         self.label_dir = label_dir
         self.image_size = image_size
+        # All the labels are parsed once into flat arrays
+        if cache_dir is None:
+            self.index = LabelIndex.build(csv_file, img_dir, label_dir)
+        else:
+            self.index = LabelIndex.cached(csv_file, img_dir, label_dir, cache_dir)
+        self.images = None
+        if cache_images:
+            assert cache_dir is not None, "cache_images needs a cache_dir"
+            cache_image_size = cache_image_size or int(image_size * 1.1)
+            self.images = ImageStore(self.index.image_paths, cache_image_size, cache_dir)
         self.transform = transform
         self.S = S
-        self.anchors = torch.tensor(anchors[0] + anchors[1] + anchors[2])  # for all 3 scales
+        self.anchors = torch.tensor([anchor for scale_anchors in anchors for anchor in scale_anchors])  # for all the scales
         self.num_anchors = self.anchors.shape[0]
-        self.num_anchors_per_scale = self.num_anchors // 3
+        self.num_anchors_per_scale = self.num_anchors // len(S)
         self.C = C
         self.ignore_iou_thresh = 0.5 # ignore if iou is greater than this
+        self.encode = encode
 
     def __len__(self):
-        return len(self.annotations)
+        return len(self.index)
 
     def __getitem__(self, index):
-        label_path = os.path.join(self.label_dir, self.annotations.iloc[index, 1])
-        bboxes = np.roll(np.loadtxt(fname=label_path, delimiter=" ", ndmin=2), 4, axis=1).tolist() # [x, y, w, h, class]
-        img_path = os.path.join(self.img_dir, self.annotations.iloc[index, 0])
-        image = np.array(Image.open(img_path).convert("RGB"))
+        bboxes = self.index.image_boxes(index).tolist() # [x, y, w, h, class]
+        if self.images is not None:
+            image = self.images[index]
+        else:
+            image = np.array(Image.open(self.index.image_paths[index]).convert("RGB"))
 
         if self.transform:
             augmentations = self.transform(image=image, bboxes=bboxes)
             image = augmentations["image"]
             bboxes = augmentations["bboxes"]
 
-        # Below assumes 3 scale predictions (as paper) and same num of anchors per scale
-        targets = [torch.zeros((self.num_anchors // 3, S, S, 6)) for S in self.S] # [p_obj, x, y, w, h, class]
-        for box in bboxes:
-            iou_anchors = iou(torch.tensor(box[2:4]), self.anchors)
-            anchor_indices = iou_anchors.argsort(descending=True, dim=0)
-            x, y, width, height, class_label = box
-            has_anchor = [False] * 3  # each scale should have one anchor
-            for anchor_idx in anchor_indices:
-                scale_idx = anchor_idx // self.num_anchors_per_scale # Compute which scale the anchor is for
-                anchor_on_scale = anchor_idx % self.num_anchors_per_scale # Compute which anchor on that scale
-                S = self.S[scale_idx]
-                i, j = int(S * y), int(S * x)  # which cell
-                anchor_taken = targets[scale_idx][anchor_on_scale, i, j, 0]
-                # If the anchor is not already taken, then use it
-                if not anchor_taken and not has_anchor[scale_idx]:
-                    targets[scale_idx][anchor_on_scale, i, j, 0] = 1
-                    x_cell, y_cell = S * x - j, S * y - i  # both between [0,1] since they are the value within the cell
-                    width_cell, height_cell = (
-                        width * S,
-                        height * S,
-                    )  # can be greater than 1 since it's relative to cell
-                    box_coordinates = torch.tensor(
-                        [x_cell, y_cell, width_cell, height_cell]
-                    )
-                    targets[scale_idx][anchor_on_scale, i, j, 1:5] = box_coordinates
-                    targets[scale_idx][anchor_on_scale, i, j, 5] = int(class_label)
-                    has_anchor[scale_idx] = True
-
-                # If the anchor is not the best but has a high IOU, then it is ignored
-                elif not anchor_taken and iou_anchors[anchor_idx] > self.ignore_iou_thresh:
-                    targets[scale_idx][anchor_on_scale, i, j, 0] = -1  # ignore prediction
-
-        return image, tuple(targets)
+        if not self.encode:
+            return image, torch.tensor(bboxes, dtype=torch.float32).reshape(-1, 5)
+
+        return image, self.build_targets(bboxes)
+
+    def build_targets(self, bboxes):
+        """
+        Assigns every box ([x, y, w, h, class]) to the best free anchor of every scale.
+        Returns one (num_anchors_per_scale, S, S, 6) tensor of [p_obj, x, y, w, h, class] per scale.
+        """
+        boxes = torch.tensor(bboxes, dtype=torch.float64).reshape(-1, 5)
+        targets = encode_targets(boxes, torch.zeros(len(boxes), dtype=torch.long), 1, self.anchors, self.S,
+                                 self.ignore_iou_thresh)
+        return tuple(target[0] for target in targets)
+
+
+def encode_targets(boxes, batch_idx, batch_size, anchors, S=[13, 26, 52], ignore_iou_thresh=0.5):
+    """
+    Vectorized target encoding of a whole batch (runs on the device of the boxes).
+
+    Every box is assigned, on every scale, to the anchor with the highest IoU whose slot (anchor, cell) is free.
+    The other free anchors of the scale with IoU > ignore_iou_thresh are marked -1 (ignored). When several boxes
+    fall in the same cell of a scale, they are processed in their order in the batch (same result as walking the
+    boxes one by one): the boxes are ranked within their cell and each round assigns the boxes of one rank.
+
+    Parameters:
+        boxes (tensor): (M, 5) boxes [x, y, w, h, class] relative to the image, of all the images of the batch
+        batch_idx (tensor): (M,) index of the image of every box
+        batch_size (int): number of images
+        anchors (tensor): (num_scales * num_anchors_per_scale, 2) anchors of all the scales, relative to the image
+        S (list): grid size of every scale
+
+    Returns:
+        list: one (batch_size, num_anchors_per_scale, S, S, 6) tensor of [p_obj, x, y, w, h, class] per scale
+    """
+    device = boxes.device
+    anchors = anchors.to(device)
+    num_anchors_per_scale = len(anchors) // len(S)
+    targets = [torch.zeros((batch_size, num_anchors_per_scale, s, s, 6), device=device) for s in S]
+    if len(boxes) == 0:
+        return targets
+
+    batch_idx = batch_idx.to(device)
+    ious = iou(boxes[:, None, 2:4].float(), anchors[None].float())  # (M, num anchors)
+
+    for scale_idx, s in enumerate(S):
+        target = targets[scale_idx]
+        scale_ious = ious[:, scale_idx * num_anchors_per_scale:(scale_idx + 1) * num_anchors_per_scale]
+        anchor_order = scale_ious.argsort(descending=True, dim=1)
+        # which cell (boxes on the border belong to the last cell)
+        i = (s * boxes[:, 1]).long().clamp(max=s - 1)
+        j = (s * boxes[:, 0]).long().clamp(max=s - 1)
+
+        # Rank of every box among the boxes of the same image and cell
+        cell = (batch_idx * s + i) * s + j
+        sorted_cell, order = torch.sort(cell, stable=True)
+        first = torch.searchsorted(sorted_cell, sorted_cell)
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(len(order), device=device) - first
+
+        for r in range(int(rank.max()) + 1):
+            k = torch.nonzero(rank == r).squeeze(1)
+            b, ci, cj = batch_idx[k, None], i[k, None], j[k, None]
+            candidates = anchor_order[k]  # (n, num_anchors_per_scale) by decreasing IoU
+            free = target[b, candidates, ci, cj, 0] == 0
+
+            # The first free anchor gets the box
+            has_free = free.any(dim=1)
+            first_free = free.int().argmax(dim=1)
+            chosen = candidates[torch.arange(len(k), device=device), first_free][has_free]
+            kb = k[has_free]
+            box = boxes[kb]
+            target[batch_idx[kb], chosen, i[kb], j[kb]] = torch.stack((
+                torch.ones_like(box[:, 0]),
+                s * box[:, 0] - j[kb],  # both between [0,1] since they are the value within the cell
+                s * box[:, 1] - i[kb],
+                box[:, 2] * s,  # can be greater than 1 since it's relative to cell
+                box[:, 3] * s,
+                box[:, 4].trunc(),
+            ), dim=1).to(target.dtype)
+
+            # The following free anchors with a high IoU are ignored
+            after_first = torch.arange(num_anchors_per_scale, device=device)[None] > first_free[:, None]
+            high_iou = torch.gather(scale_ious[k], 1, candidates) > ignore_iou_thresh
+            ignore = free & after_first & high_iou
+            rows, cols = torch.nonzero(ignore, as_tuple=True)
+            target[batch_idx[k[rows]], candidates[rows, cols], i[k[rows]], j[k[rows]], 0] = -1
+
+    return targets
+
+
+def _build_targets_loop(dataset, bboxes):
+    # Reference: target encoding walking every box and anchor (previous YOLODataset.__getitem__)
+    targets = [torch.zeros((dataset.num_anchors_per_scale, S, S, 6)) for S in dataset.S]
+    for box in bboxes:
+        iou_anchors = iou(torch.tensor(box[2:4]), dataset.anchors)
+        anchor_indices = iou_anchors.argsort(descending=True, dim=0)
+        x, y, width, height, class_label = box
+        has_anchor = [False] * len(dataset.S)
+        for anchor_idx in anchor_indices:
+            scale_idx = anchor_idx // dataset.num_anchors_per_scale
+            anchor_on_scale = anchor_idx % dataset.num_anchors_per_scale
+            S = dataset.S[scale_idx]
+            i, j = int(S * y), int(S * x)
+            anchor_taken = targets[scale_idx][anchor_on_scale, i, j, 0]
+            if not anchor_taken and not has_anchor[scale_idx]:
+                targets[scale_idx][anchor_on_scale, i, j, 0] = 1
+                targets[scale_idx][anchor_on_scale, i, j, 1:5] = torch.tensor([S * x - j, S * y - i, width * S, height * S])
+                targets[scale_idx][anchor_on_scale, i, j, 5] = int(class_label)
+                has_anchor[scale_idx] = True
+            elif not anchor_taken and iou_anchors[anchor_idx] > dataset.ignore_iou_thresh:
+                targets[scale_idx][anchor_on_scale, i, j, 0] = -1
+    return tuple(targets)
+
+
+def check_encode_targets(num_images=200, anchors=config.ANCHORS, S=config.S):
+    """Checks encode_targets against the reference loop, with many boxes sharing cells"""
+    dataset = YOLODataset.__new__(YOLODataset)
+    dataset.S = S
+    dataset.anchors = torch.tensor([anchor for scale_anchors in anchors for anchor in scale_anchors])
+    dataset.num_anchors = dataset.anchors.shape[0]
+    dataset.num_anchors_per_scale = dataset.num_anchors // len(S)
+    dataset.ignore_iou_thresh = 0.5
+
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(num_images):
+        n = rng.integers(0, 40)
+        centers = rng.uniform(0, 1, (n, 2)) if rng.random() < 0.5 else rng.uniform(0.45, 0.55, (n, 2))
+        sizes = rng.choice(np.array(anchors).reshape(-1, 2), n) * rng.uniform(0.7, 1.3, (n, 2))
+        images.append(np.column_stack((centers, sizes, rng.integers(0, 20, n))).tolist())
+
+    for bboxes in images:
+        for expected, encoded in zip(_build_targets_loop(dataset, bboxes), dataset.build_targets(bboxes)):
+            assert torch.equal(expected, encoded)
+
+    boxes = torch.tensor([box for bboxes in images for box in bboxes], dtype=torch.float64)
+    batch_idx = torch.tensor([b for b, bboxes in enumerate(images) for _ in bboxes])
+    start = time.perf_counter()
+    batch_targets = encode_targets(boxes, batch_idx, num_images, dataset.anchors, dataset.S)
+    print(f"Encoded {len(boxes)} boxes of {num_images} images in {(time.perf_counter() - start) * 1000:.1f} ms")
+    for b, bboxes in enumerate(images):
+        for expected, encoded in zip(_build_targets_loop(dataset, bboxes), batch_targets):
+            assert torch.equal(expected, encoded[b])
+    print("Target encoding matches the loop")
 
 
 def test():
@@ -148,4 +284,6 @@ def test():
 
 
 if __name__ == "__main__":
+    check_encode_targets()
+    check_encode_targets(anchors=config.TINY_ANCHORS, S=config.TINY_S)
     test()
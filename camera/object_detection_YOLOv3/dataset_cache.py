@@ -0,0 +1,165 @@
+"""
+Preprocessing / caching layer for YOLODataset.
+
+    - LabelIndex: parses the csv and every label file once into flat arrays (image and label paths, boxes of
+      all the images concatenated, offsets of the boxes of every image) saved as a .npz file, instead of
+      reading the csv row with pandas and parsing the label file with np.loadtxt on every access.
+    - ImageStore: decodes and resizes every image once into a memory-mapped uint8 .npy file, so that the
+      DataLoader workers only read pixels (shared through the page cache) instead of decoding files.
+
+The caches are rebuilt automatically when the csv or a label file is newer than the cache, delete the cache
+folder to force a rebuild (e.g. after replacing images).
+"""
+
+import cv2
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+def _cache_name(*parts):
+    # Short name identifying the dataset split, so that train and test caches don't collide
+    return hashlib.md5("|".join(os.path.abspath(p) for p in parts).encode()).hexdigest()[:12]
+
+
+def _latest_mtime(paths):
+    return max((os.path.getmtime(p) for p in paths if os.path.exists(p)), default=0.0)
+
+
+def read_label_file(label_path):
+    """
+    Reads a YOLO label file ([class, x, y, w, h] per line).
+    Returns:
+        (n, 5) array of [x, y, w, h, class] (empty if the file is missing or empty)
+    """
+    if not os.path.exists(label_path) or os.path.getsize(label_path) == 0:
+        return np.zeros((0, 5))
+    labels = np.loadtxt(fname=label_path, delimiter=" ", ndmin=2)
+    return np.roll(labels, 4, axis=1)
+
+
+class LabelIndex:
+    """
+    All the annotations of a csv file ([image file, label file] per row) in flat arrays:
+        image_paths, label_paths: (N,) arrays of paths
+        boxes: (num_boxes, 5) array of [x, y, w, h, class] of all the images
+        offsets: (N + 1,) array, the boxes of image i are boxes[offsets[i]:offsets[i+1]]
+    """
+
+    def __init__(self, image_paths, label_paths, boxes, offsets):
+        self.image_paths = np.asarray(image_paths)
+        self.label_paths = np.asarray(label_paths)
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 5)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def image_boxes(self, index):
+        """(n, 5) array of [x, y, w, h, class] of one image"""
+        return self.boxes[self.offsets[index]:self.offsets[index + 1]]
+
+    @classmethod
+    def build(cls, csv_file, img_dir, label_dir, workers=8):
+        annotations = pd.read_csv(csv_file)
+        image_paths = [os.path.join(img_dir, f) for f in annotations.iloc[:, 0]]
+        label_paths = [os.path.join(label_dir, f) for f in annotations.iloc[:, 1]]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            labels = list(pool.map(read_label_file, label_paths))
+        offsets = np.concatenate(([0], np.cumsum([len(l) for l in labels])))
+        boxes = np.concatenate(labels) if len(labels) > 0 else np.zeros((0, 5))
+        return cls(image_paths, label_paths, boxes, offsets)
+
+    def save(self, path):
+        np.savez(path, image_paths=self.image_paths, label_paths=self.label_paths, boxes=self.boxes,
+                 offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["image_paths"], data["label_paths"], data["boxes"], data["offsets"])
+
+    @classmethod
+    def cached(cls, csv_file, img_dir, label_dir, cache_dir):
+        """
+        Loads the index from cache_dir, (re)building it if missing or older than the csv or the label files.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f"labels_{_cache_name(csv_file, img_dir, label_dir)}.npz")
+        if os.path.exists(path):
+            index = cls.load(path)
+            cache_time = os.path.getmtime(path)
+            if cache_time >= os.path.getmtime(csv_file) and cache_time >= _latest_mtime(index.label_paths):
+                return index
+
+        print(f"=> Building label index of {csv_file}")
+        index = cls.build(csv_file, img_dir, label_dir)
+        index.save(path)
+        return index
+
+
+def load_resized_image(image_path, size):
+    """Decodes an image as RGB and resizes it so that its longest side is size (keeps the aspect ratio)"""
+    image = np.array(Image.open(image_path).convert("RGB"))
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+    if (new_width, new_height) != (width, height):
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        image = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+    return image
+
+
+class ImageStore:
+    """
+    Decoded images, resized to longest side `size`, stored in a memory-mapped (N, size, size, 3) uint8 .npy
+    file (image i occupies the top left corner [:height, :width], the shapes are stored next to it).
+    Boxes in YOLO format are relative to the image, so they are unaffected by the resize.
+    """
+
+    def __init__(self, image_paths, size, cache_dir, workers=8):
+        os.makedirs(cache_dir, exist_ok=True)
+        name = _cache_name(*image_paths)
+        self.path = os.path.join(cache_dir, f"images_{name}_{size}.npy")
+        self.shapes_path = os.path.join(cache_dir, f"images_{name}_{size}_shapes.npy")
+        self.size = size
+        self.images = None  # opened lazily, in every DataLoader worker
+
+        if not os.path.exists(self.shapes_path) or os.path.getmtime(self.shapes_path) < _latest_mtime(image_paths):
+            self._build(image_paths, workers)
+        self.shapes = np.load(self.shapes_path)
+
+    def _build(self, image_paths, workers):
+        print(f"=> Caching {len(image_paths)} images to {self.path}")
+        images = np.lib.format.open_memmap(self.path + ".tmp", mode="w+", dtype=np.uint8,
+                                           shape=(len(image_paths), self.size, self.size, 3))
+        shapes = np.zeros((len(image_paths), 2), dtype=np.int32)
+
+        def store(i):
+            image = load_resized_image(image_paths[i], self.size)
+            images[i, :image.shape[0], :image.shape[1]] = image
+            shapes[i] = image.shape[:2]
+
+        # Decoding (PIL) and resizing (OpenCV) release the GIL
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(store, range(len(image_paths))))
+
+        images.flush()
+        del images
+        os.replace(self.path + ".tmp", self.path)
+        # Shapes are written last: they mark the store as complete
+        np.save(self.shapes_path, shapes)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.load(self.path, mmap_mode="r")
+        height, width = self.shapes[index]
+        # Copy out of the memory map, the transforms write into the image
+        return np.array(self.images[index, :height, :width])
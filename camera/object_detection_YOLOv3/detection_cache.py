@@ -0,0 +1,159 @@
+"""
+Persistent cache of the detections, for the recorded procedures that are reviewed several times (live camera frames
+are never seen twice and are not cached).
+
+The boxes of a frame are stored once per (model, frame, NMS IoU threshold), computed with a low confidence threshold
+(min_conf): the NMS is greedy in decreasing confidence, so the boxes kept at a higher conf_threshold are exactly the
+cached boxes above it, and a replay at any conf_threshold >= min_conf is served without running the network.
+    - model: hash of the checkpoint / exported model file (model_fingerprint), a retrained model gets new entries
+    - frame: video (or image) file + frame index (video_key, no hashing of the pixels)
+The entries are kept in a SQLite file (boxes as float32 blobs), the least recently used ones are evicted beyond
+max_entries.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+
+
+def model_fingerprint(model_file, chunk_size=1 << 20):
+    """Hash of the content of a model file (checkpoint, TorchScript or ONNX)"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(model_file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def video_key(video_path, frame_index):
+    """Key of a frame of a video (or image) file, the file is identified by its path, size and modification time"""
+    stat = os.stat(video_path)
+    return f"video:{os.path.abspath(video_path)}:{stat.st_size}:{int(stat.st_mtime)}:{frame_index}"
+
+
+def filter_boxes(boxes, conf_threshold):
+    """Boxes [class_pred, conf, x, y, width, height] above conf_threshold (same comparison as batched_nms)"""
+    return [box for box in boxes if box[1] > conf_threshold]
+
+
+class DetectionCache:
+    """
+    Inputs:
+        path: SQLite file of the cache
+        model_id: model the detections come from (model_fingerprint of its file)
+        min_conf: confidence threshold the cached boxes are computed with, the lowest threshold that can be served
+        max_entries: frames kept, the least recently used are evicted
+    Usage:
+        boxes = cache.get(key, conf_threshold, iou_threshold)
+        if boxes is None:
+            boxes = ... detections with threshold cache.min_conf ...
+            cache.put(key, boxes, iou_threshold)
+            boxes = filter_boxes(boxes, conf_threshold)
+    """
+
+    def __init__(self, path, model_id, min_conf=0.05, max_entries=200_000):
+        self.path = path
+        self.model_id = model_id
+        self.min_conf = min_conf
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Used from the inference threads of streaming.py / batch_inference.py
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS detections (key BLOB PRIMARY KEY, boxes BLOB NOT NULL, used INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS detections_used ON detections (used)")
+        self._count, last_used = self._db.execute("SELECT COUNT(*), MAX(used) FROM detections").fetchone()
+        self._clock = last_used or 0
+
+    def _key(self, key, iou_threshold):
+        return hashlib.blake2b(f"{self.model_id}|{key}|{self.min_conf:g}|{iou_threshold:g}".encode(),
+                               digest_size=16).digest()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get(self, key, conf_threshold, iou_threshold):
+        """Cached boxes of a frame above conf_threshold, or None if the frame isn't cached"""
+        if conf_threshold < self.min_conf:
+            return None
+        db_key = self._key(key, iou_threshold)
+        with self._lock:
+            row = self._db.execute("SELECT boxes FROM detections WHERE key = ?", (db_key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE detections SET used = ? WHERE key = ?", (self._tick(), db_key))
+        boxes = np.frombuffer(row[0], dtype=np.float32).reshape(-1, 6)
+        return filter_boxes(boxes.tolist(), conf_threshold)
+
+    def put(self, key, boxes, iou_threshold):
+        """Stores the boxes [class_pred, conf, x, y, width, height] of a frame, computed with conf min_conf"""
+        blob = np.asarray(boxes, dtype=np.float32).reshape(-1, 6).tobytes()
+        db_key = self._key(key, iou_threshold)
+        with self._lock:
+            inserted = self._db.execute("SELECT 1 FROM detections WHERE key = ?", (db_key,)).fetchone() is None
+            self._db.execute("INSERT OR REPLACE INTO detections VALUES (?, ?, ?)", (db_key, blob, self._tick()))
+            self._count += inserted
+            if self._count > self.max_entries:
+                # Evicts 10% more than needed, so that eviction doesn't run at every insertion
+                excess = self._count - int(self.max_entries * 0.9)
+                self._db.execute(
+                    "DELETE FROM detections WHERE key IN (SELECT key FROM detections ORDER BY used LIMIT ?)", (excess,))
+                self._count -= excess
+            self._db.commit()
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+    import torch
+    from utils import non_max_suppression
+
+    # Boxes cached at min_conf and filtered at a higher threshold == NMS run at that threshold
+    rng = np.random.default_rng(0)
+    predictions = torch.tensor(np.column_stack((
+        rng.integers(0, 3, 300), rng.random(300), rng.uniform(0.2, 0.8, (300, 2)), rng.uniform(0.05, 0.3, (300, 2)),
+    )), dtype=torch.float32)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DetectionCache(os.path.join(directory, "detections.sqlite"), "model", min_conf=0.05, max_entries=10)
+        key = video_key(__file__, 100)
+        assert cache.get(key, 0.5, 0.5) is None
+        cache.put(key, non_max_suppression(predictions, 0.5, cache.min_conf, box_format="midpoint").tolist(), 0.5)
+        for conf_threshold in (0.05, 0.3, 0.6, 0.9):
+            expected = non_max_suppression(predictions, 0.5, conf_threshold, box_format="midpoint").numpy()
+            assert np.allclose(np.array(cache.get(key, conf_threshold, 0.5)).reshape(-1, 6), expected)
+        assert cache.get(key, 0.5, 0.45) is None  # other NMS IoU threshold
+        assert cache.get(key, 0.01, 0.5) is None  # below min_conf
+
+        # LRU eviction: the frame read again stays, the oldest ones go
+        for i in range(12):
+            cache.put(video_key(__file__, i), [[0, 0.9, 0.5, 0.5, 0.1, 0.1]], 0.5)
+            cache.get(key, 0.5, 0.5)
+        assert len(cache) <= 10 and cache.get(key, 0.5, 0.5) is not None
+        assert cache.get(video_key(__file__, 0), 0.5, 0.5) is None
+        assert np.allclose(cache.get(video_key(__file__, 11), 0.5, 0.5), [[0, 0.9, 0.5, 0.5, 0.1, 0.1]])
+        cache.close()
+
+        # Persistent: a new cache on the same file serves the frame
+        cache = DetectionCache(os.path.join(directory, "detections.sqlite"), "model", min_conf=0.05, max_entries=10)
+        assert cache.get(key, 0.5, 0.5) is not None and len(cache) <= 10
+        assert DetectionCache(os.path.join(directory, "detections.sqlite"), "other model").get(key, 0.5, 0.5) is None
+        cache.close()
+    print("Success!")
@@ -0,0 +1,66 @@
+"""
+Exports a trained YOLOv3 / YOLOv3Tiny for the inference runtimes of realtime.py (RUNTIME in config.py):
+    - onnx: ONNX model with a dynamic batch axis, for ONNX Runtime
+    - torchscript: traced and frozen TorchScript of the fused model (see inference.py)
+The exported model takes (N, 3, IMAGE_SIZE, IMAGE_SIZE) float images and returns one (N, 3, S, S, 5 + num_classes)
+tensor per scale, as the PyTorch model.
+
+Usage:
+    python export.py --format onnx --checkpoint checkpoint.pth.tar --out model.onnx
+"""
+
+import argparse
+import torch
+
+import config
+from inference import prepare_for_inference
+
+
+def export_onnx(model, path, image_size=config.IMAGE_SIZE, opset=17):
+    """Writes the fused model to ONNX, with a dynamic batch axis on the input and on every output"""
+    model = prepare_for_inference(model.cpu(), channels_last=False, backend="eager")
+    example_input = torch.zeros(1, 3, image_size, image_size)
+    with torch.no_grad():
+        num_outputs = len(model(example_input))
+    output_names = [f"scale_{i}" for i in range(num_outputs)]
+    dynamic_axes = {name: {0: "batch"} for name in ["images"] + output_names}
+    torch.onnx.export(model, (example_input,), path, input_names=["images"], output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False)
+    return output_names
+
+
+def export_torchscript(model, path, image_size=config.IMAGE_SIZE):
+    """Writes the fused, traced and frozen model to TorchScript"""
+    example_input = torch.zeros(1, 3, image_size, image_size, device=next(model.parameters()).device)
+    model = prepare_for_inference(model, channels_last=config.CHANNELS_LAST, backend="eager")
+    # Frozen but not optimize_for_inference: the MKLDNN graph it creates can't be serialized
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(model, example_input))
+    torch.jit.save(scripted, path)
+
+
+if __name__ == "__main__":
+    from YOLOv3 import YOLOv3
+    from YOLOv3Tiny import YOLOv3Tiny
+
+    parser = argparse.ArgumentParser(description="Export YOLOv3 / YOLOv3Tiny for realtime.py")
+    parser.add_argument("--format", default="onnx", choices=["onnx", "torchscript"])
+    parser.add_argument("--checkpoint", default=config.CHECKPOINT_FILE)
+    parser.add_argument("--model", default=config.MODEL, choices=["YOLOv3", "YOLOv3Tiny"],
+                        help="architecture of the checkpoint (default MODEL of config.py)")
+    parser.add_argument("--out", default=None, help="output file (default ONNX_MODEL / TORCHSCRIPT_MODEL of config.py)")
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    model_class = YOLOv3Tiny if args.model == "YOLOv3Tiny" else YOLOv3
+    model = model_class(num_classes=config.NUM_CLASSES)
+    model.load_state_dict(torch.load(args.checkpoint, map_location="cpu")["state_dict"])
+    model.eval()
+
+    if args.format == "onnx":
+        out = args.out or config.ONNX_MODEL
+        export_onnx(model, out, opset=args.opset)
+    else:
+        out = args.out or config.TORCHSCRIPT_MODEL
+        export_torchscript(model, out)
+    print(f"=> Exported {args.format} model to {out}")
@@ -0,0 +1,169 @@
+"""
+Prepares a trained YOLOv3 / YOLOv3Tiny for inference (realtime.py):
+    - folds every BatchNorm2d into the weights and bias of the preceding Conv2d (in eval mode BN is a fixed
+      per channel affine transform, so conv + bn is one conv)
+    - runs the LeakyReLU in place on the conv output
+    - converts weights (and inputs) to channels_last, faster for convolutions on recent CPUs and on tensor cores
+    - optionally compiles the result: "script" (traced and frozen TorchScript, which also fuses the
+      activations where the backend can) or "compile" (torch.compile)
+
+Run this file to check the prepared model against the original one and compare CPU latencies:
+    python inference.py --checkpoint checkpoint.pth.tar --backend script
+"""
+
+import argparse
+import copy
+import time
+import torch
+import torch.nn as nn
+
+import config
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    Returns a Conv2d computing bn(conv(x)) with the running statistics of bn (eval mode).
+    """
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                      conv.dilation, conv.groups, bias=True).to(conv.weight.device)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    with torch.no_grad():
+        fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+def fuse_model(model):
+    """
+    Copy of the model with every Conv2d followed by a BatchNorm2d (CNNBlock of YOLOv3, ConvBlock of YOLOv3Tiny)
+    replaced by a single Conv2d, and in place LeakyReLUs. The original model is left untouched.
+    """
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        # CNNBlock: conv, bn and leaky attributes
+        if isinstance(getattr(module, "conv", None), nn.Conv2d) and isinstance(getattr(module, "bn", None), nn.BatchNorm2d):
+            if getattr(module, "use_bn_act", True):
+                module.conv = fuse_conv_bn(module.conv, module.bn)
+                module.bn = nn.Identity()
+        # ConvBlock: nn.Sequential(conv, bn, leaky)
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                    module[i] = fuse_conv_bn(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
+        if isinstance(module, nn.LeakyReLU):
+            module.inplace = True
+    return model
+
+
+class InferenceModel(nn.Module):
+    """Model wrapper converting the input to the memory format of the weights"""
+
+    def __init__(self, model, channels_last=True):
+        super().__init__()
+        self.model = model
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.model(x)
+
+
+def prepare_for_inference(model, channels_last=True, backend="eager", example_input=None):
+    """
+    Fused, eval mode copy of the model for inference.
+    Inputs:
+        model: trained YOLOv3 or YOLOv3Tiny
+        channels_last: use the channels_last memory format
+        backend: "eager" (fused module), "script" (traced and frozen TorchScript) or "compile" (torch.compile)
+        example_input: input used to trace the model for "script" (default one IMAGE_SIZE image on the model device)
+    Returns:
+        callable with the same inputs and outputs as the model
+    """
+    device = next(model.parameters()).device
+    prepared = InferenceModel(fuse_model(model), channels_last).eval()
+    if channels_last:
+        prepared = prepared.to(memory_format=torch.channels_last)
+
+    if backend == "script":
+        if example_input is None:
+            example_input = torch.randn(1, 3, config.IMAGE_SIZE, config.IMAGE_SIZE, device=device)
+        with torch.no_grad():
+            traced = torch.jit.trace(prepared, example_input)
+            prepared = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    elif backend == "compile":
+        prepared = torch.compile(prepared, mode="max-autotune")
+    elif backend != "eager":
+        raise ValueError(f"Unknown backend {backend}")
+    return prepared
+
+
+def _as_list(outputs):
+    return [outputs] if torch.is_tensor(outputs) else list(outputs)
+
+
+@torch.no_grad()
+def check_parity(reference, prepared, x, atol=1e-3):
+    """
+    Largest absolute difference between the outputs of the two models (every scale) on x.
+    Returns:
+        max difference, True if below atol
+    """
+    reference_out = _as_list(reference(x))
+    prepared_out = _as_list(prepared(x))
+    max_diff = max((a.float() - b.float()).abs().max().item() for a, b in zip(reference_out, prepared_out))
+    return max_diff, max_diff <= atol
+
+
+@torch.no_grad()
+def benchmark(model, x, runs=20, warmup=3):
+    """Mean latency of model(x) in milliseconds"""
+    for _ in range(warmup):
+        model(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(runs):
+        model(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+if __name__ == "__main__":
+    from YOLOv3 import YOLOv3
+    from YOLOv3Tiny import YOLOv3Tiny
+
+    parser = argparse.ArgumentParser(description="Fuse a YOLOv3 model for inference, check parity and latency")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint to load (random weights if not given)")
+    parser.add_argument("--model", default=config.MODEL, choices=["YOLOv3", "YOLOv3Tiny"],
+                        help="architecture of the checkpoint (default MODEL of config.py)")
+    parser.add_argument("--backend", default="eager", choices=["eager", "script", "compile"])
+    parser.add_argument("--no-channels-last", action="store_true")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    model_class = YOLOv3Tiny if args.model == "YOLOv3Tiny" else YOLOv3
+    model = model_class(num_classes=config.NUM_CLASSES)
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location="cpu")["state_dict"])
+    else:
+        # Random running statistics, so that folding the BatchNorms is actually checked
+        for module in model.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.1, 0.1)
+                module.running_var.uniform_(0.5, 2.0)
+    model.eval()
+
+    x = torch.rand(1, 3, config.IMAGE_SIZE, config.IMAGE_SIZE)
+    prepared = prepare_for_inference(model, channels_last=not args.no_channels_last, backend=args.backend, example_input=x)
+
+    max_diff, ok = check_parity(model, prepared, x)
+    print(f"Parity: max abs difference {max_diff:.2e} ({'ok' if ok else 'MISMATCH'})")
+
+    reference_ms = benchmark(model, x, args.runs)
+    prepared_ms = benchmark(prepared, x, args.runs)
+    print(f"CPU latency: unfused {reference_ms:.1f} ms, prepared ({args.backend}) {prepared_ms:.1f} ms, "
+          f"speedup {reference_ms / prepared_ms:.2f}x")
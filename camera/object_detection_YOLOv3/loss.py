@@ -2,10 +2,16 @@
 Implementation of Yolo Loss Function similar to the one in Yolov3 paper,
 the difference from what I can tell is I use CrossEntropy for the classes
 instead of BinaryCrossEntropy.
+
+The loss takes the predictions and targets of all the scales in one call: the cells with an object are
+gathered once from every scale and the four components are computed on them together, the no object
+loss is a masked reduction over all the cells. Every component is still the mean over the cells of a
+scale, summed over the scales, as when the loss was called once per scale. Inputs are never modified
+(the targets can be reused) and the components are computed in float32 under autocast.
 """
-import random
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from utils import intersection_over_union
 
@@ -13,32 +19,54 @@ from utils import intersection_over_union
 class YoloLoss(nn.Module):
     def __init__(self):
         super().__init__()
-        self.mse = nn.MSELoss()
-        self.bce = nn.BCEWithLogitsLoss()
-        self.entropy = nn.CrossEntropyLoss()
-        self.sigmoid = nn.Sigmoid()
-
         # Constants signifying how much to pay for each respective part of the loss
         self.lambda_class = 1
         self.lambda_noobj = 10
         self.lambda_obj = 1
         self.lambda_box = 10
 
-    # We are going to call this 3 times for each passs since we have 3 scales
-    def forward(self, predictions, target, anchors):
-        # Check where obj and noobj (we ignore if target == -1)
-        obj = target[..., 0] == 1  # in paper this is Iobj_i
-        noobj = target[..., 0] == 0  # in paper this is Inoobj_i
+    def forward(self, predictions, targets, anchors):
+        """
+        Inputs:
+            predictions: list of (N, 3, S, S, 5 + num_classes) model outputs, one per scale
+                         (or a single scale tensor)
+            targets: list of (N, 3, S, S, 6) targets [obj, x, y, w, h, class], one per scale
+            anchors: (num_scales, 3, 2) anchors scaled to the grid of every scale
+        Returns:
+            total loss, dict of the weighted components (detached) for logging
+        """
+        if torch.is_tensor(predictions):
+            predictions, targets, anchors = [predictions], [targets], anchors.reshape(1, 3, 2)
+
+        obj_preds, obj_targets, obj_anchors, obj_weights = [], [], [], []
+        no_object_loss = 0.0
+        for scale_preds, scale_target, scale_anchors in zip(predictions, targets, anchors):
+            # Check where obj and noobj (we ignore if target == -1)
+            obj = scale_target[..., 0] == 1  # in paper this is Iobj_i
+            noobj = scale_target[..., 0] == 0  # in paper this is Inoobj_i
+
+            # ======================= #
+            #   FOR NO OBJECT LOSS    #
+            # ======================= #
+            """This is the loss incurred when the model predicts the absence of an object at a certain location where there actually is no object. 
+            This loss is calculated using binary cross-entropy (BCE) between the predicted probability of no object and the true label (which is 0 in this case),
+            BCE with logits against 0 is softplus(logit)."""
 
-        # ======================= #
-        #   FOR NO OBJECT LOSS    #
-        # ======================= #
-        """This is the loss incurred when the model predicts the absence of an object at a certain location where there actually is no object. 
-        This loss is calculated using binary cross-entropy (BCE) between the predicted probability of no object and the true label (which is 0 in this case)."""
+            noobj_count = noobj.sum().clamp(min=1)
+            no_object_loss = no_object_loss + torch.where(noobj, F.softplus(scale_preds[..., 0].float()), 0.0).sum() / noobj_count
 
-        no_object_loss = self.bce(
-            (predictions[..., 0:1][noobj]), (target[..., 0:1][noobj]),
-        )
+            # Gather the cells with an object, with the anchor of each one
+            index = obj.nonzero(as_tuple=True)
+            obj_preds.append(scale_preds[index].float())
+            obj_targets.append(scale_target[index].float())
+            obj_anchors.append(scale_anchors[index[1]].float())
+            obj_weights.append(torch.full((len(index[0]),), 1.0, device=scale_target.device) / max(len(index[0]), 1))
+
+        obj_preds = torch.cat(obj_preds)
+        obj_targets = torch.cat(obj_targets)
+        obj_anchors = torch.cat(obj_anchors)
+        # Weight of every cell: the mean over the cells of its scale
+        obj_weights = torch.cat(obj_weights)
 
         # ==================== #
         #   FOR OBJECT LOSS    #
@@ -47,23 +75,21 @@ class YoloLoss(nn.Module):
         This loss is calculated using mean squared error (MSE) between the predicted probability of objectness and the intersection over union (IoU) of the predicted bounding box 
         with the true bounding box."""
 
-        anchors = anchors.reshape(1, 3, 1, 1, 2)
-        box_preds = torch.cat([self.sigmoid(predictions[..., 1:3]), torch.exp(predictions[..., 3:5]) * anchors], dim=-1)
-        ious = intersection_over_union(box_preds[obj], target[..., 1:5][obj]).detach()
-        object_loss = self.mse(self.sigmoid(predictions[..., 0:1][obj]), ious * target[..., 0:1][obj])
+        xy_preds = torch.sigmoid(obj_preds[:, 1:3])
+        box_preds = torch.cat([xy_preds, torch.exp(obj_preds[:, 3:5]) * obj_anchors], dim=-1)
+        ious = intersection_over_union(box_preds, obj_targets[:, 1:5]).detach().squeeze(-1)
+        object_loss = (obj_weights * (torch.sigmoid(obj_preds[:, 0]) - ious * obj_targets[:, 0]) ** 2).sum()
 
         # ======================== #
         #   FOR BOX COORDINATES    #
         # ======================== #
         """This is the loss incurred when the model predicts the bounding box coordinates of an object. This loss is also calculated using MSE between the predicted bounding box 
-        coordinates and the true bounding box coordinates.
+        coordinates and the true bounding box coordinates (x, y after sigmoid, w, h in log space relative to the anchor).
         """
 
-        predictions[..., 1:3] = self.sigmoid(predictions[..., 1:3])  # x,y coordinates
-        target[..., 3:5] = torch.log(
-            (1e-16 + target[..., 3:5] / anchors)
-        )  # width, height coordinates
-        box_loss = self.mse(predictions[..., 1:5][obj], target[..., 1:5][obj])
+        box_targets = torch.cat([obj_targets[:, 1:3], torch.log(1e-16 + obj_targets[:, 3:5] / obj_anchors)], dim=-1)
+        box_errors = torch.cat([xy_preds, obj_preds[:, 3:5]], dim=-1) - box_targets
+        box_loss = (obj_weights * (box_errors ** 2).mean(dim=-1)).sum()
 
         # ================== #
         #   FOR CLASS LOSS   #
@@ -71,20 +97,13 @@ class YoloLoss(nn.Module):
         """ This is the loss incurred when the model predicts the wrong class label for an object. This loss is calculated using cross-entropy between the predicted class 
         probabilities and the true class label."""
 
-        class_loss = self.entropy(
-            (predictions[..., 5:][obj]), (target[..., 5][obj].long()),
-        )
-
-        #print("__________________________________")
-        #print(self.lambda_box * box_loss)
-        #print(self.lambda_obj * object_loss)
-        #print(self.lambda_noobj * no_object_loss)
-        #print(self.lambda_class * class_loss)
-        #print("\n")
-
-        return (
-            self.lambda_box * box_loss
-            + self.lambda_obj * object_loss
-            + self.lambda_noobj * no_object_loss
-            + self.lambda_class * class_loss
-        )
+        class_loss = (obj_weights * F.cross_entropy(obj_preds[:, 5:], obj_targets[:, 5].long(), reduction="none")).sum()
+
+        components = {
+            "box": self.lambda_box * box_loss,
+            "object": self.lambda_obj * object_loss,
+            "no_object": self.lambda_noobj * no_object_loss,
+            "class": self.lambda_class * class_loss,
+        }
+        total = sum(components.values())
+        return total, {name: value.detach() for name, value in components.items()}
@@ -0,0 +1,241 @@
+"""
+Packs a YOLO dataset (images/<split>, labels/<split>, as data/formatted_bronchoscopy) into a few large shards so that
+training doesn't decode thousands of small PNGs from disk every epoch. The images are letterboxed with the geometry of
+preprocess.letterbox_geometry (the one used at inference), set PACKED_DATASET in config.py to train on the shards.
+
+Layout of the packed dataset (in <dataset>/packed by default):
+    <split>_000.npy, <split>_001.npy, ...  (n, size, size, 3) uint8 RGB images, letterboxed to size x size
+    <split>_index.npz                       per image: file name, shard, position in the shard, original shape,
+                                            letterbox scale and padding; and the label table (image index, class,
+                                            x, y, w, h relative to the letterboxed image)
+
+PackedDataset memory-maps the shards (random access without opening files) and ShardSampler visits the shards one
+after the other (shuffled within a shard), asking the OS to read the next shard ahead.
+
+Usage:
+    python pack_dataset.py ../data/formatted_bronchoscopy --size 416
+"""
+
+import argparse
+import cv2
+import numpy as np
+import os
+import random
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from torch.utils.data import Dataset, Sampler
+
+import config
+from dataset import encode_targets
+from preprocess import letterbox_geometry
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp"}
+
+
+def letterbox(image, size, pad_value=0):
+    """
+    Resizes the image so that its longest side is size and pads it to size x size (centred).
+    Returns:
+        letterboxed image, scale, (pad_x, pad_y)
+    """
+    scale, (new_width, new_height), (pad_x, pad_y) = letterbox_geometry(image.shape[0], image.shape[1], size)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+    out = np.full((size, size, 3), pad_value, dtype=np.uint8)
+    out[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = resized
+    return out, scale, (pad_x, pad_y)
+
+
+def read_yolo_labels(label_path):
+    """(n, 5) array of [class, x, y, w, h] (empty if the file is missing or empty)"""
+    if not label_path.exists() or label_path.stat().st_size == 0:
+        return np.zeros((0, 5))
+    return np.loadtxt(label_path, ndmin=2).reshape(-1, 5)
+
+
+def pack_split(dataset_dir, split, out_dir, size=config.IMAGE_SIZE, shard_size=2048, workers=8):
+    """
+    Packs images/<split> and labels/<split> of dataset_dir into shards of shard_size images.
+    Images that can't be read are reported and left out of the index (with their labels).
+    Returns:
+        number of packed images
+    """
+    dataset_dir, out_dir = Path(dataset_dir), Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    image_files = sorted(p for p in (dataset_dir / "images" / split).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+    num_images = len(image_files)
+    print(f"Packing {num_images} {split} images into {out_dir}")
+
+    shapes = np.zeros((num_images, 2), dtype=np.int32)
+    scales = np.zeros(num_images, dtype=np.float32)
+    pads = np.zeros((num_images, 2), dtype=np.int32)
+    labels = [None] * num_images
+    readable = np.ones(num_images, dtype=bool)
+
+    for shard, start in enumerate(range(0, num_images, shard_size)):
+        stop = min(start + shard_size, num_images)
+        shard_path = out_dir / f"{split}_{shard:03d}.npy"
+        images = np.lib.format.open_memmap(str(shard_path) + ".tmp", mode="w+", dtype=np.uint8,
+                                           shape=(stop - start, size, size, 3))
+
+        def pack(i):
+            image = cv2.imread(str(image_files[i]))
+            if image is None:
+                print(f"Skipping {image_files[i]}: the image can't be read")
+                readable[i] = False
+                labels[i] = np.zeros((0, 5))
+                return
+            shapes[i] = image.shape[:2]
+            images[i - start], scales[i], pads[i] = letterbox(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), size)
+            boxes = read_yolo_labels(dataset_dir / "labels" / split / f"{image_files[i].stem}.txt")
+            # Boxes relative to the original image -> relative to the letterboxed one
+            height, width = shapes[i]
+            boxes[:, 1] = (boxes[:, 1] * width * scales[i] + pads[i, 0]) / size
+            boxes[:, 2] = (boxes[:, 2] * height * scales[i] + pads[i, 1]) / size
+            boxes[:, 3] = boxes[:, 3] * width * scales[i] / size
+            boxes[:, 4] = boxes[:, 4] * height * scales[i] / size
+            labels[i] = boxes
+
+        # Decoding and resizing release the GIL
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(pack, range(start, stop)))
+        images.flush()
+        del images
+        os.replace(str(shard_path) + ".tmp", shard_path)
+
+    # Unreadable images keep their (empty) slot in the shards but are left out of the index
+    keep = np.flatnonzero(readable)
+    counts = [len(labels[i]) for i in keep]
+    label_table = np.zeros((sum(counts), 6), dtype=np.float32)  # [image index, class, x, y, w, h]
+    if sum(counts) > 0:
+        label_table[:, 0] = np.repeat(np.arange(len(keep)), counts)
+        label_table[:, 1:] = np.concatenate([labels[i] for i in keep if len(labels[i]) > 0])
+
+    np.savez(out_dir / f"{split}_index.npz",
+             files=np.array([image_files[i].name for i in keep]),
+             shard=keep // shard_size,
+             position=keep % shard_size,
+             shapes=shapes[keep], scales=scales[keep], pads=pads[keep], size=size,
+             labels=label_table, offsets=np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+    return len(keep)
+
+
+class PackedDataset(Dataset):
+    """
+    Dataset over the shards written by pack_split.
+    Returns (image, boxes) with the image (size, size, 3) uint8 RGB (after transform if given, an albumentations
+    Compose with yolo bbox_params) and boxes an (n, 5) float tensor of [x, y, w, h, class], the same output as
+    YOLODataset(encode=False).
+    encode: return the targets of every scale instead of the boxes, as YOLODataset (anchors and S needed)
+    """
+
+    def __init__(self, packed_dir, split, transform=None, encode=False, anchors=None, S=[13, 26, 52]):
+        self.packed_dir = Path(packed_dir)
+        self.split = split
+        self.transform = transform
+        self.encode = encode
+        self.S = S
+        if encode:
+            self.anchors = torch.tensor([anchor for scale_anchors in anchors for anchor in scale_anchors])
+        index = np.load(self.packed_dir / f"{split}_index.npz")
+        self.files = index["files"]
+        self.shard = index["shard"]
+        self.position = index["position"]
+        self.shapes = index["shapes"]
+        self.size = int(index["size"])
+        self.labels = index["labels"]
+        self.offsets = index["offsets"]
+        self.num_shards = int(self.shard.max()) + 1 if len(self.shard) > 0 else 0
+        self._shards = {}  # memory maps, opened lazily in every DataLoader worker
+
+    def __len__(self):
+        return len(self.files)
+
+    def shard_path(self, shard):
+        return self.packed_dir / f"{self.split}_{shard:03d}.npy"
+
+    def _get_shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.load(self.shard_path(shard), mmap_mode="r")
+        return self._shards[shard]
+
+    def prefetch(self, shard):
+        """Asks the OS to read a shard ahead (no-op where posix_fadvise isn't available)"""
+        if not hasattr(os, "posix_fadvise") or not 0 <= shard < self.num_shards:
+            return
+        fd = os.open(self.shard_path(shard), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def boxes(self, index):
+        """(n, 5) array of [x, y, w, h, class] of an image, relative to the letterboxed image"""
+        labels = self.labels[self.offsets[index]:self.offsets[index + 1]]
+        return np.roll(labels[:, 1:], 4, axis=1)
+
+    def __getitem__(self, index):
+        # Copy out of the memory map, the transforms write into the image
+        image = np.array(self._get_shard(self.shard[index])[self.position[index]])
+        bboxes = self.boxes(index).tolist()
+
+        if self.transform:
+            augmentations = self.transform(image=image, bboxes=bboxes)
+            image = augmentations["image"]
+            bboxes = augmentations["bboxes"]
+
+        if not self.encode:
+            return image, torch.tensor(bboxes, dtype=torch.float32).reshape(-1, 5)
+
+        boxes = torch.tensor(bboxes, dtype=torch.float64).reshape(-1, 5)
+        targets = encode_targets(boxes, torch.zeros(len(boxes), dtype=torch.long), 1, self.anchors, self.S)
+        return image, tuple(target[0] for target in targets)
+
+
+class ShardSampler(Sampler):
+    """
+    Visits the shards in random order and the images of a shard in random order, so that reads stay within one
+    file at a time, and prefetches the next shard while the current one is used.
+    """
+
+    def __init__(self, dataset, shuffle=True, seed=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+        shards = list(range(self.dataset.num_shards))
+        if self.shuffle:
+            rng.shuffle(shards)
+
+        for k, shard in enumerate(shards):
+            if k + 1 < len(shards):
+                self.dataset.prefetch(shards[k + 1])
+            indices = np.flatnonzero(self.dataset.shard == shard).tolist()
+            if self.shuffle:
+                rng.shuffle(indices)
+            yield from indices
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a YOLO dataset into memory-mappable shards")
+    parser.add_argument("dataset", help="dataset folder with images/<split> and labels/<split>")
+    parser.add_argument("--out", default=None, help="output folder (default <dataset>/packed)")
+    parser.add_argument("--size", type=int, default=config.IMAGE_SIZE, help="letterboxed image size (IMAGE_SIZE of config.py)")
+    parser.add_argument("--shard-size", type=int, default=2048, help="images per shard")
+    parser.add_argument("--splits", nargs="+", default=["train", "val"])
+    args = parser.parse_args()
+
+    out_dir = args.out or os.path.join(args.dataset, "packed")
+    for split in args.splits:
+        pack_split(args.dataset, split, out_dir, args.size, args.shard_size)
+        dataset = PackedDataset(out_dir, split)
+        print(f"{split}: {len(dataset)} images in {dataset.num_shards} shards, {len(dataset.labels)} boxes")
@@ -0,0 +1,120 @@
+"""
+Frame preprocessing for inference, with the geometry of config.test_transforms (LongestMaxSize + centred
+PadIfNeeded, i.e. letterboxing) so that inference sees the images as they were seen in training.
+
+FramePreprocessor resizes the frame directly into a preallocated (pinned on CUDA) uint8 buffer, swaps BGR to RGB
+in place, and converts it to the normalized (1, 3, IMAGE_SIZE, IMAGE_SIZE) float input with a single op
+(HWC -> CHW, uint8 -> float, / 255) writing into a preallocated tensor on the device. No other full frame copy is
+made. The scale and padding are returned to map the predicted boxes back to the frame (boxes_to_frame).
+"""
+
+import cv2
+import numpy as np
+import torch
+
+import config
+
+
+def letterbox_geometry(height, width, size):
+    """Scale, resized (width, height) and (pad_x, pad_y) of a height x width frame letterboxed to size x size"""
+    scale = size / max(height, width)
+    new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+    pad_x, pad_y = (size - new_width) // 2, (size - new_height) // 2
+    return scale, (new_width, new_height), (pad_x, pad_y)
+
+
+class FramePreprocessor:
+    """
+    Inputs:
+        image_size: model input size
+        device: device of the model input
+        pad_value: value of the letterbox borders (0 as in PadIfNeeded)
+        swap_rb: frames are BGR (OpenCV) and the model was trained on RGB images
+    The returned tensor is reused by the next call: clone it (or concatenate it in a batch) to keep it.
+    """
+
+    def __init__(self, image_size=config.IMAGE_SIZE, device=config.DEVICE, pad_value=0, swap_rb=True):
+        self.image_size = image_size
+        self.device = torch.device(device)
+        self.pad_value = pad_value
+        self.swap_rb = swap_rb
+        cuda = self.device.type == "cuda"
+
+        # uint8 HWC buffer the frame is letterboxed into, and its numpy view (same memory)
+        self.buffer = torch.full((image_size, image_size, 3), pad_value, dtype=torch.uint8)
+        if cuda:
+            self.buffer = self.buffer.pin_memory()
+        self._buffer_np = self.buffer.numpy()
+        # On CUDA the buffer is copied asynchronously, the next frame waits for the copy before writing into it
+        self._device_buffer = torch.empty_like(self.buffer, device=self.device) if cuda else self.buffer
+        self._copied = torch.cuda.Event() if cuda else None
+        self.output = torch.empty((1, 3, image_size, image_size), dtype=torch.float32, device=self.device)
+        self._geometry = None
+
+    def __call__(self, frame, out=None):
+        """
+        Letterboxes a (H, W, 3) uint8 frame.
+        Inputs:
+            out: (3, image_size, image_size) float tensor on the device to write into (e.g. one image of a batch),
+                 instead of the preprocessor's own input tensor
+        Returns:
+            (1, 3, image_size, image_size) float tensor on the device (or out), scale, (pad_x, pad_y)
+        """
+        height, width = frame.shape[:2]
+        scale, (new_width, new_height), (pad_x, pad_y) = letterbox_geometry(height, width, self.image_size)
+
+        if self._copied is not None:
+            self._copied.synchronize()
+        if self._geometry != (new_width, new_height):
+            # Borders only need to be cleared when the frame size changes
+            self._buffer_np[:] = self.pad_value
+            self._geometry = (new_width, new_height)
+
+        roi = self._buffer_np[pad_y:pad_y + new_height, pad_x:pad_x + new_width]
+        if (new_width, new_height) == (width, height):
+            roi[:] = frame
+        else:
+            cv2.resize(frame, (new_width, new_height), dst=roi, interpolation=cv2.INTER_LINEAR)
+        if self.swap_rb:
+            cv2.cvtColor(roi, cv2.COLOR_BGR2RGB, dst=roi)
+
+        if self._copied is not None:
+            self._device_buffer.copy_(self.buffer, non_blocking=True)
+            self._copied.record()
+        # Layout change, conversion and normalization in one op, into the preallocated input
+        torch.mul(self._device_buffer.permute(2, 0, 1), 1 / 255, out=self.output[0] if out is None else out)
+        return self.output if out is None else out, scale, (pad_x, pad_y)
+
+
+def boxes_to_frame(boxes, scale, pad, image_size=config.IMAGE_SIZE, frame_shape=None):
+    """
+    Maps boxes [class_pred, conf, x, y, width, height] relative to the letterboxed input to boxes relative to the
+    original frame of shape frame_shape (height, width, ...), as expected by realtime.draw_bb.
+    """
+    if len(boxes) == 0:
+        return []
+    boxes = np.asarray(boxes, dtype=np.float64).copy()
+    frame_height, frame_width = frame_shape[:2]
+    boxes[:, 2] = (boxes[:, 2] * image_size - pad[0]) / (scale * frame_width)
+    boxes[:, 3] = (boxes[:, 3] * image_size - pad[1]) / (scale * frame_height)
+    boxes[:, 4] = boxes[:, 4] * image_size / (scale * frame_width)
+    boxes[:, 5] = boxes[:, 5] * image_size / (scale * frame_height)
+    return boxes.tolist()
+
+
+if __name__ == "__main__":
+    # Same input as config.test_transforms (up to resize rounding)
+    frame = (np.random.default_rng(0).random((240, 320, 3)) * 255).astype(np.uint8)
+    preprocessor = FramePreprocessor(device="cpu")
+    x, scale, pad = preprocessor(frame)
+    expected = config.test_transforms(image=cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), bboxes=[])["image"]
+    assert x.shape == (1, 3, config.IMAGE_SIZE, config.IMAGE_SIZE)
+    assert (x[0] - expected).abs().mean() < 0.01, (x[0] - expected).abs().mean()
+    # The buffer is shared with the numpy view: no copy between OpenCV and torch
+    assert np.shares_memory(preprocessor._buffer_np, preprocessor.buffer.numpy())
+
+    # A box in the frame -> letterboxed input -> back to the frame
+    box = [0, 0.9, 0.25, 0.5, 0.1, 0.2]
+    boxed = [0, 0.9, (0.25 * 320 * scale + pad[0]) / 416, (0.5 * 240 * scale + pad[1]) / 416, 0.1 * 320 * scale / 416, 0.2 * 240 * scale / 416]
+    assert np.allclose(boxes_to_frame([boxed], scale, pad, frame_shape=frame.shape)[0], box)
+    print("Success!")
@@ -0,0 +1,173 @@
+"""
+Post-training static INT8 quantization of YOLOv3 / YOLOv3Tiny for CPU inference (procedure room machines without GPU).
+
+Uses the FX graph mode quantization of PyTorch: the BatchNorms are folded into the convolutions, observers are
+inserted, a sample of bronchoscopy images is run through the model to calibrate the activation ranges and the
+model is converted to quantized kernels (x86/fbgemm on Intel/AMD, qnnpack on ARM). Inputs and outputs stay float,
+so the quantized model is a drop-in replacement in realtime.py.
+
+The quantized model is saved as TorchScript, set it as TORCHSCRIPT_MODEL with RUNTIME "torchscript" in config.py.
+The mAP of the float and quantized models is compared on the val split of the same dataset (--eval-dir, --eval-split).
+
+Usage:
+    python quantize.py --checkpoint checkpoint.pth.tar --calib-dir ../data/formatted_bronchoscopy/images/train --out quantized.pt
+"""
+
+import argparse
+import os
+import random
+import numpy as np
+import torch
+
+from pathlib import Path
+from PIL import Image
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+import config
+from inference import benchmark, check_parity
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp"}
+
+
+def default_engine():
+    """Quantized backend of this machine"""
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError("No quantized engine available in this PyTorch build")
+
+
+def calibration_images(image_dir, num_images=200, seed=0):
+    """
+    Random sample of the images of a folder, letterboxed to IMAGE_SIZE as in config.test_transforms.
+    Returns:
+        list of (1, 3, IMAGE_SIZE, IMAGE_SIZE) float tensors
+    """
+    files = sorted(p for p in Path(image_dir).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+    if len(files) == 0:
+        raise FileNotFoundError(f"No images in {image_dir}")
+    files = random.Random(seed).sample(files, min(num_images, len(files)))
+    images = []
+    for file in files:
+        image = np.array(Image.open(file).convert("RGB"))
+        image = config.test_transforms(image=image, bboxes=[])["image"]
+        images.append(image.unsqueeze(0))
+    return images
+
+
+def quantize_model(model, calibration, engine=None):
+    """
+    INT8 static quantization of a trained model.
+    Inputs:
+        model: YOLOv3 or YOLOv3Tiny (float, on the cpu), it is not modified
+        calibration: iterable of input batches used to calibrate the activation ranges
+        engine: quantized backend ("x86", "fbgemm", "qnnpack"), default the one of this machine
+    Returns:
+        quantized model (float inputs and outputs)
+    """
+    engine = engine or default_engine()
+    torch.backends.quantized.engine = engine
+    model = model.cpu().eval()
+    example_input = torch.zeros(1, 3, config.IMAGE_SIZE, config.IMAGE_SIZE)
+
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs=(example_input,))
+    with torch.no_grad():
+        for x in calibration:
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def save_quantized(model, path, example_input=None):
+    """Saves the quantized model as TorchScript, loadable without the model classes"""
+    if example_input is None:
+        example_input = torch.zeros(1, 3, config.IMAGE_SIZE, config.IMAGE_SIZE)
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(model, example_input).eval())
+    torch.jit.save(scripted, path)
+    return scripted
+
+
+def load_quantized(path, engine=None):
+    torch.backends.quantized.engine = engine or default_engine()
+    return torch.jit.load(path, map_location="cpu").eval()
+
+
+def evaluation_map(model, image_dir, label_dir):
+    """
+    mAP@MAP_IOU_THRESH of the model on the images of image_dir with their YOLO labels in label_dir (layout of
+    data/formatted_bronchoscopy: images/<split>, labels/<split>), on the cpu
+    """
+    import tempfile
+    import pandas as pd
+    from torch.utils.data import DataLoader
+    from dataset import YOLODataset
+    from utils import evaluate_map
+
+    # csv of the split ([image file, label file] per row) as read by YOLODataset
+    images = sorted(p.name for p in Path(image_dir).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+    with tempfile.TemporaryDirectory() as directory:
+        csv_file = os.path.join(directory, "split.csv")
+        pd.DataFrame({"image": images, "label": [Path(name).stem + ".txt" for name in images]}).to_csv(csv_file, index=False)
+        dataset = YOLODataset(
+            csv_file,
+            transform=config.test_transforms,
+            S=config.S,
+            img_dir=image_dir,
+            label_dir=label_dir,
+            anchors=config.ANCHORS,
+        )
+    loader = DataLoader(dataset, batch_size=8, num_workers=config.NUM_WORKERS, shuffle=False)
+    metric = evaluate_map(loader, model, iou_threshold=config.NMS_IOU_THRESH, anchors=config.ANCHORS,
+                          threshold=config.CONF_THRESHOLD, num_classes=config.NUM_CLASSES,
+                          map_iou_thresholds=[config.MAP_IOU_THRESH], device="cpu")
+    return metric.compute().item()
+
+
+if __name__ == "__main__":
+    from YOLOv3 import YOLOv3
+    from YOLOv3Tiny import YOLOv3Tiny
+
+    parser = argparse.ArgumentParser(description="INT8 post-training quantization of YOLOv3 / YOLOv3Tiny")
+    parser.add_argument("--checkpoint", default=config.CHECKPOINT_FILE)
+    parser.add_argument("--model", default=config.MODEL, choices=["YOLOv3", "YOLOv3Tiny"],
+                        help="architecture of the checkpoint (default MODEL of config.py)")
+    parser.add_argument("--calib-dir", default=os.path.join("..", "data", "formatted_bronchoscopy", "images", "train"),
+                        help="folder of calibration images")
+    parser.add_argument("--calib-images", type=int, default=200, help="number of calibration images")
+    parser.add_argument("--eval-dir", default=os.path.join("..", "data", "formatted_bronchoscopy"),
+                        help="dataset of the mAP comparison, with images/<split> and labels/<split> (skipped if missing)")
+    parser.add_argument("--eval-split", default="val", help="split of --eval-dir for the mAP comparison")
+    parser.add_argument("--engine", default=None, help="quantized backend (default: the one of this machine)")
+    parser.add_argument("--out", default="quantized.pt")
+    args = parser.parse_args()
+
+    model_class = YOLOv3Tiny if args.model == "YOLOv3Tiny" else YOLOv3
+    model = model_class(num_classes=config.NUM_CLASSES)
+    model.load_state_dict(torch.load(args.checkpoint, map_location="cpu")["state_dict"])
+    model.eval()
+
+    print(f"=> Calibrating on {args.calib_images} images of {args.calib_dir}")
+    calibration = calibration_images(args.calib_dir, args.calib_images)
+    quantized = quantize_model(model, calibration, args.engine)
+    quantized = save_quantized(quantized, args.out)
+    print(f"=> Saved quantized model to {args.out} ({torch.backends.quantized.engine})")
+
+    x = calibration[0]
+    max_diff, _ = check_parity(model, quantized, x)
+    print(f"Max abs difference of the raw outputs: {max_diff:.3f}")
+
+    float_ms = benchmark(model, x)
+    quantized_ms = benchmark(quantized, x)
+    print(f"CPU latency: float {float_ms:.1f} ms, int8 {quantized_ms:.1f} ms, speedup {float_ms / quantized_ms:.2f}x")
+
+    eval_images = os.path.join(args.eval_dir, "images", args.eval_split)
+    eval_labels = os.path.join(args.eval_dir, "labels", args.eval_split)
+    if os.path.isdir(eval_images):
+        float_map = evaluation_map(model, eval_images, eval_labels)
+        quantized_map = evaluation_map(quantized, eval_images, eval_labels)
+        print(f"mAP@{config.MAP_IOU_THRESH} on {eval_images}: float {float_map:.4f}, int8 {quantized_map:.4f}, "
+              f"delta {quantized_map - float_map:+.4f}")
+    else:
+        print(f"{eval_images} not found, mAP comparison skipped")
@@ -1,32 +1,120 @@
 """
-Performs real-time object detection on a webcam feed using a trained YOLOv3 model.
+Performs real-time object detection on a webcam feed using a trained YOLOv3 model (or on a recorded video, VIDEO_PATH).
+The model runs with one of the inference backends below (RUNTIME in config.py): eager PyTorch, TorchScript or
+ONNX Runtime (models exported with export.py), set BENCHMARK_RUNTIMES to compare their latency on this machine.
 """
 
 import cv2
+import os
+import threading
 import torch
 import numpy as np
-from utils import cells_to_bboxes, non_max_suppression
+from utils import non_max_suppression, predictions_to_bboxes
 import config
+from detection_cache import DetectionCache, filter_boxes, model_fingerprint, video_key
+from inference import benchmark, prepare_for_inference
+from preprocess import FramePreprocessor, boxes_to_frame
+from quantize import default_engine
+from sort_tracker import DetectionTracker
+from streaming import LatestFrameCapture, StreamingPipeline, run_stream
 from config import *
 from YOLOv3 import YOLOv3
+from YOLOv3Tiny import YOLOv3Tiny
 
-def preprocess_frame(frame):
-    """
-    Preprocesses the frame before passing it to the model.
-    """
-    # Resize to 416x416
-    frame = cv2.resize(frame, (config.IMAGE_SIZE, config.IMAGE_SIZE))
+try:
+    import onnxruntime as ort
+    HAS_ONNXRUNTIME = True
+except ImportError:
+    HAS_ONNXRUNTIME = False
+
+
+class TorchBackend:
+    """Eager PyTorch model loaded from a checkpoint, prepared for inference (inference.py)"""
+    name = "torch"
+
+    def __init__(self, checkpoint_file=config.CHECKPOINT_FILE, device=config.DEVICE):
+        model_class = YOLOv3Tiny if config.MODEL == "YOLOv3Tiny" else YOLOv3
+        model = model_class(num_classes=config.NUM_CLASSES).to(device)
+        checkpoint = torch.load(checkpoint_file, map_location=device)
+        model.load_state_dict(checkpoint['state_dict'])
+        model.eval()
+        # Fold the BatchNorms into the convolutions (and compile with INFERENCE_BACKEND)
+        self.model = prepare_for_inference(model, channels_last=config.CHANNELS_LAST, backend=config.INFERENCE_BACKEND)
+
+    @torch.no_grad()
+    def __call__(self, x):
+        return list(self.model(x))
+
+
+class TorchScriptBackend:
+    """TorchScript model written by export.py or quantize.py (INT8, cpu only)"""
+    name = "torchscript"
 
-    # Converts the pixel values of the resized image to 32-bit floating-point.
-    # Then normalizes the pixel values by dividing them by 255.0, which scales the values from the original 0 to 255 range to a new 0.0 to 1.0 range.
-    frame = frame.astype(np.float32) / 255.0
+    def __init__(self, model_file=config.TORCHSCRIPT_MODEL, device=config.DEVICE):
+        if device == "cpu":
+            torch.backends.quantized.engine = default_engine()
+        self.model = torch.jit.load(model_file, map_location=device).eval()
 
-    # Converts the image from HWC (height, width, channels) to CHW (channels, height, width) format.
-    frame = np.transpose(frame, (2, 0, 1))
+    @torch.no_grad()
+    def __call__(self, x):
+        return list(self.model(x))
 
-    # Adds a new axis to the image, which is the batch dimension (unsqeeze) and move it to the GPU.
-    return torch.tensor(frame, dtype=torch.float32).unsqueeze(0).to(config.DEVICE)
 
+class OnnxRuntimeBackend:
+    """ONNX model written by export.py, run with ONNX Runtime (CUDA if available, else cpu)"""
+    name = "onnxruntime"
+
+    def __init__(self, model_file=config.ONNX_MODEL, device=config.DEVICE):
+        if not HAS_ONNXRUNTIME:
+            raise ImportError("onnxruntime is not installed (pip install onnxruntime)")
+        providers = ["CPUExecutionProvider"]
+        if device != "cpu" and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = ort.InferenceSession(model_file, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.device = device
+
+    def __call__(self, x):
+        outputs = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})
+        return [torch.from_numpy(output).to(self.device) for output in outputs]
+
+
+# Inference backends: callables taking a (N, 3, IMAGE_SIZE, IMAGE_SIZE) tensor and returning the list of
+# (N, 3, S, S, 5 + NUM_CLASSES) predictions of every scale, with the model file they load
+BACKENDS = {
+    "torch": (TorchBackend, config.CHECKPOINT_FILE),
+    "torchscript": (TorchScriptBackend, config.TORCHSCRIPT_MODEL),
+    "onnxruntime": (OnnxRuntimeBackend, config.ONNX_MODEL),
+}
+
+
+def load_backend(runtime=config.RUNTIME, device=config.DEVICE):
+    backend_class, model_file = BACKENDS[runtime]
+    return backend_class(model_file, device=device)
+
+
+def benchmark_backends(batch_sizes=(1,), runs=20, device=config.DEVICE):
+    """
+    Prints the latency of every runtime whose model file exists, to pick the fastest one on this machine.
+    Returns:
+        {runtime: {batch size: latency [ms]}}
+    """
+    results = {}
+    for runtime, (backend_class, model_file) in BACKENDS.items():
+        if not os.path.exists(model_file):
+            print(f"{runtime}: {model_file} not found, skipped")
+            continue
+        try:
+            backend = backend_class(model_file, device=device)
+        except ImportError as e:
+            print(f"{runtime}: {e}")
+            continue
+        results[runtime] = {}
+        for batch_size in batch_sizes:
+            x = torch.rand(batch_size, 3, config.IMAGE_SIZE, config.IMAGE_SIZE, device=device)
+            results[runtime][batch_size] = benchmark(backend, x, runs)
+            print(f"{runtime}: batch {batch_size}: {results[runtime][batch_size]:.1f} ms")
+    return results
 
 def get_boxes(y, scaled_anchors, conf_threshold=0.6, iou_threshold=0.5):
     """
@@ -40,18 +128,14 @@ def get_boxes(y, scaled_anchors, conf_threshold=0.6, iou_threshold=0.5):
         A list of bounding boxes, each in the format [class_pred, conf, x, y, width, height]
     """
 
-    boxes = []
+    # Converts the model's predictions of all the scales into a tensor of bounding boxes of the (single) image,
+    # boxes below the confidence threshold are dropped on the device.
+    boxes = predictions_to_bboxes(y, scaled_anchors, threshold=conf_threshold)[0]
 
-    # For each anchor box  
-    for i in range(y[0].shape[1]): 
-        anchor = scaled_anchors[i]
-        # Converts the model's predictions for the current anchor box and the current prediction into a list of bounding boxes.
-        boxes += cells_to_bboxes( y[i], is_preds=True, S=y[i].shape[2], anchors=anchor)[0]
-    
-    # Applies non-max suppression to the bounding boxes.
+    # Applies non-max suppression to the bounding boxes, only the kept boxes are moved to the cpu.
     boxes = non_max_suppression(boxes, iou_threshold=iou_threshold, threshold=conf_threshold, box_format="midpoint")
-    
-    return boxes
+
+    return boxes.tolist()
 
 def draw_bb(image, boxes, class_labels, colors):
     """
@@ -87,13 +171,22 @@ def draw_bb(image, boxes, class_labels, colors):
     return image
 
 if __name__ == "__main__":
-    # Load saved model
-    model = YOLOv3(num_classes=config.NUM_CLASSES).to(config.DEVICE)
-    checkpoint = torch.load(config.CHECKPOINT_FILE, map_location=config.DEVICE)
-    model.load_state_dict(checkpoint['state_dict'])
-    model.eval()
-
-    # Get scaled anchors as a tensor of shape (3, 3, 2) where 3 is the number of anchor boxes and 2 is the width and height of each anchor box.
+    if config.BENCHMARK_RUNTIMES:
+        benchmark_backends(batch_sizes=(1, 4))
+        raise SystemExit
+
+    # Load the model with the runtime chosen in config.py
+    model = load_backend(config.RUNTIME)
+    # Detections of the recorded videos / images already seen, keyed by the model file: replays don't run the model
+    # again (the webcam is not cached)
+    cache = None
+    if config.DETECTION_CACHE is not None:
+        cache = DetectionCache(config.DETECTION_CACHE, model_fingerprint(BACKENDS[config.RUNTIME][1]),
+                               max_entries=config.DETECTION_CACHE_MAX_ENTRIES)
+    # Letterboxes the frames as config.test_transforms, into a reused input tensor
+    preprocessor = FramePreprocessor()
+
+    # Get scaled anchors as a tensor of shape (num scales, 3, 2) where 3 is the number of anchor boxes and 2 is the width and height of each anchor box.
     scaled_anchors = ( torch.tensor(config.ANCHORS) * torch.tensor(config.S).unsqueeze(1).unsqueeze(1).repeat(1, 3, 2) ).to(config.DEVICE)
 
     # Get class labels and generate random colors for each class
@@ -103,36 +196,32 @@ if __name__ == "__main__":
 
     # Test with webcam or image
     webcam = WEBCAM
-    if webcam == True:
-        # Test with webcam
-        cap = cv2.VideoCapture(0)
-        while True:
-            # Get camera frame
-            ret, frame = cap.read()
-            if not ret:
-                print("Failed to grab frame")
-                break
-
-            with torch.no_grad(): # Don't need to track gradients for inference, so save memory
-                # Preprocess frame to tensor
-                input_tensor = preprocess_frame(frame)
-
-                # Get model predictions
-                y = model(input_tensor)
-
-                # Get bounding boxes (apply non-max suppression)
-                boxes = get_boxes(y, scaled_anchors, conf_threshold=0.7, iou_threshold=0.7)
-
-                # Draw bounding boxes on frame
-                frame_bb = draw_bb(frame, boxes, class_labels, colors)
-
-            cv2.imshow("YOLOv3 Webcam", frame_bb)
-
-            key = cv2.waitKey(1)
-            if key == ord('q'):
-                break
-
-        cap.release()
+    if webcam == True and config.VIDEO_PATH is not None:
+        # Test with a recorded video: every frame is read in order (none is dropped), the frames already seen are
+        # served from the cache
+        from batch_inference import MicroBatchRunner, run_source
+        runner = MicroBatchRunner(model, scaled_anchors, conf_threshold=0.7, iou_threshold=0.7, cache=cache)
+        capture = cv2.VideoCapture(config.VIDEO_PATH)
+        stop = threading.Event()
+
+        def show(frame_index, frame, boxes):
+            cv2.imshow("YOLOv3 Video", draw_bb(frame, boxes, class_labels, colors))
+            if cv2.waitKey(1) == ord('q'):
+                stop.set()
+
+        run_source(runner, capture, show, video_path=config.VIDEO_PATH, stop=stop)
+        capture.release()
+        runner.close()
+        cv2.destroyAllWindows()
+    elif webcam == True:
+        # Test with webcam: capture, preprocessing, inference and display run in parallel stages
+        capture = LatestFrameCapture(0)
+        # The detector runs every DETECT_EVERY frames, the boxes are tracked in between
+        tracker = DetectionTracker(None, detect_every=config.DETECT_EVERY) if config.TRACKING else None
+        pipeline = StreamingPipeline(
+            capture, model, lambda y: get_boxes(y, scaled_anchors, conf_threshold=0.7, iou_threshold=0.7),
+            tracker=tracker)
+        run_stream(pipeline, lambda frame, boxes: draw_bb(frame, boxes, class_labels, colors))
         cv2.destroyAllWindows()
     else:
         # Test with a single image
@@ -140,12 +229,22 @@ if __name__ == "__main__":
         cv2.imshow("before prediction", img)
         # Start timer to count inference time
         start = cv2.getTickCount()
-        input_tensor = preprocess_frame(img)
-        y = model(input_tensor)
+        conf_threshold, iou_threshold = 0.6, 0.5
+        boxes = cache.get(video_key(IMG_PATH, 0), conf_threshold, iou_threshold) if cache is not None else None
+        if boxes is None:
+            input_tensor, scale, pad = preprocessor(img)
+            y = model(input_tensor)
+            detect_conf = cache.min_conf if cache is not None else conf_threshold
+            boxes = boxes_to_frame(get_boxes(y, scaled_anchors, detect_conf, iou_threshold), scale, pad, frame_shape=img.shape)
+            if cache is not None:
+                cache.put(video_key(IMG_PATH, 0), boxes, iou_threshold)
+                boxes = filter_boxes(boxes, conf_threshold)
         end = cv2.getTickCount()
         print("Inference time: ", (end - start) / cv2.getTickFrequency())
-        boxes = get_boxes(y, scaled_anchors)
         image_bb = draw_bb(img, boxes, class_labels, colors)
         cv2.imshow("opencv bb image", image_bb)
         cv2.waitKey(0)
         cv2.destroyAllWindows()
+    if cache is not None:
+        print(f"Detection cache: {cache.hits} hits, {cache.misses} misses, {len(cache)} frames stored")
+        cache.close()
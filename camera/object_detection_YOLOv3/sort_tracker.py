@@ -0,0 +1,241 @@
+"""
+SORT-style tracking of the detections, so that the detector doesn't have to run on every frame.
+
+During ductoscopy / bronchoscopy the camera moves slowly: the boxes of a frame are close to the boxes of the
+previous frame. Every object is tracked with a constant velocity Kalman filter on [x, y, w, h]; detections are
+associated to the tracks by IoU (Hungarian assignment). DetectionTracker runs the detector only every N-th frame,
+or earlier when a track becomes uncertain, and propagates the tracks with the Kalman prediction in between.
+Every track keeps an id and a class (majority vote of its detections), so labels don't flicker between frames.
+
+Boxes are [class, conf, x, y, w, h] relative to the frame (realtime.get_boxes + preprocess.boxes_to_frame),
+tracks are returned as [track_id, class, conf, x, y, w, h].
+
+Reference: Bewley et al., Simple Online and Realtime Tracking, https://arxiv.org/abs/1602.00763
+"""
+
+import collections
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+
+def iou_matrix(boxes1, boxes2):
+    """IoU of every pair of (N, 4) and (M, 4) [x, y, w, h] (midpoint) boxes, (N, M) array"""
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    c1 = np.concatenate((boxes1[:, :2] - boxes1[:, 2:] / 2, boxes1[:, :2] + boxes1[:, 2:] / 2), axis=1)
+    c2 = np.concatenate((boxes2[:, :2] - boxes2[:, 2:] / 2, boxes2[:, :2] + boxes2[:, 2:] / 2), axis=1)
+    top_left = np.maximum(c1[:, None, :2], c2[None, :, :2])
+    bottom_right = np.minimum(c1[:, None, 2:], c2[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area1 = np.prod(boxes1[:, 2:], axis=1)
+    area2 = np.prod(boxes2[:, 2:], axis=1)
+    return intersection / (area1[:, None] + area2[None, :] - intersection + 1e-9)
+
+
+def _assign(cost):
+    # Minimum cost assignment, greedy when scipy isn't available
+    if HAS_SCIPY:
+        return linear_sum_assignment(cost)
+    rows, cols = [], []
+    for flat in np.argsort(cost, axis=None):
+        r, c = np.unravel_index(flat, cost.shape)
+        if r not in rows and c not in cols:
+            rows.append(r)
+            cols.append(c)
+    return np.array(rows, dtype=int), np.array(cols, dtype=int)
+
+
+class KalmanBoxTrack:
+    """
+    One tracked object: constant velocity Kalman filter on the state [x, y, w, h, vx, vy, vw, vh] (per frame).
+    The noises are variances in frame-relative units (measurement: std of 0.005, i.e. ~2 px at 416).
+    """
+
+    def __init__(self, track_id, box, process_noise=1e-6, measurement_noise=2.5e-5, velocity_noise=1e-4):
+        class_pred, conf = int(box[0]), float(box[1])
+        self.id = track_id
+        self.x = np.concatenate((np.asarray(box[2:6], dtype=np.float64), np.zeros(4)))
+        self.P = np.diag([measurement_noise] * 4 + [velocity_noise] * 4)
+        self.F = np.eye(8)
+        self.F[:4, 4:] = np.eye(4)
+        self.H = np.eye(4, 8)
+        self.Q = np.eye(8) * process_noise
+        self.R = np.eye(4) * measurement_noise
+        self.class_votes = collections.Counter({class_pred: conf})
+        self.conf = conf
+        self.hits = 1
+        self.frames_since_update = 0
+
+    @property
+    def box(self):
+        return self.x[:4]
+
+    @property
+    def class_pred(self):
+        return self.class_votes.most_common(1)[0][0]
+
+    def predict(self):
+        self.x = self.F @ self.x
+        self.x[2:4] = np.maximum(self.x[2:4], 1e-4)
+        self.P = self.F @ self.P @ self.F.T + self.Q
+        self.frames_since_update += 1
+        return self.box
+
+    def update(self, box):
+        z = np.asarray(box[2:6], dtype=np.float64)
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ (z - self.H @ self.x)
+        self.P = (np.eye(8) - K @ self.H) @ self.P
+        self.class_votes[int(box[0])] += float(box[1])
+        self.conf = float(box[1])
+        self.hits += 1
+        self.frames_since_update = 0
+
+    def uncertainty(self):
+        """Position standard deviation relative to the box size (grows while the track is only predicted)"""
+        return float(np.sqrt(self.P[0, 0] + self.P[1, 1]) / max(np.sqrt(self.x[2] * self.x[3]), 1e-4))
+
+
+class SortTracker:
+    """
+    Inputs:
+        iou_threshold: minimum IoU between a track and a detection to associate them
+        max_age: frames without detection a track is kept for (counted in detection rounds by DetectionTracker)
+        min_hits: detections needed before a track is reported
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=3, min_hits=1):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.tracks = []
+        self._next_id = 0
+
+    def predict(self):
+        """Propagates every track to the next frame"""
+        for track in self.tracks:
+            track.predict()
+        return self.output()
+
+    def update(self, boxes):
+        """
+        Associates the detections of the current frame (after predict) to the tracks.
+        Returns the tracks [track_id, class, conf, x, y, w, h]
+        """
+        boxes = [list(box) for box in boxes]
+        matched_tracks, matched_boxes = set(), set()
+        if self.tracks and boxes:
+            ious = iou_matrix([t.box for t in self.tracks], [b[2:6] for b in boxes])
+            rows, cols = _assign(-ious)
+            for r, c in zip(rows, cols):
+                if ious[r, c] >= self.iou_threshold:
+                    self.tracks[r].update(boxes[c])
+                    matched_tracks.add(r)
+                    matched_boxes.add(c)
+
+        self.tracks = [t for i, t in enumerate(self.tracks) if i in matched_tracks or t.frames_since_update <= self.max_age]
+        for c, box in enumerate(boxes):
+            if c not in matched_boxes:
+                self.tracks.append(KalmanBoxTrack(self._next_id, box))
+                self._next_id += 1
+        return self.output()
+
+    def output(self):
+        return [
+            [t.id, t.class_pred, t.conf, *t.box.tolist()]
+            for t in self.tracks if t.hits >= self.min_hits
+        ]
+
+
+class DetectionTracker:
+    """
+    Runs detect(frame) -> boxes every `detect_every` frames, or as soon as a track is too uncertain
+    (uncertainty() above max_uncertainty), and propagates the tracks in between.
+    Inputs:
+        detect: callable(frame) -> list of [class, conf, x, y, w, h] relative to the frame
+        detect_every: detection period in frames (1: every frame, the tracker only gives ids and stable classes)
+    """
+
+    def __init__(self, detect, detect_every=5, max_uncertainty=0.25, iou_threshold=0.3, max_age=None, min_hits=1):
+        self.detect = detect
+        self.detect_every = detect_every
+        self.max_uncertainty = max_uncertainty
+        # A track is dropped after being missed by 2 detections
+        self.tracker = SortTracker(iou_threshold, max_age if max_age is not None else 2 * detect_every, min_hits)
+        self.frames_since_detection = None
+        self.detections = 0
+        self.frames = 0
+
+    def needs_detection(self):
+        if self.frames_since_detection is None or self.frames_since_detection + 1 >= self.detect_every:
+            return True
+        return any(track.uncertainty() > self.max_uncertainty for track in self.tracker.tracks)
+
+    def step(self, boxes=None):
+        """
+        Advances one frame: with the detections of the frame if the detector was run (boxes not None), else
+        with the Kalman prediction only. Returns the tracks [track_id, class, conf, x, y, w, h].
+        """
+        self.frames += 1
+        self.tracker.predict()
+        if boxes is None:
+            self.frames_since_detection += 1
+            return self.tracker.output()
+        self.detections += 1
+        self.frames_since_detection = 0
+        return self.tracker.update(boxes)
+
+    def __call__(self, frame):
+        return self.step(self.detect(frame) if self.needs_detection() else None)
+
+
+def tracks_to_boxes(tracks):
+    """Tracks [track_id, class, conf, x, y, w, h] -> boxes [class, conf, x, y, w, h] (e.g. for realtime.draw_bb)"""
+    return [track[1:] for track in tracks]
+
+
+def ultralytics_detector(model, conf=0.25, iou=0.7):
+    """
+    detect(frame) callable for DetectionTracker from an Ultralytics YOLO model (test_yolo.py, realtime_yolo.py).
+    """
+    def detect(frame):
+        result = model.predict(source=frame, conf=conf, iou=iou, verbose=False)[0]
+        xywhn = result.boxes.xywhn.cpu().numpy()
+        classes = result.boxes.cls.cpu().numpy()
+        confs = result.boxes.conf.cpu().numpy()
+        return [[int(c), float(p), *box.tolist()] for c, p, box in zip(classes, confs, xywhn)]
+    return detect
+
+
+if __name__ == "__main__":
+    # Two boxes moving slowly, the detector only sees them every 4 frames with a noisy position and class
+    rng = np.random.default_rng(0)
+    truth = np.array([[0.3, 0.4, 0.1, 0.12], [0.7, 0.5, 0.2, 0.15]])
+    velocity = np.array([[0.004, 0.002, 0, 0], [-0.003, 0.001, 0, 0]])
+
+    def detect(frame_index):
+        boxes = truth + velocity * frame_index + rng.normal(0, 0.002, truth.shape)
+        classes = [0, 1] if rng.random() > 0.2 else [1, 1]  # class flicker
+        return [[c, 0.9, *box] for c, box in zip(classes, boxes.tolist())]
+
+    tracker = DetectionTracker(detect, detect_every=4)
+    ids = set()
+    for frame_index in range(40):
+        tracks = tracker(frame_index)
+        assert len(tracks) == 2
+        expected = truth + velocity * frame_index
+        for track in tracks:
+            ids.add(track[0])
+            match = np.argmin(np.abs(expected[:, 0] - track[3]))
+            assert np.allclose(track[3:7], expected[match], atol=0.02), (frame_index, track, expected[match])
+            assert track[1] == match  # majority class
+    assert ids == {0, 1}, ids
+    assert tracker.detections <= 40 // 4 + 2, tracker.detections
+    print(f"Detector run on {tracker.detections} of {tracker.frames} frames, {len(ids)} stable ids")
+    print("Success!")
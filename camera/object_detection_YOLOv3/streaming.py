@@ -0,0 +1,200 @@
+"""
+Streaming runtime for live cameras: capture, preprocessing, inference and display run in separate stages so that
+the camera latency doesn't add to the inference latency.
+    - LatestFrameCapture: thread reading the camera continuously and keeping only the latest frame (frames the
+      model is too slow for are dropped instead of queuing up in the driver buffer)
+    - preprocessing thread: letterboxes the latest frame while the previous one is in the model
+    - inference thread: model, NMS and mapping of the boxes back to the frame (with a sort_tracker.DetectionTracker,
+      the model only runs every N-th frame and the tracks are propagated in between)
+    - consumer (caller thread, as OpenCV windows must be updated from it): draws, shows and/or records the frames
+Every frame carries its capture time, the end-to-end latency (capture -> displayed) and the effective fps are
+reported.
+"""
+
+import collections
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+import torch
+
+from preprocess import FramePreprocessor, boxes_to_frame
+from sort_tracker import tracks_to_boxes
+
+
+class LatestFrameCapture:
+    """
+    Reads a cv2.VideoCapture in a thread and keeps the latest frame.
+    read() returns the next frame not returned yet: (frame index, frame, capture time), or None when the source ended.
+    """
+
+    def __init__(self, source=0):
+        self.capture = cv2.VideoCapture(source)
+        self._condition = threading.Condition()
+        self._latest = None
+        self._last_read = -1
+        self._running = True
+        self.frames_read = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            ret, frame = self.capture.read()
+            timestamp = time.perf_counter()
+            with self._condition:
+                if not ret:
+                    self._running = False
+                else:
+                    self._latest = (self.frames_read, frame, timestamp)
+                    self.frames_read += 1
+                self._condition.notify_all()
+        self.capture.release()
+
+    def read(self, timeout=None):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: not self._running or (self._latest is not None and self._latest[0] > self._last_read), timeout)
+            if self._latest is None or self._latest[0] <= self._last_read:
+                return None
+            self._last_read = self._latest[0]
+            return self._latest
+
+    @property
+    def running(self):
+        return self._running
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+
+def _put_latest(q, item):
+    # Keeps only the newest items when the consumer is slower than the producer
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class StreamingPipeline:
+    """
+    Inputs:
+        capture: LatestFrameCapture
+        model: callable taking a (1, 3, IMAGE_SIZE, IMAGE_SIZE) input and returning the predictions of every scale
+        get_boxes: callable(predictions) -> list of boxes [class_pred, conf, x, y, width, height] (realtime.get_boxes)
+        tracker: optional sort_tracker.DetectionTracker deciding on which frames the model runs
+    results() yields (frame index, frame, boxes relative to the frame, capture time) for the caller to display.
+    """
+
+    def __init__(self, capture, model, get_boxes, queue_size=1, tracker=None):
+        self.capture = capture
+        self.model = model
+        self.get_boxes = get_boxes
+        self.tracker = tracker
+        # The tensor of a preprocessor is reused by its next call: one preprocessor is written while one waits in
+        # the queue and one is read by the model
+        self._preprocessors = [FramePreprocessor() for _ in range(queue_size + 2)]
+        self._inputs = queue.Queue(maxsize=queue_size)
+        self._results = queue.Queue(maxsize=queue_size)
+        self._running = True
+        self.latencies = collections.deque(maxlen=1000)
+        self.displayed = collections.deque(maxlen=1000)  # display times
+        self.frames_displayed = 0
+        self._threads = [
+            threading.Thread(target=self._preprocess, daemon=True),
+            threading.Thread(target=self._infer, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _preprocess(self):
+        k = 0
+        while self._running:
+            item = self.capture.read(timeout=0.5)
+            if item is None:
+                if not self.capture.running:
+                    break
+                continue
+            frame_index, frame, timestamp = item
+            x, scale, pad = self._preprocessors[k % len(self._preprocessors)](frame)
+            k += 1
+            # Blocks while the model is busy: the preprocessed frame waits, newer frames are dropped by the capture
+            self._inputs.put((frame_index, frame, timestamp, x, scale, pad))
+        self._inputs.put(None)
+
+    def _infer(self):
+        while True:
+            item = self._inputs.get()
+            if item is None:
+                break
+            frame_index, frame, timestamp, x, scale, pad = item
+            boxes = None
+            if self.tracker is None or self.tracker.needs_detection():
+                with torch.no_grad():
+                    boxes = self.get_boxes(self.model(x))
+                boxes = boxes_to_frame(boxes, scale, pad, frame_shape=frame.shape)
+            if self.tracker is not None:
+                boxes = tracks_to_boxes(self.tracker.step(boxes))
+            _put_latest(self._results, (frame_index, frame, boxes, timestamp))
+        self._results.put(None)
+
+    def results(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            yield item
+
+    def frame_done(self, timestamp):
+        """Records the end-to-end latency of a frame (call it once the frame is displayed / written)"""
+        now = time.perf_counter()
+        self.latencies.append(now - timestamp)
+        self.displayed.append(now)
+        self.frames_displayed += 1
+
+    def stats(self, window=2.0):
+        """Mean and 95th percentile end-to-end latency [ms] and fps over the last `window` seconds"""
+        if not self.latencies:
+            return 0.0, 0.0, 0.0
+        latencies = np.array(self.latencies) * 1000
+        recent = [t for t in self.displayed if t >= self.displayed[-1] - window]
+        fps = (len(recent) - 1) / (recent[-1] - recent[0]) if len(recent) > 1 and recent[-1] > recent[0] else 0.0
+        return latencies.mean(), np.percentile(latencies, 95), fps
+
+    def stop(self):
+        self._running = False
+        self.capture.stop()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+
+
+def run_stream(pipeline, draw, show=True, writer=None, window_name="YOLOv3 Webcam", quit_key='q'):
+    """
+    Consumer stage: draws every result with draw(frame, boxes), shows it and/or writes it to a cv2.VideoWriter,
+    and prints the latency and fps. Stops at the end of the source or when quit_key is pressed.
+    """
+    last_print = time.perf_counter()
+    for frame_index, frame, boxes, timestamp in pipeline.results():
+        frame = draw(frame, boxes)
+        if writer is not None:
+            writer.write(frame)
+        if show:
+            cv2.imshow(window_name, frame)
+        pipeline.frame_done(timestamp)
+        if show and cv2.waitKey(1) == ord(quit_key):
+            break
+        if time.perf_counter() - last_print > 2.0:
+            mean_latency, p95_latency, fps = pipeline.stats()
+            print(f"Latency {mean_latency:.1f} ms (p95 {p95_latency:.1f} ms), {fps:.1f} fps, "
+                  f"frames captured {pipeline.capture.frames_read}, displayed {pipeline.frames_displayed}")
+            last_print = time.perf_counter()
+    pipeline.stop()
+    mean_latency, p95_latency, fps = pipeline.stats()
+    print(f"End-to-end latency {mean_latency:.1f} ms (p95 {p95_latency:.1f} ms), {fps:.1f} fps")
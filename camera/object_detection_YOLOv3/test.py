@@ -7,10 +7,12 @@ import numpy as np
 from utils import get_loaders, plot_couple_examples
 import config
 from YOLOv3 import YOLOv3
+from YOLOv3Tiny import YOLOv3Tiny
 
 
 if __name__ == "__main__":
-    model = YOLOv3(num_classes=config.NUM_CLASSES).to(config.DEVICE)
+    model_class = YOLOv3Tiny if config.MODEL == "YOLOv3Tiny" else YOLOv3
+    model = model_class(num_classes=config.NUM_CLASSES).to(config.DEVICE)
     checkpoint = torch.load(config.CHECKPOINT_FILE, map_location=config.DEVICE)
     model.load_state_dict(checkpoint['state_dict'])
     train_loader, test_loader, train_eval_loader = get_loaders(train_csv_path=config.DATASET + "/8examples.csv", test_csv_path=config.DATASET + "/8examples.csv")
@@ -18,20 +18,22 @@ The anchor boxes are specified in the model configuration file config.py as a li
 To create the scaled anchors, the anchor widths and heights are first multiplied by the corresponding stride values (config.S), which determine the size of the grid cells in 
 each feature map. The resulting tensor has shape (3, num_anchors_per_scale, 2), where the first dimension represents the scale and the second dimension represents the anchor box index.
 The third dimension contains the scaled width and height values of each anchor box.
-The scaled anchors are then moved to the same device (CPU or GPU) as the model using the .to() method and are passed to the train_fn() function, where they are used to compute the YOLOv3 loss function for each scale.
+The scaled anchors are then moved to the same device (CPU or GPU) as the model using the .to() method and are passed to the train_fn() function, where they are used to compute the YOLOv3 loss function of all the scales.
 """
 
 import config
 import torch
 import torch.optim as optim
 
+from batch_augment import BatchAugment
+from dataset import encode_targets
 from YOLOv3 import YOLOv3
 from YOLOv3Tiny import YOLOv3Tiny
 from tqdm import tqdm
 from utils import (
-    mean_average_precision,
+    COCO_IOU_THRESHOLDS,
     cells_to_bboxes,
-    get_evaluation_bboxes,
+    evaluate_map,
     save_checkpoint,
     load_checkpoint,
     check_class_accuracy,
@@ -45,40 +47,45 @@ warnings.filterwarnings("ignore")
 torch.backends.cudnn.benchmark = True
 
 
-def train_fn(train_loader, model, optimizer, loss_fn, scaler, scaled_anchors):
+def train_fn(train_loader, model, optimizer, loss_fn, scaler, scaled_anchors, batch_augment=None):
     loop = tqdm(train_loader, leave=True)
-    losses = []
+    # Running sums for the epoch means shown in the progress bar
+    loss_sum = 0.0
+    component_sums = 0.0
+    num_batches = 0
+    anchors = torch.tensor(config.ANCHORS).reshape(-1, 2)
     for batch_idx, (x, y) in enumerate(loop):
         x = x.to(config.DEVICE)
-        y0, y1, y2 = (
-            y[0].to(config.DEVICE),
-            y[1].to(config.DEVICE),
-            y[2].to(config.DEVICE),
-        )
+        if batch_augment is not None:
+            # y holds the boxes of the batch: augment the batch and encode the targets on the device
+            boxes, box_image_idx = y[0].to(config.DEVICE), y[1].to(config.DEVICE)
+            x, boxes, box_image_idx = batch_augment(x, boxes, box_image_idx)
+            y = encode_targets(boxes, box_image_idx, x.shape[0], anchors, config.S)
+
+        y = [target.to(config.DEVICE) for target in y]
 
         with torch.cuda.amp.autocast():
             out = model(x)
-            loss = (
-                loss_fn(out[0], y0, scaled_anchors[0])
-                + loss_fn(out[1], y1, scaled_anchors[1])
-                + loss_fn(out[2], y2, scaled_anchors[2])
-            )
+            loss, loss_components = loss_fn(out, y, scaled_anchors)
 
-        losses.append(loss.item())
+        loss_sum += loss.item()
+        component_sums = component_sums + torch.stack(list(loss_components.values())).float()
+        num_batches += 1
         optimizer.zero_grad()
         scaler.scale(loss).backward()
         scaler.step(optimizer)
         scaler.update()
 
         # update progress bar
-        mean_loss = sum(losses) / len(losses)
-        loop.set_postfix(loss=mean_loss)
+        mean_loss = loss_sum / num_batches
+        mean_components = (component_sums / num_batches).tolist()
+        loop.set_postfix(loss=mean_loss, **{name: f"{value:.3f}" for name, value in zip(loss_components, mean_components)})
 
 
 
 def main():
-    model = YOLOv3(num_classes=config.NUM_CLASSES).to(config.DEVICE)
-    #model = YOLOv3Tiny(num_classes=config.NUM_CLASSES).to(config.DEVICE)
+    model_class = YOLOv3Tiny if config.MODEL == "YOLOv3Tiny" else YOLOv3
+    model = model_class(num_classes=config.NUM_CLASSES).to(config.DEVICE)
     optimizer = optim.Adam(model.parameters(), lr=config.LEARNING_RATE, weight_decay=config.WEIGHT_DECAY)
     loss_fn = YoloLoss()
     scaler = torch.cuda.amp.GradScaler()
@@ -89,6 +96,7 @@ def main():
         load_checkpoint(config.CHECKPOINT_FILE, model, optimizer, config.LEARNING_RATE)
 
     scaled_anchors = ( torch.tensor(config.ANCHORS) * torch.tensor(config.S).unsqueeze(1).unsqueeze(1).repeat(1, 3, 2) ).to(config.DEVICE)
+    batch_augment = BatchAugment() if config.BATCH_AUGMENT else None
 
     for epoch in range(config.NUM_EPOCHS):
         #plot_couple_examples(model, test_loader, 0.6, 0.5, scaled_anchors)
@@ -96,7 +104,7 @@ def main():
 
         # Train
         print("Training...")
-        train_fn(train_loader, model, optimizer, loss_fn, scaler, scaled_anchors)
+        train_fn(train_loader, model, optimizer, loss_fn, scaler, scaled_anchors, batch_augment)
 
         if config.SAVE_MODEL:
             save_checkpoint(model, optimizer, filename=f"checkpoint.pth.tar")
@@ -109,9 +117,11 @@ def main():
         if epoch > 0 and epoch % 3 == 0:
             print("Checking class accuracy on Test loader:")
             check_class_accuracy(model, test_loader, threshold=config.CONF_THRESHOLD)
-            pred_boxes, true_boxes = get_evaluation_bboxes(test_loader, model, iou_threshold=config.NMS_IOU_THRESH, anchors=config.ANCHORS, threshold=config.CONF_THRESHOLD)
-            mapval = mean_average_precision(pred_boxes, true_boxes, iou_threshold=config.MAP_IOU_THRESH, box_format="midpoint", num_classes=config.NUM_CLASSES)
-            print(f"MAP: {mapval.item()}")
+            metric = evaluate_map(test_loader, model, iou_threshold=config.NMS_IOU_THRESH, anchors=config.ANCHORS, threshold=config.CONF_THRESHOLD,
+                                  num_classes=config.NUM_CLASSES, map_iou_thresholds=[config.MAP_IOU_THRESH] + COCO_IOU_THRESHOLDS, device=config.DEVICE)
+            mapvals = metric.compute(per_threshold=True)
+            print(f"MAP: {mapvals[0].item()}")
+            print(f"MAP@0.5:0.95: {mapvals[1:].mean().item()}")
 
             # Set model back to train mode (was in eval mode in check_class_accuracy and get_evaluation_bboxes)
             model.train()
@@ -3,13 +3,20 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import numpy as np
 import os
+import queue
 import random
+import threading
 import torch
 
-from collections import Counter
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+try:
+    import torchvision
+    HAS_TORCHVISION = True
+except ImportError:
+    HAS_TORCHVISION = False
+
 
 def iou_width_height(boxes1, boxes2):
     """
@@ -77,7 +84,92 @@ def intersection_over_union(boxes_preds, boxes_labels, box_format="midpoint"):
     return intersection / (box1_area + box2_area - intersection + 1e-6)
 
 
-def non_max_suppression(bboxes, iou_threshold, threshold, box_format="corners"):
+def midpoint_to_corners(boxes):
+    """Converts (..., 4) boxes from (x, y, w, h) to (x1, y1, x2, y2)"""
+    return torch.cat((boxes[..., 0:2] - boxes[..., 2:4] / 2, boxes[..., 0:2] + boxes[..., 2:4] / 2), dim=-1)
+
+
+def box_iou_matrix(boxes1, boxes2, box_format="midpoint"):
+    """
+    Pairwise intersection over union of two sets of boxes.
+
+    Parameters:
+        boxes1 (tensor): (N, 4) boxes
+        boxes2 (tensor): (M, 4) boxes
+        box_format (str): midpoint/corners, if boxes (x,y,w,h) or (x1,y1,x2,y2)
+
+    Returns:
+        tensor: (N, M) IoU of every pair of boxes
+    """
+    if box_format == "midpoint":
+        boxes1 = midpoint_to_corners(boxes1)
+        boxes2 = midpoint_to_corners(boxes2)
+
+    top_left = torch.max(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = torch.min(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    intersection = (bottom_right - top_left).clamp(0).prod(dim=-1)
+    area1 = ((boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])).abs()
+    area2 = ((boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])).abs()
+
+    return intersection / (area1[:, None] + area2[None, :] - intersection + 1e-6)
+
+
+def _greedy_nms(boxes, scores, classes, iou_threshold):
+    # Same as torchvision.ops.batched_nms: boxes sorted by score, a box suppresses the lower scored
+    # boxes of its class overlapping more than iou_threshold. The IoU matrix is computed at once,
+    # only the (cheap) greedy pass is sequential.
+    order = torch.argsort(scores, descending=True)
+    boxes, classes = boxes[order], classes[order]
+    overlap = box_iou_matrix(boxes, boxes, box_format="corners") > iou_threshold
+    overlap &= classes[:, None] == classes[None, :]
+    overlap = overlap.triu(diagonal=1).cpu().numpy()
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if not suppressed[i]:
+            suppressed |= overlap[i]
+
+    return order[torch.from_numpy(~suppressed).to(order.device)]
+
+
+def batched_nms(bboxes, iou_threshold, threshold, box_format="corners", top_k=None, max_detections=None):
+    """
+    Class aware Non Max Suppression on tensors.
+
+    Parameters:
+        bboxes (tensor): (N, 6) boxes of one image or (BATCH_SIZE, N, 6) padded boxes of a batch,
+        each box as [class, prob_score, x1, y1, x2, y2] (or [class, prob_score, x, y, w, h])
+        iou_threshold (float): boxes of the same class overlapping more than this are suppressed
+        threshold (float): threshold to remove predicted bboxes (independent of IoU)
+        box_format (str): "midpoint" or "corners" used to specify bboxes
+        top_k (int): only the top_k boxes by score are considered (None for all)
+        max_detections (int): maximum number of boxes kept per image (None for all)
+
+    Returns:
+        tensor (K, 6) of the kept boxes sorted by score, or a list of them for a batch
+    """
+    if bboxes.dim() == 3:
+        return [batched_nms(b, iou_threshold, threshold, box_format, top_k, max_detections) for b in bboxes]
+
+    bboxes = bboxes[bboxes[:, 1] > threshold]
+    if top_k is not None and len(bboxes) > top_k:
+        bboxes = bboxes[torch.topk(bboxes[:, 1], top_k).indices]
+    if len(bboxes) == 0:
+        return bboxes
+
+    corners = midpoint_to_corners(bboxes[:, 2:6]) if box_format == "midpoint" else bboxes[:, 2:6]
+    if HAS_TORCHVISION:
+        keep = torchvision.ops.batched_nms(corners.float(), bboxes[:, 1].float(), bboxes[:, 0].long(), iou_threshold)
+    else:
+        keep = _greedy_nms(corners, bboxes[:, 1], bboxes[:, 0], iou_threshold)
+
+    if max_detections is not None:
+        keep = keep[:max_detections]
+
+    return bboxes[keep]
+
+
+def non_max_suppression(bboxes, iou_threshold, threshold, box_format="corners", top_k=None, max_detections=None):
     """
     Video explanation of this function:
     https://youtu.be/YDkjWEN8jNA
@@ -85,30 +177,149 @@ def non_max_suppression(bboxes, iou_threshold, threshold, box_format="corners"):
     Does Non Max Suppression given bboxes
 
     Parameters:
-        bboxes (list): where each element is a bounding box of format [class, prob_score, x1, y1, x2, y2]
+        bboxes (list or tensor): where each element is a bounding box of format [class, prob_score, x1, y1, x2, y2]
         iou_threshold (float): threshold where predicted bboxes is correct
         threshold (float): threshold to remove predicted bboxes (independent of IoU)
         box_format (str): "midpoint" or "corners" used to specify bboxes
+        top_k (int): only the top_k boxes by score are considered (None for all)
+        max_detections (int): maximum number of boxes kept (None for all)
 
     Returns:
-        list: bboxes after performing NMS given a specific IoU threshold
+        list: bboxes after performing NMS given a specific IoU threshold (tensor if bboxes is a tensor)
     """
 
-    assert type(bboxes) == list
+    assert type(bboxes) == list or torch.is_tensor(bboxes)
+
+    if torch.is_tensor(bboxes):
+        return batched_nms(bboxes, iou_threshold, threshold, box_format, top_k, max_detections)
+
+    if len(bboxes) == 0:
+        return []
 
-    bboxes = [box for box in bboxes if box[1] > threshold]
-    bboxes = sorted(bboxes, key=lambda x: x[1], reverse=True)
-    bboxes_after_nms = []
+    bboxes_after_nms = batched_nms(torch.tensor(bboxes, dtype=torch.float32), iou_threshold, threshold, box_format,
+                                   top_k, max_detections)
 
-    while bboxes:
-        chosen_box = bboxes.pop(0)
+    return bboxes_after_nms.tolist()
 
-        bboxes = [box for box in bboxes if box[0] != chosen_box[0] 
-                  or intersection_over_union(torch.tensor(chosen_box[2:]), torch.tensor(box[2:]), box_format=box_format, ) < iou_threshold]
 
-        bboxes_after_nms.append(chosen_box)
+# IoU thresholds of the COCO mAP@0.5:0.95
+COCO_IOU_THRESHOLDS = [0.5 + 0.05 * i for i in range(10)]
 
-    return bboxes_after_nms
+
+class MeanAveragePrecision:
+    """
+    Accumulates detections batch by batch and computes the mAP at one or more IoU thresholds.
+
+    The boxes are matched image by image: the IoU matrix between the detections and the ground truths
+    of an image is computed at once, and each detection only keeps its score and whether it's a true
+    positive at every threshold, so memory doesn't grow with the boxes of the whole dataset.
+
+    Parameters:
+        num_classes (int): number of classes
+        iou_thresholds (list): IoU thresholds, e.g. [0.5] or COCO_IOU_THRESHOLDS for mAP@0.5:0.95
+        box_format (str): "midpoint" or "corners" used to specify bboxes
+
+    Usage:
+        metric = MeanAveragePrecision(num_classes, COCO_IOU_THRESHOLDS)
+        for each batch: metric.update(pred_boxes, true_boxes)
+        map_50_95 = metric.compute()
+    """
+
+    def __init__(self, num_classes, iou_thresholds=(0.5,), box_format="midpoint"):
+        self.num_classes = num_classes
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+        self.box_format = box_format
+        self.reset()
+
+    def reset(self):
+        self.scores = [[] for _ in range(self.num_classes)]
+        self.true_positives = [[] for _ in range(self.num_classes)]
+        self.num_true_boxes = np.zeros(self.num_classes, dtype=np.int64)
+
+    def update(self, pred_boxes, true_boxes):
+        """
+        Parameters:
+            pred_boxes (list): one tensor (K, 6) per image of [class_prediction, prob_score, x1, y1, x2, y2]
+            true_boxes (list): one tensor (M, 6) per image of the ground truths, same format
+        """
+        for preds, targets in zip(pred_boxes, true_boxes):
+            self._update_image(torch.as_tensor(preds, dtype=torch.float32).reshape(-1, 6),
+                               torch.as_tensor(targets, dtype=torch.float32).reshape(-1, 6))
+
+    def _update_image(self, preds, targets):
+        target_classes = targets[:, 0].long().cpu().numpy()
+        self.num_true_boxes += np.bincount(target_classes, minlength=self.num_classes)[:self.num_classes]
+        if len(preds) == 0:
+            return
+
+        # Detections by decreasing score (stable, as the sort of the reference implementation)
+        preds = preds[torch.sort(preds[:, 1], descending=True, stable=True).indices]
+        pred_classes = preds[:, 0].long().cpu().numpy()
+        scores = preds[:, 1].cpu().numpy()
+        true_positives = np.zeros((len(preds), len(self.iou_thresholds)), dtype=bool)
+
+        if len(targets) > 0:
+            # Best ground truth of the same class for every detection
+            ious = box_iou_matrix(preds[:, 2:6], targets[:, 2:6].to(preds.device), box_format=self.box_format)
+            ious = ious.cpu().numpy()
+            ious[pred_classes[:, None] != target_classes[None, :]] = 0
+            best_gt = ious.argmax(axis=1)
+            best_iou = ious[np.arange(len(preds)), best_gt]
+
+            # A ground truth is only detected once: by the first (highest score) detection matching it
+            for t, iou_threshold in enumerate(self.iou_thresholds):
+                candidates = np.flatnonzero(best_iou > iou_threshold)
+                _, first = np.unique(best_gt[candidates], return_index=True)
+                true_positives[candidates[first], t] = True
+
+        for c in np.unique(pred_classes):
+            in_class = pred_classes == c
+            self.scores[c].append(scores[in_class])
+            self.true_positives[c].append(true_positives[in_class])
+
+    def compute(self, per_threshold=False):
+        """
+        Returns:
+            tensor: mAP averaged over the classes with ground truths and over the IoU thresholds
+            (one value per threshold if per_threshold)
+        """
+        # used for numerical stability later on
+        epsilon = 1e-6
+        average_precisions = []
+
+        for c in range(self.num_classes):
+            # If none exists for this class then we can safely skip
+            if self.num_true_boxes[c] == 0:
+                continue
+
+            if len(self.scores[c]) == 0:
+                average_precisions.append(np.zeros(len(self.iou_thresholds)))
+                continue
+
+            scores = np.concatenate(self.scores[c])
+            true_positives = np.concatenate(self.true_positives[c])[np.argsort(-scores, kind="stable")]
+            TP_cumsum = np.cumsum(true_positives, axis=0)
+            FP_cumsum = np.cumsum(~true_positives, axis=0)
+            recalls = TP_cumsum / (self.num_true_boxes[c] + epsilon)
+            precisions = TP_cumsum / (TP_cumsum + FP_cumsum + epsilon)
+            precisions = np.concatenate((np.ones((1, len(self.iou_thresholds))), precisions))
+            recalls = np.concatenate((np.zeros((1, len(self.iou_thresholds))), recalls))
+            # trapezoidal rule for numerical integration, one column per threshold
+            average_precisions.append(np.sum(np.diff(recalls, axis=0) * (precisions[1:] + precisions[:-1]) / 2, axis=0))
+
+        if len(average_precisions) == 0:
+            return torch.zeros(len(self.iou_thresholds)) if per_threshold else torch.tensor(0.0)
+
+        mean_precisions = torch.tensor(np.mean(average_precisions, axis=0), dtype=torch.float32)
+        return mean_precisions if per_threshold else mean_precisions.mean()
+
+
+def _group_by_image(boxes, image_ids):
+    # Splits [train_idx, ...] boxes into one tensor per image of image_ids (sorted), without the index
+    boxes = boxes[torch.sort(boxes[:, 0], stable=True).indices]
+    starts = torch.searchsorted(boxes[:, 0].contiguous(), image_ids).tolist()
+    ends = torch.searchsorted(boxes[:, 0].contiguous(), image_ids, right=True).tolist()
+    return [boxes[start:end, 1:] for start, end in zip(starts, ends)]
 
 
 def mean_average_precision(
@@ -124,7 +335,8 @@ def mean_average_precision(
         pred_boxes (list): list of lists containing all bboxes with each bboxes
         specified as [train_idx, class_prediction, prob_score, x1, y1, x2, y2]
         true_boxes (list): Similar as pred_boxes except all the correct ones
-        iou_threshold (float): threshold where predicted bboxes is correct
+        iou_threshold (float or list): threshold where predicted bboxes is correct,
+        a list of thresholds (e.g. COCO_IOU_THRESHOLDS) gives the mAP averaged over them
         box_format (str): "midpoint" or "corners" used to specify bboxes
         num_classes (int): number of classes
 
@@ -132,94 +344,16 @@ def mean_average_precision(
         float: mAP value across all classes given a specific IoU threshold
     """
 
-    # list storing all AP for respective classes
-    average_precisions = []
-
-    # used for numerical stability later on
-    epsilon = 1e-6
-
-    for c in range(num_classes):
-        detections = []
-        ground_truths = []
-
-        # Go through all predictions and targets,
-        # and only add the ones that belong to the
-        # current class c
-        for detection in pred_boxes:
-            if detection[1] == c:
-                detections.append(detection)
-
-        for true_box in true_boxes:
-            if true_box[1] == c:
-                ground_truths.append(true_box)
-
-        # find the amount of bboxes for each training example
-        # Counter here finds how many ground truth bboxes we get
-        # for each training example, so let's say img 0 has 3,
-        # img 1 has 5 then we will obtain a dictionary with:
-        # amount_bboxes = {0:3, 1:5}
-        amount_bboxes = Counter([gt[0] for gt in ground_truths])
-
-        # We then go through each key, val in this dictionary
-        # and convert to the following (w.r.t same example):
-        # ammount_bboxes = {0:torch.tensor[0,0,0], 1:torch.tensor[0,0,0,0,0]}
-        for key, val in amount_bboxes.items():
-            amount_bboxes[key] = torch.zeros(val)
-
-        # sort by box probabilities which is index 2
-        detections.sort(key=lambda x: x[2], reverse=True)
-        TP = torch.zeros((len(detections)))
-        FP = torch.zeros((len(detections)))
-        total_true_bboxes = len(ground_truths)
-
-        # If none exists for this class then we can safely skip
-        if total_true_bboxes == 0:
-            continue
-
-        for detection_idx, detection in enumerate(detections):
-            # Only take out the ground_truths that have the same
-            # training idx as detection
-            ground_truth_img = [
-                bbox for bbox in ground_truths if bbox[0] == detection[0]
-            ]
-
-            num_gts = len(ground_truth_img)
-            best_iou = 0
-
-            for idx, gt in enumerate(ground_truth_img):
-                iou = intersection_over_union(
-                    torch.tensor(detection[3:]),
-                    torch.tensor(gt[3:]),
-                    box_format=box_format,
-                )
-
-                if iou > best_iou:
-                    best_iou = iou
-                    best_gt_idx = idx
-
-            if best_iou > iou_threshold:
-                # only detect ground truth detection once
-                if amount_bboxes[detection[0]][best_gt_idx] == 0:
-                    # true positive and add this bounding box to seen
-                    TP[detection_idx] = 1
-                    amount_bboxes[detection[0]][best_gt_idx] = 1
-                else:
-                    FP[detection_idx] = 1
-
-            # if IOU is lower then the detection is a false positive
-            else:
-                FP[detection_idx] = 1
-
-        TP_cumsum = torch.cumsum(TP, dim=0)
-        FP_cumsum = torch.cumsum(FP, dim=0)
-        recalls = TP_cumsum / (total_true_bboxes + epsilon)
-        precisions = TP_cumsum / (TP_cumsum + FP_cumsum + epsilon)
-        precisions = torch.cat((torch.tensor([1]), precisions))
-        recalls = torch.cat((torch.tensor([0]), recalls))
-        # torch.trapz for numerical integration
-        average_precisions.append(torch.trapz(precisions, recalls))
-
-    return sum(average_precisions) / len(average_precisions)
+    iou_thresholds = iou_threshold if np.ndim(iou_threshold) > 0 else [iou_threshold]
+    metric = MeanAveragePrecision(num_classes, iou_thresholds, box_format)
+
+    # Group the boxes by image once
+    pred_boxes = torch.as_tensor(pred_boxes, dtype=torch.float32).reshape(-1, 7)
+    true_boxes = torch.as_tensor(true_boxes, dtype=torch.float32).reshape(-1, 7)
+    image_ids = torch.cat((pred_boxes[:, 0], true_boxes[:, 0])).unique()
+    metric.update(_group_by_image(pred_boxes, image_ids), _group_by_image(true_boxes, image_ids))
+
+    return metric.compute()
 
 
 def plot_image(image, boxes):
@@ -267,51 +401,122 @@ def plot_image(image, boxes):
     plt.show()
    
 
+def prefetch_batches(loader, device, depth=2):
+    """
+    Iterates over the loader in a background thread and moves the images to the device ahead of time,
+    so that loading (and the host to device copy, with pin_memory) overlaps with inference.
+    If the caller stops early (break or exception), the worker stops and the prefetched batches are released.
+    """
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up when the consumer is gone instead of blocking on a full queue
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for x, labels in loader:
+                if not put((x.to(device, non_blocking=True), labels)):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # Drops the batches already on the device
+        while not batches.empty():
+            batches.get_nowait()
+        thread.join()
+
+
+def _scale_anchors(anchors, predictions, device):
+    # anchors of every scale relative to its grid
+    return [torch.tensor([*anchors[i]], device=device) * predictions[i].shape[2] for i in range(len(predictions))]
+
+
+def _evaluation_batch(predictions, labels, scaled_anchors, iou_threshold, threshold, box_format):
+    # NMS of the predictions and ground truths of a batch, as one tensor per image on the device
+    pred_boxes = [
+        non_max_suppression(image_boxes, iou_threshold=iou_threshold, threshold=threshold, box_format=box_format)
+        for image_boxes in predictions_to_bboxes(predictions, scaled_anchors, threshold=threshold)
+    ]
+
+    # we just want one bbox for each label, not one for each scale
+    # (labels of the last scale, decoded with the anchors and grid of that scale)
+    last_labels = labels[-1].to(predictions[-1].device)
+    true_boxes = decode_bboxes(last_labels, scaled_anchors[-1], S=last_labels.shape[2], is_preds=False)
+    true_boxes = [image_boxes[image_boxes[:, 1] > threshold] for image_boxes in true_boxes]
+
+    return pred_boxes, true_boxes
+
+
+def evaluate_map(loader, model, iou_threshold, anchors, threshold, num_classes, map_iou_thresholds=(0.5,),
+                 box_format="midpoint", device="cuda"):
+    """
+    Streaming version of get_evaluation_bboxes + mean_average_precision: every batch goes through NMS on the
+    device and updates the mAP accumulators, so memory stays constant and the cost is linear in the test set.
+    Returns the MeanAveragePrecision metric (call .compute() for the mAP)
+    """
+    # make sure model is in eval before get bboxes
+    model.eval()
+    metric = MeanAveragePrecision(num_classes, map_iou_thresholds, box_format)
+    scaled_anchors = None
+    for x, labels in tqdm(prefetch_batches(loader, device), total=len(loader)):
+        with torch.no_grad():
+            predictions = model(x)
+
+        if scaled_anchors is None:
+            scaled_anchors = _scale_anchors(anchors, predictions, device)
+
+        metric.update(*_evaluation_batch(predictions, labels, scaled_anchors, iou_threshold, threshold, box_format))
+
+    model.train()
+    return metric
+
+
 def get_evaluation_bboxes(loader, model, iou_threshold, anchors, threshold, box_format="midpoint", device="cuda"):
     """
     Returns all bboxes with score > threshold
+    (keeps every box of the test set in memory, use evaluate_map to compute the mAP)
     """
     # make sure model is in eval before get bboxes
     model.eval()
     train_idx = 0
     all_pred_boxes = []
     all_true_boxes = []
-    for batch_idx, (x, labels) in enumerate(tqdm(loader)):
-        x = x.to(device)
-
+    scaled_anchors = None
+    for x, labels in tqdm(prefetch_batches(loader, device), total=len(loader)):
         with torch.no_grad():
             predictions = model(x)
 
-        batch_size = x.shape[0]
-        bboxes = [[] for _ in range(batch_size)]
-        for i in range(3):
-            S = predictions[i].shape[2]
-            anchor = torch.tensor([*anchors[i]]).to(device) * S
-            boxes_scale_i = cells_to_bboxes(
-                predictions[i], anchor, S=S, is_preds=True
-            )
-            for idx, (box) in enumerate(boxes_scale_i):
-                bboxes[idx] += box
-
-        # we just want one bbox for each label, not one for each scale
-        true_bboxes = cells_to_bboxes(
-            labels[2], anchor, S=S, is_preds=False
-        )
-
-        for idx in range(batch_size):
-            nms_boxes = non_max_suppression(
-                bboxes[idx],
-                iou_threshold=iou_threshold,
-                threshold=threshold,
-                box_format=box_format,
-            )
+        if scaled_anchors is None:
+            scaled_anchors = _scale_anchors(anchors, predictions, device)
 
-            for nms_box in nms_boxes:
+        pred_boxes, true_boxes = _evaluation_batch(predictions, labels, scaled_anchors, iou_threshold, threshold, box_format)
+        for nms_boxes, image_true_boxes in zip(pred_boxes, true_boxes):
+            for nms_box in nms_boxes.tolist():
                 all_pred_boxes.append([train_idx] + nms_box)
 
-            for box in true_bboxes[idx]:
-                if box[1] > threshold:
-                    all_true_boxes.append([train_idx] + box)
+            for box in image_true_boxes.tolist():
+                all_true_boxes.append([train_idx] + box)
 
             train_idx += 1
 
@@ -319,43 +524,89 @@ def get_evaluation_bboxes(loader, model, iou_threshold, anchors, threshold, box_
     return all_pred_boxes, all_true_boxes
 
 
-def cells_to_bboxes(predictions, anchors, S, is_preds=True):
+# Offsets of the grid cells, cached per (S, device) as they are the same for every batch
+_CELL_OFFSETS = {}
+
+
+def cell_offsets(S, device):
     """
-    Scales the predictions coming from the model to be relative to the entire image such that they can be plotted.
+    Returns the (1, 1, S, S, 2) tensor with the [column, row] index of every cell of an S x S grid
+    """
+    key = (S, str(device))
+    if key not in _CELL_OFFSETS:
+        cells = torch.arange(S, dtype=torch.float32, device=device)
+        columns, rows = torch.meshgrid(cells, cells, indexing="xy")
+        _CELL_OFFSETS[key] = torch.stack((columns, rows), dim=-1)[None, None]
+    return _CELL_OFFSETS[key]
+
+
+def decode_bboxes(predictions, anchors, S, is_preds=True):
+    """
+    Same as cells_to_bboxes but returns a tensor on the device of the predictions (and doesn't modify them).
     INPUT:
-    predictions: tensor of size (N, 3, S, S, num_classes+5), where N is the batch size, 3 is the number of anchors,  
-    num_classes is the number of classes and 5 is the number of elements in the bounding box (x, y, width, height, objectness score)
-    anchors: the anchors used for the predictions
+    predictions: tensor of size (N, 3, S, S, num_classes+5) (or (N, 3, S, S, 6) for the targets)
+    anchors: the anchors used for the predictions, scaled to the grid
     S: the number of cells the image is divided in on the width (and height)
     is_preds: whether the input is predictions or the true bounding boxes
     OUTPUT:
-    converted_bboxes: the converted boxes of sizes (N, num_anchors, S, S, 1+5) with class index, object score, bounding box coordinates
-    1+5 because we add the class index to the bounding box coordinates
+    tensor of size (N, num_anchors * S * S, 6) with [class index, object score, x, y, width, height] relative to the image
     """
     BATCH_SIZE = predictions.shape[0]
     num_anchors = len(anchors)
-    box_predictions = predictions[..., 1:5]
     if is_preds:
-        anchors = anchors.reshape(1, len(anchors), 1, 1, 2)
-        box_predictions[..., 0:2] = torch.sigmoid(box_predictions[..., 0:2])
-        box_predictions[..., 2:] = torch.exp(box_predictions[..., 2:]) * anchors
+        anchors = anchors.to(predictions.device).reshape(1, num_anchors, 1, 1, 2)
+        xy = torch.sigmoid(predictions[..., 1:3])
+        w_h = torch.exp(predictions[..., 3:5]) * anchors
         scores = torch.sigmoid(predictions[..., 0:1])
-        best_class = torch.argmax(predictions[..., 5:], dim=-1).unsqueeze(-1)
+        best_class = torch.argmax(predictions[..., 5:], dim=-1, keepdim=True).to(xy.dtype)
     else:
+        xy = predictions[..., 1:3]
+        w_h = predictions[..., 3:5]
         scores = predictions[..., 0:1]
         best_class = predictions[..., 5:6]
 
-    cell_indices = (
-        torch.arange(S)
-        .repeat(predictions.shape[0], 3, S, 1)
-        .unsqueeze(-1)
-        .to(predictions.device)
-    )
-    x = 1 / S * (box_predictions[..., 0:1] + cell_indices)
-    y = 1 / S * (box_predictions[..., 1:2] + cell_indices.permute(0, 1, 3, 2, 4))
-    w_h = 1 / S * box_predictions[..., 2:4]
-    converted_bboxes = torch.cat((best_class, scores, x, y, w_h), dim=-1).reshape(BATCH_SIZE, num_anchors * S * S, 6)
-    return converted_bboxes.tolist()
+    xy = (xy + cell_offsets(S, predictions.device).to(xy.dtype)) / S
+    w_h = w_h / S
+    return torch.cat((best_class, scores, xy, w_h), dim=-1).reshape(BATCH_SIZE, num_anchors * S * S, 6)
+
+
+def predictions_to_bboxes(predictions, scaled_anchors, threshold=None, is_preds=True):
+    """
+    Decodes the predictions of all the scales of the model.
+    INPUT:
+    predictions: list of the model outputs, one per scale
+    scaled_anchors: anchors of every scale, scaled to the grid of the scale
+    threshold: boxes with object score <= threshold are dropped (on the device, before any transfer)
+    OUTPUT:
+    list with one (K, 6) tensor of [class index, object score, x, y, width, height] per image
+    """
+    bboxes = torch.cat([
+        decode_bboxes(scale_predictions, anchors, S=scale_predictions.shape[2], is_preds=is_preds)
+        for scale_predictions, anchors in zip(predictions, scaled_anchors)
+    ], dim=1)
+
+    if threshold is None:
+        return list(bboxes)
+
+    keep = bboxes[..., 1] > threshold
+    return [image_bboxes[image_keep] for image_bboxes, image_keep in zip(bboxes, keep)]
+
+
+def cells_to_bboxes(predictions, anchors, S, is_preds=True):
+    """
+    Scales the predictions coming from the model to be relative to the entire image such that they can be plotted.
+    INPUT:
+    predictions: tensor of size (N, 3, S, S, num_classes+5), where N is the batch size, 3 is the number of anchors,  
+    num_classes is the number of classes and 5 is the number of elements in the bounding box (x, y, width, height, objectness score)
+    anchors: the anchors used for the predictions
+    S: the number of cells the image is divided in on the width (and height)
+    is_preds: whether the input is predictions or the true bounding boxes
+    OUTPUT:
+    converted_bboxes: the converted boxes of sizes (N, num_anchors, S, S, 1+5) with class index, object score, bounding box coordinates
+    1+5 because we add the class index to the bounding box coordinates
+    (list version of decode_bboxes, use decode_bboxes / predictions_to_bboxes to stay on the device)
+    """
+    return decode_bboxes(predictions, anchors, S, is_preds).tolist()
 
 def check_class_accuracy(model, loader, threshold):
     model.eval()
@@ -368,7 +619,7 @@ def check_class_accuracy(model, loader, threshold):
         with torch.no_grad():
             out = model(x)
 
-        for i in range(3):
+        for i in range(len(out)):
             y[i] = y[i].to(config.DEVICE)
             obj = y[i][..., 0] == 1 # in paper this is Iobj_i
             noobj = y[i][..., 0] == 0  # in paper this is Iobj_i
@@ -427,32 +678,82 @@ def load_checkpoint(checkpoint_file, model, optimizer, lr):
 
 
 def get_loaders(train_csv_path, test_csv_path):
+    from batch_augment import collate_boxes
     from dataset import YOLODataset
 
     IMAGE_SIZE = config.IMAGE_SIZE
-    train_dataset = YOLODataset(
-        train_csv_path,
-        transform=config.train_transforms,
-        S=[IMAGE_SIZE // 32, IMAGE_SIZE // 16, IMAGE_SIZE // 8],
-        img_dir=config.IMG_DIR,
-        label_dir=config.LABEL_DIR,
-        anchors=config.ANCHORS,
-    )
-    test_dataset = YOLODataset(
-        test_csv_path,
-        transform=config.test_transforms,
-        S=[IMAGE_SIZE // 32, IMAGE_SIZE // 16, IMAGE_SIZE // 8],
-        img_dir=config.IMG_DIR,
-        label_dir=config.LABEL_DIR,
-        anchors=config.ANCHORS,
-    )
+    # With BATCH_AUGMENT the train loader returns the boxes, augmented and encoded per batch in train_fn
+    train_sampler = None
+    if config.PACKED_DATASET is not None:
+        # Memory-mapped shards of pack_dataset.py (the csv paths are not used), read one shard after the other
+        from pack_dataset import PackedDataset, ShardSampler
+        train_dataset = PackedDataset(
+            config.PACKED_DATASET,
+            "train",
+            transform=config.batch_train_transforms if config.BATCH_AUGMENT else config.train_transforms,
+            encode=not config.BATCH_AUGMENT,
+            anchors=config.ANCHORS,
+            S=config.S,
+        )
+        test_dataset = PackedDataset(
+            config.PACKED_DATASET,
+            "val",
+            transform=config.test_transforms,
+            encode=True,
+            anchors=config.ANCHORS,
+            S=config.S,
+        )
+        train_eval_dataset = PackedDataset(
+            config.PACKED_DATASET,
+            "train",
+            transform=config.test_transforms,
+            encode=True,
+            anchors=config.ANCHORS,
+            S=config.S,
+        )
+        train_sampler = ShardSampler(train_dataset)
+    else:
+        train_dataset = YOLODataset(
+            train_csv_path,
+            transform=config.batch_train_transforms if config.BATCH_AUGMENT else config.train_transforms,
+            encode=not config.BATCH_AUGMENT,
+            S=config.S,
+            img_dir=config.IMG_DIR,
+            label_dir=config.LABEL_DIR,
+            anchors=config.ANCHORS,
+            cache_dir=config.CACHE_DIR,
+            cache_images=config.CACHE_IMAGES,
+        )
+        test_dataset = YOLODataset(
+            test_csv_path,
+            transform=config.test_transforms,
+            S=config.S,
+            img_dir=config.IMG_DIR,
+            label_dir=config.LABEL_DIR,
+            anchors=config.ANCHORS,
+            cache_dir=config.CACHE_DIR,
+            cache_images=config.CACHE_IMAGES,
+        )
+        train_eval_dataset = YOLODataset(
+            train_csv_path,
+            transform=config.test_transforms,
+            S=config.S,
+            img_dir=config.IMG_DIR,
+            label_dir=config.LABEL_DIR,
+            anchors=config.ANCHORS,
+            cache_dir=config.CACHE_DIR,
+            cache_images=config.CACHE_IMAGES,
+        )
+
     train_loader = DataLoader(
         dataset=train_dataset,
         batch_size=config.BATCH_SIZE,
         num_workers=config.NUM_WORKERS,
         pin_memory=config.PIN_MEMORY,
-        shuffle=True,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
         drop_last=False,
+        collate_fn=collate_boxes if config.BATCH_AUGMENT else None,
     )
     test_loader = DataLoader(
         dataset=test_dataset,
@@ -463,14 +764,6 @@ def get_loaders(train_csv_path, test_csv_path):
         drop_last=False,
     )
 
-    train_eval_dataset = YOLODataset(
-        train_csv_path,
-        transform=config.test_transforms,
-        S=[IMAGE_SIZE // 32, IMAGE_SIZE // 16, IMAGE_SIZE // 8],
-        img_dir=config.IMG_DIR,
-        label_dir=config.LABEL_DIR,
-        anchors=config.ANCHORS,
-    )
     train_eval_loader = DataLoader(
         dataset=train_eval_dataset,
         batch_size=config.BATCH_SIZE,
@@ -491,22 +784,15 @@ def plot_couple_examples(model, loader, thresh, iou_thresh, anchors):
     x = x.to("cuda")
     with torch.no_grad():
         out = model(x)
-        bboxes = [[] for _ in range(x.shape[0])]
-        for i in range(3):
-            batch_size, A, S, _, _ = out[i].shape
-            anchor = anchors[i]
-            boxes_scale_i = cells_to_bboxes(
-                out[i], anchor, S=S, is_preds=True
-            )
-            for idx, (box) in enumerate(boxes_scale_i):
-                bboxes[idx] += box
+        batch_size = x.shape[0]
+        bboxes = predictions_to_bboxes(out, anchors, threshold=thresh)
 
         model.train()
 
     for i in range(batch_size):
         nms_boxes = non_max_suppression(
             bboxes[i], iou_threshold=iou_thresh, threshold=thresh, box_format="midpoint",
-        )
+        ).tolist()
         plot_image(x[i].permute(1,2,0).detach().cpu(), nms_boxes)
 
 